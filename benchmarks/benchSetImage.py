@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of mosaic image delivery to pyqtgraph
+
+Compares the time of ImageItem.setImage and the conversion to QImage for
+float64 images passed as transposed views with auto-levelling (the former
+delivery) and uint8 row-major images with fixed levels (MosaicImageViewWidget)
+for mosaic sizes of high-resolution screens.
+
+It is a standalone script, it needs PyQt5 and a display:
+
+    python benchmarks/benchSetImage.py
+
+__________________________________________________________________________
+Copyright (C) 2016-2021 OpenNFT.org
+
+"""
+
+import time
+
+import numpy as np
+import pyqtgraph as pg
+from PyQt5 import QtWidgets
+
+from opennft.mosaicview import MosaicImageViewWidget
+
+# mosaic sizes in megapixels
+sizes_mp = [10, 15, 20]
+repeats = 10
+
+
+def bench(func, image):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func(image)
+        times.append(time.perf_counter() - t0)
+    return np.median(times) * 1000
+
+
+def main():
+    app = QtWidgets.QApplication([])
+
+    widget = MosaicImageViewWidget()
+    widget.resize(1920, 1080)
+    widget.show()
+
+    old_item = pg.ImageItem(autoDownsample=True)
+
+    def set_old(image):
+        old_item.setImage(image.T)
+        old_item.render()
+
+    def set_new(image):
+        widget.set_background_image(image)
+        widget._background_imitem.render()
+
+    def set_new_rgba(image):
+        widget.set_pos_map_image(image)
+        widget._pos_map_imitem.render()
+
+    rng = np.random.default_rng(0)
+
+    print('{:>6} {:>16} {:>16} {:>16}'.format('MP', 'float64 auto, ms', 'uint8 fixed, ms', 'RGBA fixed, ms'))
+
+    for mp in sizes_mp:
+        side = int(np.sqrt(mp * 1e6))
+        float_image = rng.random((side, side))
+        uint8_image = (float_image * 255).astype(np.uint8)
+        rgba_image = rng.integers(0, 256, (side, side, 4), dtype=np.uint8)
+
+        print('{:>6} {:>16.1f} {:>16.1f} {:>16.1f}'.format(
+            mp, bench(set_old, float_image), bench(set_new, uint8_image), bench(set_new_rgba, rgba_image)))
+        app.processEvents()
+
+
+if __name__ == '__main__':
+    main()
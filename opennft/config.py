@@ -126,6 +126,18 @@ MC_PLOT_COLORS = [
 
 PROJ_ROI_COLORS = ROI_PLOT_COLORS
 
+# the mosaic background is refreshed at most every N volumes, overlay updates do not refresh it
+MOSAIC_BACKGROUND_REFRESH = 1
+# the mosaic shows every N-th slice and every M-th voxel of a slice, previews of high-resolution or multiband data
+MOSAIC_SLICE_STRIDE = 1
+MOSAIC_DOWNSAMPLE = 1
+# maximum rate of interactive view re-renders (cursor, thresholds), 0 means no limit
+VIEW_MAX_FPS = 20
+# time in seconds after which an unfinished view render is requested again
+VIEW_RENDER_TIMEOUT = 1.0
+# interpolation of the orthogonal view background and maps: 0 - nearest, 1 - trilinear, 3 - B-spline
+VIEW_RESAMPLING_ORDER = 0
+
 # debugging use only
 USE_SLEEP_IN_STOP = False
 HIDE_TEST_BTN = True
@@ -139,6 +151,10 @@ USE_RTQA = True
 USE_IGLM = True
 USE_ROI = True
 FIRST_SNR_VOLUME = 1
+# data type of voxelwise rtQA statistics, 'float32' halves the memory traffic
+RTQA_VOLUME_DTYPE = 'float64'
+# voxelwise rtQA maps are updated every N volumes, statistics are estimated from these volumes only
+RTQA_MAP_CADENCE = 1
 
 # zero padding settings
 zeroPaddingFlag = False
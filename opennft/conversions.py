@@ -9,8 +9,8 @@ def img2d_vol3d(img2d, xdim_img_number, ydim_img_number, dim3d):
             if sl >= dim3d[2]:
                 break
             else:
-                vol3d[:, :, sl] = img2d[sy * dim3d[0]: (sy + 1) * dim3d[0], sx * dim3d[0]: (sx + 1) * dim3d[0]]
-            vol3d[:, :, sl] = np.rot90(vol3d[:, :, sl], 3)
+                vol3d[:, :, sl] = np.rot90(
+                    img2d[sy * dim3d[1]: (sy + 1) * dim3d[1], sx * dim3d[0]: (sx + 1) * dim3d[0]], 3)
             sl += 1
 
     return vol3d
@@ -31,21 +31,78 @@ def vol3d_img2d(vol3d, sl_nr_img2d_dimx, sl_nr_img2d_dimy, xdim_img_number, ydim
     return img2d
 
 
+def mosaic_tiles(nr_slices):
+    """Returns numbers of mosaic tiles along x and y for the number of slices
+    """
+    xdim_img_number = round(np.sqrt(nr_slices))
+    ydim_img_number = xdim_img_number
+
+    if nr_slices > xdim_img_number ** 2:
+        xdim_img_number += 1
+
+    return xdim_img_number, ydim_img_number
+
+
 def get_mosaic_dim(dim3d):
-    xdim_img_number = round(np.sqrt(dim3d[2]))
-    tmp_dim = dim3d[2] - xdim_img_number ** 2
-
-    if tmp_dim == 0:
-        ydim_img_number = xdim_img_number
-    else:
-        if tmp_dim > 0:
-            ydim_img_number = xdim_img_number
-            xdim_img_number += 1
-        else:
-            xdim_img_number = xdim_img_number
-            ydim_img_number = xdim_img_number
+    xdim_img_number, ydim_img_number = mosaic_tiles(dim3d[2])
 
     img2d_dimx = xdim_img_number * dim3d[0]
-    img2d_dimy = ydim_img_number * dim3d[0]
+    img2d_dimy = ydim_img_number * dim3d[1]
 
     return xdim_img_number, ydim_img_number, img2d_dimx, img2d_dimy
+
+
+class MosaicLayout:
+    """Layout of volume slices in a mosaic image, it is computed once per volume geometry
+
+    Slices are rotated as in `vol3d_img2d` and tiled row by row, a tile has dim3d[1] rows
+    and dim3d[0] columns. Conversions copy slices to the tiles of a preallocated image.
+
+    :param dim3d: volume dimensions
+    :param slice_stride: every n-th slice is shown, for large multiband slice counts
+    :param downsample: every n-th voxel of a slice is shown, preview of large matrices
+    """
+
+    def __init__(self, dim3d, slice_stride=1, downsample=1):
+        self.dim = tuple(int(d) for d in dim3d[0:3])
+        self.slices = range(0, self.dim[2], max(int(slice_stride), 1))
+        self.step = max(int(downsample), 1)
+
+        self.xdim_img_number, self.ydim_img_number = mosaic_tiles(len(self.slices))
+
+        tile_rows = len(range(0, self.dim[1], self.step))
+        tile_cols = len(range(0, self.dim[0], self.step))
+        self.tile_shape = (tile_rows, tile_cols)
+        self.shape = (self.ydim_img_number * tile_rows, self.xdim_img_number * tile_cols)
+
+        # (rows, columns) of all tiles in the mosaic
+        tiles = []
+        for sy in range(self.ydim_img_number):
+            for sx in range(self.xdim_img_number):
+                tiles.append((slice(sy * tile_rows, (sy + 1) * tile_rows),
+                              slice(sx * tile_cols, (sx + 1) * tile_cols)))
+
+        self.tiles = tiles[:len(self.slices)]
+        self.empty_tiles = tiles[len(self.slices):]
+
+    def to_mosaic(self, vol3d, out=None):
+        """Converts the volume to the mosaic image
+
+        :param vol3d: volume of the layout dimensions
+        :param out: image of the layout shape, empty tiles are not written
+        :return: out or a new image with zero empty tiles
+        """
+        if out is None:
+            out = np.zeros(self.shape, dtype=vol3d.dtype)
+
+        step = self.step
+        for (rows, cols), sl in zip(self.tiles, self.slices):
+            out[rows, cols] = np.rot90(vol3d[::step, ::step, sl])
+
+        return out
+
+    def clear_empty_tiles(self, img, value=0):
+        """Fills the tiles without slices of the mosaic image
+        """
+        for rows, cols in self.empty_tiles:
+            img[rows, cols] = value
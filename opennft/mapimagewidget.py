@@ -16,7 +16,6 @@ from PyQt5 import QtCore
 
 from opennft import pgext
 
-from copy import copy
 
 ColormapType = t.Union[str, colors.Colormap]
 Thresholds = collections.namedtuple('Thresholds', ('lower', 'upper'))
@@ -30,31 +29,52 @@ class MapImageThresholdsCalculator:
     """Statistics/CNR map thresholds calculator class
 
     The class computes the optimal thresholds for display a map.
+    The thresholds are medians of the lowest and the highest values of the map,
+    the order statistics are found by partial sorting in linear time.
     """
 
     def __init__(self, thr_coeff: float = 0.0005, no_value: float = 0.0):
         self._thr_coeff = thr_coeff
         self._no_value = no_value
 
-    def __call__(self, map_image: np.ndarray) -> t.Optional[Thresholds]:
-        map_image_ma = np.ma.masked_equal(map_image, self._no_value)
+    def __call__(self, map_image: t.Union[np.ndarray, t.Sequence[np.ndarray]]) -> t.Optional[Thresholds]:
+        """Computes thresholds of the map
 
-        if map_image_ma.mask.all():
+        :param map_image: map image or a sequence of images whose values are used together
+        :return: thresholds, None if there are no values on the map
+        """
+        if isinstance(map_image, np.ndarray):
+            map_image = (map_image,)
+
+        values = [np.ravel(image) for image in map_image]
+        values = [v[v != self._no_value] for v in values]
+        data = values[0] if len(values) == 1 else np.concatenate(values)
+
+        if data.size == 0:
             logger.warning('There are no any values on the map')
             return None
 
-        data = np.sort(map_image_ma.compressed().ravel())
+        size = data.size
+        lower_size = int(self._thr_coeff * size)
+        upper_start = int(size - self._thr_coeff * size)
 
-        lower_data = data[:int(self._thr_coeff * data.size)]
-        upper_data = data[int(data.size - self._thr_coeff * data.size):]
+        # the tails are moved to the ends of the data by partial sorting,
+        # then medians are taken over the tails only
+        if lower_size > upper_start:
+            data.sort()
+        else:
+            if 0 < upper_start < size:
+                data.partition(upper_start)
+            if lower_size > 0:
+                data[:upper_start].partition(lower_size - 1)
 
-        if lower_data.size > 0:
-            lower_thr = np.median(lower_data)
+        if lower_size > 0:
+            lower_thr = np.median(data[:lower_size])
         else:
             lower_thr = data.min()
 
-        if upper_data.size > 0:
-            upper_thr = np.median(upper_data)
+        if upper_start < size:
+            upper_thr = np.median(data[upper_start:])
         else:
             upper_thr = data.min()
 
@@ -63,39 +83,92 @@ class MapImageThresholdsCalculator:
 
 class RgbaMapImage:
     """Represents the mapper map image to RGBA
+
+    The colormap is precomputed as a uint8 RGBA lookup table. Map values are
+    normalized to the range of the displayed values and quantized to the table
+    entries like matplotlib does, values which are not displayed get
+    a transparent entry. The result is a uint8 RGBA image.
     """
 
     def __init__(self, colormap: ColormapType = HOT_COLORMAP, no_value: float = 0.0):
         self._no_value = no_value
 
         if isinstance(colormap, str):
-            colormap = copy(cm.get_cmap(colormap))
+            colormap = cm.get_cmap(colormap)
 
         self._colormap = colormap
-        self._colormap.set_bad(alpha=0.0)
+        self._size = colormap.N
+        self._luts = {}
+        self._buffers = {}
+
+    def _lut(self, alpha: float) -> np.ndarray:
+        """Returns the lookup table for the alpha, the last entry is transparent
+        """
+        lut = self._luts.get(alpha)
+
+        if lut is None:
+            lut = np.zeros((self._size + 1, 4), dtype=np.uint8)
+            lut[:-1] = self._colormap(np.arange(self._size), alpha=alpha, bytes=True)
+            self._luts[alpha] = lut
+
+        return lut
+
+    def _buffer(self, shape) -> t.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns reusable value, index and mask buffers for the image shape
+        """
+        buffers = self._buffers.get(shape)
+
+        if buffers is None:
+            buffers = (np.empty(shape, dtype=np.float64),
+                       np.empty(shape, dtype=np.intp),
+                       np.empty(shape, dtype=bool))
+            self._buffers[shape] = buffers
+
+        return buffers
 
     def __call__(self, map_image: np.ndarray, thresholds: t.Optional[Thresholds] = None,
-                 alpha: float = 1.0) -> t.Optional[np.ndarray]:
+                 alpha: float = 1.0, out: t.Optional[np.ndarray] = None) -> t.Optional[np.ndarray]:
+        """Maps the image to RGBA
 
-        map_image_ma = np.ma.masked_equal(map_image, self._no_value)
+        :param map_image: map values
+        :param thresholds: range of displayed values, bounds are included
+        :param alpha: opacity of displayed values
+        :param out: uint8 array of the image shape with the last axis of size 4 for the result
+        :return: uint8 RGBA image, None if there are no values to display
+        """
+        values, index, mask = self._buffer(map_image.shape)
 
-        if map_image_ma.mask.all():
-            return
+        np.not_equal(map_image, self._no_value, out=mask)
 
         if thresholds is not None:
-            map_image_ma = np.ma.masked_outside(
-                map_image_ma, thresholds.lower, thresholds.upper)
+            lower, upper = sorted((thresholds.lower, thresholds.upper))
+            mask &= map_image >= lower
+            mask &= map_image <= upper
 
-        return self._map_to_rgba(map_image_ma, alpha)
+        if not mask.any():
+            return
+
+        displayed = map_image[mask]
+        vmin = displayed.min()
+        vmax = displayed.max()
+
+        # the same arithmetic as colors.Normalize followed by the colormap
+        np.subtract(map_image, vmin, out=values)
+        if vmax > vmin:
+            np.divide(values, vmax - vmin, out=values)
+        else:
+            values.fill(0)
+        np.multiply(values, self._size, out=values)
+        np.clip(values, 0, self._size - 1, out=values)
 
-    def _map_to_rgba(self, stats_map_ma, alpha) -> np.ndarray:
-        vmin = stats_map_ma.min()
-        vmax = stats_map_ma.max()
+        index[...] = values
+        np.logical_not(mask, out=mask)
+        np.copyto(index, self._size, where=mask)
 
-        normalizer = colors.Normalize(vmin=vmin, vmax=vmax)
-        mapper = cm.ScalarMappable(norm=normalizer, cmap=self._colormap)
+        if out is None:
+            out = np.empty(map_image.shape + (4,), dtype=np.uint8)
 
-        return mapper.to_rgba(stats_map_ma, alpha=alpha)
+        return np.take(self._lut(alpha), index, axis=0, out=out)
 
 
 class MapImageThresholdsWidget(QtWidgets.QWidget):
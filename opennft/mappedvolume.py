@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""
+Read-only access to volumes which Matlab shares via memory mapped files
+
+The files are created by `initMemmap.m` with a sequence counter before
+the payload. A writer (`writeMemmap.m`) increments the counter before and
+after writing, so the counter is odd while a volume is being written.
+A reader copies the volume and retries until the counter is even and has
+not changed during the copy, i.e. it never returns a half-written volume.
+
+__________________________________________________________________________
+Copyright (C) 2016-2021 OpenNFT.org
+
+"""
+
+import time
+import typing as t
+
+import numpy as np
+
+__all__ = ['MappedVolume']
+
+# size of the sequence counter header (one double) in bytes
+HEADER_SIZE = 8
+
+
+class MappedVolume:
+    """Persistent read-only mapping of a sequence-counted volume file
+
+    :param filename: memory mapped file name
+    :param shape: shape of one volume
+    :param count: number of volumes stored one after another in the file
+    :param dtype: volume data type
+    """
+
+    def __init__(self, filename: str, shape: t.Sequence[int], count: int = 1, dtype=np.float64):
+        self._filename = filename
+        self._shape = tuple(int(s) for s in shape)
+
+        self._file = np.memmap(filename, dtype=np.uint8, mode='r')
+        self._seq = self._file[:HEADER_SIZE].view(np.float64)
+
+        payload = self._file[HEADER_SIZE:HEADER_SIZE + count * int(np.prod(self._shape)) * np.dtype(dtype).itemsize]
+        self._volumes = [v.reshape(self._shape, order='F')
+                         for v in np.split(payload.view(dtype), count)]
+
+    @property
+    def filename(self) -> str:
+        return self._filename
+
+    @property
+    def shape(self) -> t.Tuple[int, ...]:
+        return self._shape
+
+    @property
+    def sequence(self) -> int:
+        """Current value of the sequence counter, it grows by 2 with every complete write
+        """
+        return int(self._seq[0])
+
+    def read(self, index: int = 0, out: t.Optional[np.ndarray] = None,
+             timeout: float = 1.0) -> t.Tuple[np.ndarray, int]:
+        """Returns a consistent copy of the volume and its sequence number
+
+        :param index: volume index in the file
+        :param out: array for the copy, a new array is allocated if it is not given
+        :param timeout: time in seconds to wait for a writer, an unchecked copy is returned after that
+        :return: volume copy and the sequence number it corresponds to
+        """
+        if out is None:
+            out = np.empty(self._shape, order='F')
+
+        volume = self._volumes[index]
+        deadline = time.monotonic() + timeout
+
+        while True:
+            seq = self._seq[0]
+            if seq % 2 == 0:
+                np.copyto(out, volume)
+                if self._seq[0] == seq:
+                    return out, int(seq)
+            if time.monotonic() > deadline:
+                np.copyto(out, volume)
+                return out, int(self._seq[0])
+            time.sleep(0)
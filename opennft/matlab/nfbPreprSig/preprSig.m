@@ -6,6 +6,8 @@ function output = preprSig(indVol)
 %
 % output:
 % Output is assigned to workspace variables.
+% output - per-iteration results needed by the Python side: time-series
+%          for display and, if rtQA is enabled, the current rtQA samples
 %__________________________________________________________________________
 % Copyright (C) 2016-2021 OpenNFT.org
 %
@@ -94,14 +96,14 @@ for indRoi = 1:P.NrROIs
                     ROIoptimGlmAnat = evalin('base', 'ROIoptimGlmAnat');
                     procVol = mainLoopData.procVol;
                     tmpVect = procVol(...
-                        cell2mat(ROIsGlmAnat(indRoi).vol(indNFTrial))>0);
+                        ROIsGlmAnat(indRoi).voxelIndex{indNFTrial});
 
                     if ~isempty(tmpVect) && length(tmpVect)>10
                         rawTimeSeries(indRoi, indVolNorm) = mean(tmpVect);
                         mainLoopData.adaptROIs(indRoi, indNFTrial+1) = 2;
                     else
-                        tmpOptRoiVect = procVol(cell2mat(...
-                            ROIoptimGlmAnat(indRoi).vol(indNFTrial))>0);
+                        tmpOptRoiVect = procVol(...
+                            ROIoptimGlmAnat(indRoi).voxelIndex{indNFTrial});
                         if ~isempty(tmpOptRoiVect) && length(tmpOptRoiVect)>10
                             rawTimeSeries(indRoi, indVolNorm) = mean(tmpOptRoiVect);
                             mainLoopData.adaptROIs(indRoi, indNFTrial+1) = 3;
@@ -374,7 +376,21 @@ output.kalmanProcTimeSeries = mainLoopData.kalmanProcTimeSeries;
 output.displRawTimeSeries = mainLoopData.displRawTimeSeries;
 output.rawTimeSeries = mainLoopData.rawTimeSeries;
 output.motCorrParam = P.motCorrParam;
-    
+
+% current rtQA samples, returned together to avoid separate engine calls
+if P.isRTQA
+    output.glmProcSample = mainLoopData.glmProcTimeSeries(:,end);
+    if ~flags.isDCM
+        output.linRegrSample = rtQA_matlab.linRegr(:,indVolNorm);
+        if ~P.isAutoRTQA
+            output.noRegGlmProcSample = mainLoopData.noRegGlmProcTimeSeries(:,end);
+        end
+    end
+    output.kalmanSpikesPos = rtQA_matlab.kalmanSpikesPos(:,indVolNorm);
+    output.kalmanSpikesNeg = rtQA_matlab.kalmanSpikesNeg(:,indVolNorm);
+    output.offsetMCParam = P.offsetMCParam;
+end
+
 if P.isRTQA
     assignin('base', 'rtQA_matlab', rtQA_matlab);
 end
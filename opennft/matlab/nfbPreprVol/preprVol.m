@@ -1,4 +1,4 @@
-function preprVol(inpFileName, indVol)
+function output = preprVol(inpFileName, indVol)
 % Function to call real-time data preprocessing analyses.
 %
 % input:
@@ -7,6 +7,8 @@ function preprVol(inpFileName, indVol)
 %
 % output:
 % Output is assigned to workspace variables.
+% output - per-iteration results needed by the Python side
+%          (statMapCreated flag)
 %__________________________________________________________________________
 % Copyright (C) 2016-2021 OpenNFT.org
 %
@@ -15,6 +17,9 @@ function preprVol(inpFileName, indVol)
 P = evalin('base', 'P');
 mainLoopData = evalin('base', 'mainLoopData');
 
+output = struct;
+output.statMapCreated = mainLoopData.statMapCreated;
+
 if P.UseTCPData, tcp = evalin('base', 'tcp'); end
 
 if indVol <= P.nrSkipVol
@@ -132,8 +137,7 @@ end
 
 % transfer preprocessed volume to Python
 assignin('base', 'preprVol', smReslVol)
-m = evalin('base', 'mmTransferVol');
-m.Data.transferVol = smReslVol;
+writeMemmap('mmTransferVol', 'transferVol', smReslVol);
 
 % iGLM init
 nrVoxInVol = mainLoopData.nrVoxInVol;
@@ -318,10 +322,10 @@ if ~isempty(idxActVoxIGLM.pos) && max(tn.pos) > 0 % handle empty activation map
     statMap3D_pos(idxActVoxIGLM.pos) = statMapVect;
 
     % shared for SPM matlab helper
-    m = evalin('base', 'mmStatVol');
-    m.Data.posStatVol = statMap3D_pos;
+    writeMemmap('mmStatVol', 'posStatVol', statMap3D_pos);
     mainLoopData.statMapCreated = 1;
 end
+output.statMapCreated = mainLoopData.statMapCreated;
 if ~isempty(idxActVoxIGLM.neg) && max(tn.neg) > 0
         
     maskedStatMapVect_neg = tn.neg(idxActVoxIGLM.neg);
@@ -332,8 +336,7 @@ if ~isempty(idxActVoxIGLM.neg) && max(tn.neg) > 0
     clear idxActVoxIGLM
 
     % shared for SPM matlab helper
-    m = evalin('base', 'mmStatVol');
-    m.Data.negStatVol = statMap3D_neg;
+    writeMemmap('mmStatVol', 'negStatVol', statMap3D_neg);
 
 end
 
@@ -373,11 +376,12 @@ if flags.isDCM
             
             ROIsAnat(iROI).vol(isnan(ROIsAnat(iROI).vol))=0;
 
-            ROIsGlmAnat(iROI).vol(indNFTrial+1) = ...
-                {statMap3D_pos & ROIsAnat(iROI).vol};
-
+            % adapted ROI is stored as compact voxel index computed once
+            % per trial, the next trial gathers the signal through it
             clear tmpVect
-            tmpVect = find(cell2mat(ROIsGlmAnat(iROI).vol(indNFTrial+1))>0);
+            tmpVect = uint32(find(statMap3D_pos & ROIsAnat(iROI).vol));
+            ROIsGlmAnat(iROI).voxelIndex(indNFTrial+1) = {tmpVect};
+
             if ~isempty(tmpVect) && length(tmpVect)>10
                 ROIsGlmAnat(iROI).meanGlmAnatROI(indNFTrial+1) = ...
                     mean(statMap3D_pos(tmpVect));
@@ -388,8 +392,8 @@ if flags.isDCM
                 % for at least 2 ROIsGlmAnat, there is always one ROIoptimGlmAnat
                 [val, nrROIoptimGlmAnat] = ...
                     max(ROIsGlmAnat(iROI).meanGlmAnatROI);
-                ROIoptimGlmAnat(iROI).vol(indNFTrial+1) = ...
-                    ROIsGlmAnat(iROI).vol(nrROIoptimGlmAnat);
+                ROIoptimGlmAnat(iROI).voxelIndex(indNFTrial+1) = ...
+                    ROIsGlmAnat(iROI).voxelIndex(nrROIoptimGlmAnat);
                 mainLoopData.nrROIoptimGlmAnat(iROI,indNFTrial) = ...
                     nrROIoptimGlmAnat;
                 clear nrROIoptimGlmAnat val
@@ -34,7 +34,13 @@ end
 % save rtqa data
 if P.isRTQA
     rtQA_matlab = evalin('base', 'rtQA_matlab');
-    rtQA_python = evalin('base', 'rtQA_python');
+    % rtQA data calculated in Python are saved by the GUI to a MAT-file
+    rtQAPythonFile = strrep(strrep(P.memMapFile, 'shared', 'rtQA_python'), '.dat', '.mat');
+    if exist(rtQAPythonFile, 'file')
+        rtQA_python = load(rtQAPythonFile);
+    else
+        rtQA_python = evalin('base', 'rtQA_python');
+    end
     save([folder '\rtQA_matlab.mat'], '-struct', 'rtQA_matlab');
     save([folder '\rtQA_python.mat'], '-struct', 'rtQA_python');
 end
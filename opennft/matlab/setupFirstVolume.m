@@ -34,11 +34,10 @@ nrVoxInVol = prod(dimVol);
 imgVolTempl = mainLoopData.imgVolTempl;
 assignin('base', 'imgVolTempl', imgVolTempl);
 
-m = evalin('base', 'mmTransferVol');
 if P.isZeroPadding
-    m.Data.transferVol = imgVolTempl(:,:,P.nrZeroPadVol+1:end-P.nrZeroPadVol);
+    writeMemmap('mmTransferVol', 'transferVol', imgVolTempl(:,:,P.nrZeroPadVol+1:end-P.nrZeroPadVol));
 else
-    m.Data.transferVol = imgVolTempl;
+    writeMemmap('mmTransferVol', 'transferVol', imgVolTempl);
 end
 
 if P.isRTQA
@@ -0,0 +1,48 @@
+function exportROIs(fileName)
+% Function to export geometry of all ROIs for Python in one file.
+% For DCM, anatomical ROIs are exported and, if rtQA is enabled, the
+% whole-brain EPI ROI is exported as the last one.
+%
+% input:
+% fileName - MAT-file name for the export
+%
+% output:
+% The file contains variables:
+% roiVoxelIndex - cell array of uint32 voxel indexes of ROI masks, the
+%                 indexes are 1-based linear indexes of find(), they are
+%                 converted to 0-based indexes once on import in Python
+% roiMat        - 4x4xNrROIs array of ROI affine matrices
+% roiDim        - NrROIs x 3 array of ROI volume dimensions, the indexes
+%                 are only valid for volumes of the EPI matrix size
+%__________________________________________________________________________
+% Copyright (C) 2016-2021 OpenNFT.org
+
+P = evalin('base', 'P');
+flags = getFlagsType(P);
+nrROIs = double(P.NrROIs);
+
+if flags.isDCM
+    ROIsAnat = evalin('base', 'ROIsAnat');
+end
+if ~flags.isDCM || P.isRTQA
+    ROIs = evalin('base', 'ROIs');
+end
+
+roiVoxelIndex = cell(1, nrROIs);
+roiMat = zeros(4, 4, nrROIs);
+roiDim = zeros(nrROIs, 3);
+
+for iROI = 1:nrROIs
+    if ~flags.isDCM
+        roi = ROIs(iROI);
+    elseif P.isRTQA && iROI == nrROIs
+        roi = ROIs(end);
+    else
+        roi = ROIsAnat(iROI);
+    end
+    roiVoxelIndex{iROI} = uint32(find(roi.vol > 0 & ~isnan(roi.vol)));
+    roiMat(:,:,iROI) = roi.mat;
+    [roiDim(iROI,1), roiDim(iROI,2), roiDim(iROI,3)] = size(roi.vol);
+end
+
+save(fileName, 'roiVoxelIndex', 'roiMat', 'roiDim', '-v7');
@@ -1,6 +1,9 @@
 function fileName = initMemmap(fileName, newName, initData, ...
     dataType, refName, mmFormat)
 % Function to initialize memory mapped files for data exchange with Python.
+% If the format is given, the data are preceded by a 'seqNum' sequence
+% counter, which is updated by writeMemmap() to let Python readers detect
+% partially written data.
 %
 % input:
 % newName  - new file name for the memory mapped file
@@ -18,9 +21,13 @@ function fileName = initMemmap(fileName, newName, initData, ...
 
 fileName = strrep(fileName, 'shared', newName);
 fileID = fopen(fileName, 'w');
+if nargin == 6
+    fwrite(fileID, 0, 'double');
+end
 fwrite(fileID, initData, dataType);
 fclose(fileID);
 if nargin == 6
+    mmFormat = [{'double', [1 1], 'seqNum'}; mmFormat];
     m = memmapfile(fileName, 'Writable', true, 'Format', mmFormat);
 else
     m = memmapfile(fileName, 'Writable', true);
@@ -0,0 +1,16 @@
+function writeMemmap(refName, fieldName, data)
+% Function to write data to a memory mapped file shared with Python.
+% The sequence counter is odd while the data are being written, so that
+% readers can retry instead of using partially written data.
+%
+% input:
+% refName   - reference variable for memory mapped file
+% fieldName - name of the data field in the memory map file format
+% data      - data to write
+%__________________________________________________________________________
+% Copyright (C) 2016-2021 OpenNFT.org
+
+m = evalin('base', refName);
+m.Data.seqNum = m.Data.seqNum + 1;
+m.Data.(fieldName) = data;
+m.Data.seqNum = m.Data.seqNum + 1;
@@ -190,3 +190,55 @@ class MatlabSharedEngineHelper:
             logger.exception('Cannot terminate Matlab process correctly')
         else:
             logger.info('Terminate Matlab engine "{}" helper process {}', shared_name, pid)
+
+
+class CountingEngine:
+    """Matlab engine proxy which counts calls to the engine
+
+    Every Matlab function call and every workspace read or write is
+    a synchronous round trip with data conversion, so the number of
+    calls per iteration is tracked to keep the main loop cheap.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._calls = 0
+
+    @property
+    def calls(self) -> int:
+        return self._calls
+
+    def reset_calls(self) -> int:
+        """Resets the counter and returns the number of calls since the previous reset
+        """
+        calls, self._calls = self._calls, 0
+        return calls
+
+    @property
+    def workspace(self):
+        return _CountingWorkspace(self)
+
+    def __getattr__(self, name):
+        attr = getattr(self._engine, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self._calls += 1
+            return attr(*args, **kwargs)
+
+        return call
+
+
+class _CountingWorkspace:
+    def __init__(self, counter: CountingEngine):
+        self._counter = counter
+        self._workspace = counter._engine.workspace
+
+    def __getitem__(self, name):
+        self._counter._calls += 1
+        return self._workspace[name]
+
+    def __setitem__(self, name, value):
+        self._counter._calls += 1
+        self._workspace[name] = value
@@ -1,6 +1,22 @@
 # -*- coding: utf-8 -*-
 
+"""
+Readers of 2D images shared via memory mapped files
+
+The uint8 images are stored one after another in Fortran order from the start
+of the file, their shapes are queried from Matlab. The readers query the shapes
+and map the file once, subsequent reads of the same file return read-only views
+of the same mapping without engine calls. The file is identified by its name,
+size and inode, so a file which Matlab recreates or truncates for a new session
+is queried and mapped again instead of reading a stale mapping.
+
+__________________________________________________________________________
+Copyright (C) 2016-2021 OpenNFT.org
+
+"""
+
 import collections
+import os
 import typing as t
 
 import numpy as np
@@ -35,6 +51,60 @@ def read_mosaic_image(memmap_filename: str, image_name, eng) -> np.ndarray:
     return read_memmap_image(memmap_filename, shape=shape, offset=0)
 
 
+def file_identity(memmap_filename: str) -> t.Tuple[str, int, int]:
+    """Returns name, size and inode of the file
+    """
+    stat = os.stat(memmap_filename)
+    return memmap_filename, stat.st_size, stat.st_ino
+
+
+class MemmapImages:
+    """Persistent read-only mapping of uint8 images stored one after another in a memmap file
+
+    :param memmap_filename: memmap file name
+    :param shapes: (rows, columns) of every image
+    :raises ValueError: the images do not fit into the file
+    """
+
+    def __init__(self, memmap_filename: str, shapes: t.Sequence[t.Sequence[int]]):
+        self._identity = file_identity(memmap_filename)
+        self._images = []
+
+        shapes = [(int(rows), int(cols)) for rows, cols in shapes]
+        size = sum(rows * cols for rows, cols in shapes)
+        file_size = self._identity[1]
+
+        if size > file_size:
+            raise ValueError('Memmap image file "{}" has {} bytes, {} bytes are expected for images of shapes {}'
+                             .format(memmap_filename, file_size, size, shapes))
+
+        if size:
+            mapping = np.memmap(memmap_filename, dtype=np.uint8, mode='r', shape=(size,))
+            offset = 0
+            for shape in shapes:
+                end = offset + shape[0] * shape[1]
+                self._images.append(mapping[offset:end].reshape(shape, order='F'))
+                offset = end
+
+    @property
+    def identity(self) -> t.Tuple[str, int, int]:
+        return self._identity
+
+    def is_current(self, memmap_filename: str) -> bool:
+        """Returns True if the mapping is of the current file with the name
+        """
+        try:
+            return file_identity(memmap_filename) == self._identity
+        except OSError:
+            return False
+
+    def __len__(self):
+        return len(self._images)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self._images[index]
+
+
 class MosaicImageReader:
     """The class for reading mosaic images from memmap file
     """
@@ -42,6 +112,7 @@ class MosaicImageReader:
     def __init__(self, image_name: str):
         self._image = None  # type: t.Optional[np.ndarray]
         self._image_name = image_name
+        self._images = None  # type: t.Optional[MemmapImages]
         self.clear()
 
     @property
@@ -49,10 +120,16 @@ class MosaicImageReader:
         return self._image
 
     def read(self, memmap_filename: str, matlab_engine):
-        self._image = read_mosaic_image(memmap_filename, self._image_name, matlab_engine)
+        """Reads mosaic image from memmap file, the shape is queried only when the file is mapped
+        """
+        if self._images is None or not self._images.is_current(memmap_filename):
+            shape = get_image_shape(self._image_name, matlab_engine, nargout=2)
+            self._images = MemmapImages(memmap_filename, [shape])
+            self._image = self._images[0]
 
     def clear(self):
         self._image = None
+        self._images = None
 
 
 class ProjectionImagesReader:
@@ -67,6 +144,7 @@ class ProjectionImagesReader:
 
     def __init__(self):
         self._projection_images = {}
+        self._images = None  # type: t.Optional[MemmapImages]
         self.clear()
 
     @property
@@ -93,17 +171,20 @@ class ProjectionImagesReader:
         return self._projection_images[proj]
 
     def read(self, memmap_filename: str, matlab_engine):
-        """Reads projection images from memmap file
+        """Reads projection images from memmap file, the shapes are queried only when the file is mapped
         """
-        with open(memmap_filename, 'r') as fp:
-            offset = 0
+        if self._images is not None and self._images.is_current(memmap_filename):
+            return
+
+        shapes = [get_image_shape(image_name, matlab_engine, nargout=2)
+                  for image_name in self._projection_images_mapping.values()]
+        self._images = MemmapImages(memmap_filename, shapes)
 
-            for proj_type, image_name in self._projection_images_mapping.items():
-                shape = get_image_shape(image_name, matlab_engine, nargout=2)
-                self._projection_images[proj_type] = read_memmap_image(fp, shape, offset)
-                offset += shape.prod()
+        for index, proj_type in enumerate(self._projection_images_mapping):
+            self._projection_images[proj_type] = self._images[index]
 
     def clear(self):
         """Clean up all data
         """
         self._projection_images = {proj: None for proj in self._projection_images_mapping}
+        self._images = None
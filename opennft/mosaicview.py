@@ -15,9 +15,9 @@ class MosaicImageViewWidget(QtWidgets.QWidget):
     def __init__(self, parent=None):
         super().__init__(parent=parent)
 
-        self._background_imitem = pg.ImageItem(autoDownsample=True)
-        self._pos_map_imitem = pg.ImageItem(autoDownsample=True)
-        self._neg_map_imitem = pg.ImageItem(autoDownsample=True)
+        self._background_imitem = pg.ImageItem(autoDownsample=True, axisOrder='row-major')
+        self._pos_map_imitem = pg.ImageItem(autoDownsample=True, axisOrder='row-major')
+        self._neg_map_imitem = pg.ImageItem(autoDownsample=True, axisOrder='row-major')
 
         self._viewbox = pgext.ViewBoxWithoutPadding(
             lockAspect=True,
@@ -44,13 +44,19 @@ class MosaicImageViewWidget(QtWidgets.QWidget):
         self._viewbox.autoRange()
 
     def set_background_image(self, image: np.ndarray):
-        self._background_imitem.setImage(image.T)
+        """Sets uint8 (rows, columns) background image, it is shown with levels (0, 255)
+        """
+        self._background_imitem.setImage(image, autoLevels=False, levels=(0, 255))
 
     def set_pos_map_image(self, image: np.ndarray):
-        self._pos_map_imitem.setImage(image.transpose((1, 0, 2)))
+        """Sets uint8 (rows, columns, 4) RGBA map image
+        """
+        self._pos_map_imitem.setImage(image, autoLevels=False, levels=(0, 255))
 
     def set_neg_map_image(self, image: np.ndarray):
-        self._neg_map_imitem.setImage(image.transpose((1, 0, 2)))
+        """Sets uint8 (rows, columns, 4) RGBA map image
+        """
+        self._neg_map_imitem.setImage(image, autoLevels=False, levels=(0, 255))
 
     def clear(self):
         self._background_imitem.clear()
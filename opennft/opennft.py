@@ -64,6 +64,7 @@ from opennft import (
     config,
     conversions,
     runmatlab,
+    mlproc,
     ptbscreen,
     mosaicview,
     projview,
@@ -73,6 +74,8 @@ from opennft import (
     rtqa_gui,
     rtqa_calc,
     volviewformation,
+    sharedstate,
+    renderscheduler,
     eventrecorder as erd,
 )
 
@@ -212,6 +215,8 @@ class OpenNFT(QWidget):
         self.orth_view = None
         self.view_form_input = None
         self.view_form_output = None
+        self.viewFrameIds = {}
+        self.viewScheduler = None
         self.rtqa_input = None
         self.rtqa_output = None
 
@@ -220,7 +225,10 @@ class OpenNFT(QWidget):
         self.fFinNFB = False
         self.orthViewUpdateInProgress = False
         self.outputSamples = {}
+        self.isStatMapCreated = False
         self.musterInfo = {}
+        self.roiVoxelIndexes = []
+        self.roiMats = None
 
         # Core Matlab helper process
         matlab_helpers = runmatlab.get_matlab_helpers()
@@ -267,11 +275,14 @@ class OpenNFT(QWidget):
 
         self.eng = None
         if self.orth_view:
-            self.view_form_input["is_stopped"] = True
+            self.orth_view.stop()
+            self.orth_view.join(timeout=1.0)
             self.orth_view.terminate()
         self.orth_view = None
 
         if self.calc_rtqa:
+            self.calc_rtqa.stop()
+            self.calc_rtqa.join(timeout=1.0)
             self.calc_rtqa.terminate()
         self.calc_rtqa = None
 
@@ -692,6 +703,7 @@ class OpenNFT(QWidget):
 
         if self.preiteration < self.iteration:
             # this code is executed before file is acquired
+            self.eng.reset_calls()
 
             self.eng.mainLoopEntry(self.iteration, nargout=0)
 
@@ -708,7 +720,7 @@ class OpenNFT(QWidget):
 
                 if self.iteration > self.P['nrSkipVol'] and config.UDP_SEND_CONDITION:
                     self.udpSender.send_data(
-                        self.udpCondForContrast[int(self.eng.evalin('base', 'mainLoopData.condition')) - 1])
+                        self.udpCondForContrast[int(self.displayData['condition']) - 1])
 
             elif self.P['Type'] == 'DCM':
                 if not self.isCalculateDcm and config.USE_PTB:
@@ -845,11 +857,12 @@ class OpenNFT(QWidget):
         # data preprocessing
         if config.USE_YIELD:
             self.call_timer.setInterval(np.int32(config.MAIN_LOOP_CALL_PERIOD / 3))
-            prepr_vol_state = self.eng.preprVol(fname, self.iteration, background=True, nargout=0)
+            prepr_vol_state = self.eng.preprVol(fname, self.iteration, background=True, nargout=1)
             while not prepr_vol_state.done():
                 yield
+            preprVolOutput = prepr_vol_state.result()
         else:
-            self.eng.preprVol(fname, self.iteration, background=False, nargout=0)
+            preprVolOutput = self.eng.preprVol(fname, self.iteration, background=False, nargout=1)
 
         # t3
         self.recorder.recordEvent(erd.Times.t3, self.iteration, time.time())
@@ -860,14 +873,15 @@ class OpenNFT(QWidget):
         else:
             is_rtqa_volume = False
 
-        is_stat_map_created = bool(self.eng.evalin('base', 'mainLoopData.statMapCreated'))
+        self.isStatMapCreated = bool(preprVolOutput['statMapCreated'])
+        is_stat_map_created = self.isStatMapCreated
 
         if self.imageViewMode == ImageViewMode.mosaic:
-            self.updateMosaicViewAsync()
+            self.updateMosaicViewAsync(is_new_volume=True)
 
         if (is_rtqa_volume and config.FIRST_SNR_VOLUME < self.iteration) or \
                 (is_stat_map_created and not is_rtqa_volume):
-            self.updateOrthViewAsync()
+            self.updateOrthViewAsync(is_new_volume=True)
 
         # spatio-temporal data processing
         with utils.timeit('  preprocess signal:'):
@@ -992,26 +1006,23 @@ class OpenNFT(QWidget):
         if bool(self.outputSamples) and self.windowRTQA:
 
             dataRealRaw = np.array(self.outputSamples['rawTimeSeries'], ndmin=2)
-            dataGLM = np.array(self.eng.evalin('base', 'mainLoopData.glmProcTimeSeries(:,end)'), ndmin=2)
+            dataGLM = np.array(self.outputSamples['glmProcSample'], ndmin=2)
             dataProc = np.array(self.outputSamples['kalmanProcTimeSeries'], ndmin=2)
             dataMC = np.array(self.outputSamples['motCorrParam'], ndmin=2)
             n = len(dataRealRaw[0, :]) - 1
             dataRaw = dataRealRaw[:, n]
 
             if n == 0:
-                offsetMCParam = np.array(self.eng.evalin('base', 'P.offsetMCParam'), ndmin=1)
+                offsetMCParam = np.array(self.outputSamples['offsetMCParam'], ndmin=1)
                 self.rtqa_input["offset_mc"] = offsetMCParam
 
             if self.P['Type'] != 'DCM':
-                betaCoeff = np.array(
-                    self.eng.evalin('base', 'rtQA_matlab.linRegr(:,mainLoopData.indVolNorm)'), ndmin=2)
+                betaCoeff = np.array(self.outputSamples['linRegrSample'], ndmin=2)
             else:
                 betaCoeff = np.zeros((int(self.P['NrROIs']), 1))
 
-            posSpikes = np.array(self.eng.evalin('base', 'rtQA_matlab.kalmanSpikesPos(:,mainLoopData.indVolNorm)'),
-                                 ndmin=2)
-            negSpikes = np.array(self.eng.evalin('base', 'rtQA_matlab.kalmanSpikesNeg(:,mainLoopData.indVolNorm)'),
-                                 ndmin=2)
+            posSpikes = np.array(self.outputSamples['kalmanSpikesPos'], ndmin=2)
+            negSpikes = np.array(self.outputSamples['kalmanSpikesNeg'], ndmin=2)
 
             if self.P['Type'] == 'DCM' and (self.iteration - self.P['nrSkipVol']) in self.P['beginDCMblock'][0]:
                 isNewDCMBlock = True
@@ -1019,21 +1030,22 @@ class OpenNFT(QWidget):
                 isNewDCMBlock = False
 
             if self.P['Type'] != 'DCM' and not self.P['isAutoRTQA']:
-                dataNoRegGLM = np.squeeze(np.array(
-                    self.eng.evalin('base', 'mainLoopData.noRegGlmProcTimeSeries(:,end)'), ndmin=2), axis=1)
+                dataNoRegGLM = np.squeeze(np.array(self.outputSamples['noRegGlmProcSample'], ndmin=2), axis=1)
             else:
-                dataNoRegGLM = np.array([])
-
-            self.rtqa_input["raw_ts"] = dataRaw
-            self.rtqa_input["glm_ts"] = dataGLM
-            self.rtqa_input["no_reg_glm_ts"] = dataNoRegGLM
-            self.rtqa_input["proc_ts"] = dataProc[:, n]
-            self.rtqa_input["mc_ts"] = dataMC[n, :]
-            self.rtqa_input["beta_coeff"] = betaCoeff
-            self.rtqa_input["pos_spikes"] = posSpikes
-            self.rtqa_input["neg_spikes"] = negSpikes
-            self.rtqa_input["is_new_dcm_block"] = isNewDCMBlock
-            self.rtqa_input["iteration"] = n
+                dataNoRegGLM = None
+
+            # the worker copies the inputs of a volume under the same lock
+            with self.rtqa_input.lock:
+                self.rtqa_input["raw_ts"] = dataRaw
+                self.rtqa_input["glm_ts"] = dataGLM
+                self.rtqa_input["no_reg_glm_ts"] = dataNoRegGLM
+                self.rtqa_input["proc_ts"] = dataProc[:, n]
+                self.rtqa_input["mc_ts"] = dataMC[n, :]
+                self.rtqa_input["beta_coeff"] = betaCoeff
+                self.rtqa_input["pos_spikes"] = posSpikes
+                self.rtqa_input["neg_spikes"] = negSpikes
+                self.rtqa_input["is_new_dcm_block"] = isNewDCMBlock
+                self.rtqa_input["iteration"] = n
             self.rtqa_input["roi_checked"] = self.selectedRoi
             self.rtqa_input["data_ready"] = True
             if self.windowRTQA.isVisible():
@@ -1054,6 +1066,7 @@ class OpenNFT(QWidget):
 
         # logger.info('**********  {}', self.recorder.files[-1])
         logger.info('Elapsed time: {:.4f} s', elapsedTime)
+        logger.info('Matlab engine calls: {}', self.eng.reset_calls())
 
         QApplication.processEvents()
 
@@ -1246,7 +1259,7 @@ class OpenNFT(QWidget):
         if config.USE_MATLAB_MODEL_HELPER:
             self.mlModelHelper.prepare()
 
-        self.eng = self.mlMainHelper.engine
+        self.eng = mlproc.CountingEngine(self.mlMainHelper.engine)
 
         self.eng.workspace['P'] = self.P
         self.eng.workspace['mainLoopData'] = self.mainLoopData
@@ -1302,13 +1315,16 @@ class OpenNFT(QWidget):
         self.reachedFirstFile = False
         self.autoRTQASetup = False
         if self.orth_view:
-            self.view_form_input["is_stopped"] = True
+            self.orth_view.stop()
+            self.orth_view.join(timeout=1.0)
             self.view_form_input = None
             self.view_form_output = None
             self.orth_view.terminate()
         self.orth_view = None
 
         if self.calc_rtqa:
+            self.calc_rtqa.stop()
+            self.calc_rtqa.join(timeout=1.0)
             self.calc_rtqa.terminate()
             self.calc_rtqa = None
             self.rtqa_input = None
@@ -1320,6 +1336,7 @@ class OpenNFT(QWidget):
         self.eng.workspace['rtQA_matlab'] = self.rtQA_matlab
         self.fFinNFB = False
         self.outputSamples = {}
+        self.isStatMapCreated = False
         self.musterInfo = {}
         self.iteration = 1
         self.preiteration = 0
@@ -1512,11 +1529,13 @@ class OpenNFT(QWidget):
             if not self.resetDone:
                 self.reset()
 
-            self.view_form_input = multiprocessing.Manager().dict()
-            self.view_form_input["ready"] = False
-            self.view_form_input["done_mosaic_templ"] = False
-            self.view_form_input["done_mosaic_overlay"] = False
-            self.view_form_input["done_orth"] = False
+            # view state is allocated after the first volume defines the geometry
+            self.view_form_input = sharedstate.SharedState(controls={
+                "view_mode": int(self.imageViewMode),
+                "request_id": 0,
+            }, events={
+                "ready": False,
+            })
 
             self.actualizeAutoRTQA()
             self.isOffline = self.cbOfflineMode3.isChecked()
@@ -1612,156 +1631,148 @@ class OpenNFT(QWidget):
         x = self.P['MatrixSizeX']
         y = self.P['MatrixSizeY']
         z = self.P['NrOfSlices']
-        ROI_vols = np.zeros((nrROIs, x, y, z))
-        ROI_mats = np.zeros((nrROIs, 4, 4))
-        if self.P['Type'] == 'DCM':
-            if self.P['isRTQA']:
-                # For DCM+rtQA, ROIs are stored in ROIsAnat and whole-brain EPI ROI is in ROIs.
-                # ROIsAnat and whole-brain EPI ROI are transferred from Matlab.
-                # For definition of nrROIs, see selectROI.m
-                for i in range(nrROIs - 1):
-                    ROI_vols[i] = np.array(self.eng.evalin('base', 'ROIsAnat(' + str(i + 1) + ').vol'), ndmin=3)
-                    ROI_mats[i] = np.array(self.eng.evalin('base', 'ROIsAnat(' + str(i + 1) + ').mat'), ndmin=2)
-                ROI_vols[nrROIs - 1] = np.array(self.eng.evalin('base', 'ROIs(end).vol'), ndmin=3)
-                ROI_mats[nrROIs - 1] = np.array(self.eng.evalin('base', 'ROIs(end).mat'), ndmin=2)
-            else:
-                for i in range(nrROIs):
-                    ROI_vols[i] = np.array(self.eng.evalin('base', 'ROIsAnat(' + str(i + 1) + ').vol'), ndmin=3)
-                    ROI_mats[i] = np.array(self.eng.evalin('base', 'ROIsAnat(' + str(i + 1) + ').mat'), ndmin=2)
-        else:
-            for i in range(nrROIs):
-                ROI_vols[i] = np.array(self.eng.evalin('base', 'ROIs(' + str(i + 1) + ').vol'), ndmin=3)
-                ROI_mats[i] = np.array(self.eng.evalin('base', 'ROIs(' + str(i + 1) + ').mat'), ndmin=2)
 
-        # # shared variables for OrthView process
-        self.view_form_input = multiprocessing.Manager().dict()
-        self.view_form_input["nr_ROIs"] = nrROIs
-        self.view_form_input["ROI_vols"] = ROI_vols
-        self.view_form_input["ROI_mats"] = ROI_mats
-        self.view_form_input["cursor_pus"] = []
-        self.view_form_input["flags_planes"] = []
-        self.view_form_input["bg_type"] = "bgEPI"
-        self.view_form_input["is_rtqa"] = False
-        self.view_form_input["is_neg"] = self.negMapCheckBox.isChecked()
-        self.view_form_input["is_ROI"] = config.USE_ROI
+        # ROI masks are transferred as voxel indexes, see exportROIs.m
+        self.exportRoiGeometry()
+
         if config.AUTO_RTQA:
-            self.view_form_input["anat_volume"] = None
+            anat_volume = None
         else:
-            self.view_form_input["anat_volume"] = self.P['StructBgFile']
-        self.view_form_input["epi_volume"] = self.P['MCTempl']
+            anat_volume = self.P['StructBgFile']
         if config.AUTO_RTQA and not config.USE_EPI_TEMPLATE:
-            self.view_form_input["epi_volume_type"] = "dcm"
+            epi_volume_type = "dcm"
         else:
-            self.view_form_input["epi_volume_type"] = "nii"
-        self.view_form_input["rtQA_volume"] = []
-        self.view_form_input["stat_volume"] = str(self.eng.evalin('base', 'P.memMapFile')).replace('shared', 'statVol')
-        self.view_form_input["mat"] = np.array(self.eng.evalin('base', 'mainLoopData.matTemplMotCorr'))
-        self.view_form_input["dim"] = tuple([x, y, z])
-        self.view_form_input["memmap_volume"] = self.P['memMapFile']
-        self.view_form_input["view_mode"] = self.imageViewMode
-        self.view_form_input["is_stopped"] = False
-        self.view_form_input["auto_thr_pos"] = True
-        self.view_form_input["auto_thr_neg"] = True
-        self.view_form_input["ready"] = False
-        self.view_form_input["overlay_ready"] = False
-        self.view_form_input["done_mosaic_templ"] = False
-        self.view_form_input["done_mosaic_overlay"] = False
-        self.view_form_input["done_orth"] = False
-
-        self.view_form_output = multiprocessing.Manager().dict()
-        self.view_form_output["mosaic_templ"] = np.zeros((1, 1))
-        self.view_form_output["mosaic_pos_overlay"] = None
-        self.view_form_output["mosaic_neg_overlay"] = None
-        self.view_form_output["ROI_t"] = np.zeros((1, 1))
-        self.view_form_output["ROI_c"] = np.zeros((1, 1))
-        self.view_form_output["ROI_s"] = np.zeros((1, 1))
-        self.view_form_output["back_t"] = np.zeros((1, 1))
-        self.view_form_output["back_c"] = np.zeros((1, 1))
-        self.view_form_output["back_s"] = np.zeros((1, 1))
-        self.view_form_output["overlay_t"] = np.zeros((1, 1))
-        self.view_form_output["overlay_c"] = np.zeros((1, 1))
-        self.view_form_output["overlay_s"] = np.zeros((1, 1))
-        self.view_form_output["neg_overlay_t"] = np.zeros((1, 1))
-        self.view_form_output["neg_overlay_c"] = np.zeros((1, 1))
-        self.view_form_output["neg_overlay_s"] = np.zeros((1, 1))
-        self.view_form_output["pos_thresholds"] = np.array([1, 255])
-        self.view_form_output["neg_thresholds"] = np.array([1, 255])
-
-        self.orth_view = volviewformation.VolViewFormation(self.view_form_input, self.view_form_output)
+            epi_volume_type = "nii"
+
+        # # shared variables for OrthView process
+        self.view_form_input = sharedstate.SharedState(
+            arrays={
+                "rtQA_volume": sharedstate.Array((x, y, z), order='F'),
+            },
+            controls={
+                "is_rtqa": False,
+                "is_neg": self.negMapCheckBox.isChecked(),
+                "view_mode": int(self.imageViewMode),
+                "is_stopped": False,
+                "auto_thr_pos": True,
+                "auto_thr_neg": True,
+                "overlay_ready": False,
+                "request_id": 0,
+            },
+            objects={
+                "cursor_pus": sharedstate.Object([]),
+                "flags_planes": sharedstate.Object([]),
+                "bg_type": sharedstate.Object("bgEPI"),
+            },
+            params={
+                "nr_ROIs": nrROIs,
+                "ROI_indexes": self.roiVoxelIndexes,
+                "ROI_mats": self.roiMats,
+                "is_ROI": config.USE_ROI,
+                "anat_volume": anat_volume,
+                "epi_volume": self.P['MCTempl'],
+                "epi_volume_type": epi_volume_type,
+                "stat_volume": str(self.eng.evalin('base', 'P.memMapFile')).replace('shared', 'statVol'),
+                "mat": np.array(self.eng.evalin('base', 'mainLoopData.matTemplMotCorr')),
+                "dim": tuple([x, y, z]),
+                "memmap_volume": self.P['memMapFile'],
+                "mosaic_bg_refresh": max(int(config.MOSAIC_BACKGROUND_REFRESH), 1),
+                "mosaic_slice_stride": config.MOSAIC_SLICE_STRIDE,
+                "mosaic_downsample": config.MOSAIC_DOWNSAMPLE,
+                "resampling_order": config.VIEW_RESAMPLING_ORDER,
+            },
+            events={
+                "ready": False,
+            })
+
+        self.orth_view = volviewformation.VolViewFormation(self.view_form_input)
+        self.view_form_output = self.orth_view.output_data
+
+        # frames which are already published (blank ones) are not taken until they change
+        names = ['mosaic_templ', 'mosaic_pos_overlay', 'mosaic_neg_overlay', 'pos_thresholds', 'neg_thresholds']
+        for plane in ('t', 'c', 's'):
+            names += ['back_' + plane, 'overlay_' + plane, 'neg_overlay_' + plane, 'ROI_' + plane]
+        self.viewFrameIds = {name: self.view_form_output.version(name) for name in names}
+        self.viewScheduler = renderscheduler.RenderScheduler(config.VIEW_MAX_FPS, config.VIEW_RENDER_TIMEOUT)
         self.orth_view.start()
 
+    # --------------------------------------------------------------------------
+    def exportRoiGeometry(self):
+        """Transfers voxel indexes and affine matrices of all ROIs from Matlab in one file
+        """
+        fileName = str(Path(self.P['memMapFile'].replace('shared', 'ROIs')).with_suffix('.mat'))
+        self.eng.exportROIs(fileName, nargout=0)
+
+        roiData = loadmat(fileName)
+
+        dim = [self.P['MatrixSizeX'], self.P['MatrixSizeY'], self.P['NrOfSlices']]
+        if np.any(np.array(roiData['roiDim'], ndmin=2) != dim):
+            raise ValueError('ROI volumes of size {} do not match the EPI size {}'.format(
+                np.array(roiData['roiDim'], ndmin=2).tolist(), dim))
+
+        # Matlab find() indexes are 1-based, they are converted once here and
+        # all ROI voxel indexes in Python are 0-based Fortran-order linear indexes
+        self.roiVoxelIndexes = [np.array(ind, dtype=np.intp).ravel() - 1 for ind in roiData['roiVoxelIndex'].ravel()]
+        self.roiMats = np.array(roiData['roiMat'], ndmin=3).reshape(4, 4, -1).transpose(2, 0, 1)
+
     # --------------------------------------------------------------------------
     def rtqa_init(self):
 
         self.btnRTQA.setEnabled(True)
 
-        self.rtqa_input = multiprocessing.Manager().dict()
-        self.rtqa_input["nr_rois"] = self.P["NrROIs"]
-        self.rtqa_input["dim"] = tuple([self.P['MatrixSizeX'], self.P['MatrixSizeY'], self.P['NrOfSlices']])
-        self.rtqa_input["wb_roi_indexes"] = np.array(self.eng.evalin('base', 'ROIs(end).voxelIndex'),
-                                                     dtype=np.int32, ndmin=2)
-        wb_mask = np.ones((self.P['MatrixSizeX'] * self.P['MatrixSizeY'] * self.P['NrOfSlices'],))
-        wb_mask[self.rtqa_input["wb_roi_indexes"]] = 0
-        self.rtqa_input["wb_mask"] = wb_mask.astype(bool)
-        self.rtqa_input["muster_info"] = self.musterInfo
-        self.rtqa_input["xrange"] = self.P['NrOfVolumes'] - self.P['nrSkipVol']
-        self.rtqa_input["is_auto_rtqa"] = self.P["isAutoRTQA"]
-        self.rtqa_input["roi_checked"] = self.selectedRoi
+        nrROIs = int(self.P["NrROIs"])
+        dim = tuple([self.P['MatrixSizeX'], self.P['MatrixSizeY'], self.P['NrOfSlices']])
+
+        wb_roi_indexes = self.roiVoxelIndexes[-1]
+
+        params = {
+            "nr_rois": self.P["NrROIs"],
+            "dim": dim,
+            "wb_roi_indexes": wb_roi_indexes,
+            "muster_info": self.musterInfo,
+            "xrange": self.P['NrOfVolumes'] - self.P['nrSkipVol'],
+            "is_auto_rtqa": self.P["isAutoRTQA"],
+            "volume": self.P["memMapFile"],
+            "dvars_scale": self.P["scaleFactorDVARS"],
+        }
         if not config.AUTO_RTQA:
-            self.rtqa_input["ind_bas"] = np.array(self.P["inds"][0])
-            self.rtqa_input["ind_cond"] = np.array(self.P["inds"][1])
-        self.rtqa_input["volume"] = self.P["memMapFile"]
-        self.rtqa_input["is_stopped"] = False
-        self.rtqa_input["data_ready"] = False
-        self.rtqa_input["calc_ready"] = False
-        self.rtqa_input["roi_changed"] = False
-        self.rtqa_input["raw_ts"] = []
-        self.rtqa_input["glm_ts"] = []
-        self.rtqa_input["no_reg_glm_ts"] = []
-        self.rtqa_input["proc_ts"] = []
-        self.rtqa_input["mc_ts"] = []
-        self.rtqa_input["offset_mc"] = []
-        self.rtqa_input["beta_coeff"] = []
-        self.rtqa_input["pos_spikes"] = []
-        self.rtqa_input["neg_spikes"] = []
-        self.rtqa_input["is_new_dcm_block"] = True
-        self.rtqa_input["iteration"] = 0
-        self.rtqa_input["which_vol"] = 0
-        self.rtqa_input["dvars_scale"] = self.P["scaleFactorDVARS"]
-        self.rtqa_input["rtqa_vol_ready"] = False
-
-        self.rtqa_output = multiprocessing.Manager().dict()
-        self.rtqa_output["snr_vol"] = np.zeros(self.rtqa_input["dim"])
-        self.rtqa_output["cnr_vol"] = np.zeros(self.rtqa_input["dim"])
-        self.rtqa_output["show_vol"] = False
-        self.rtqa_output["rSNR"] = []
-        self.rtqa_output["rCNR"] = []
-        self.rtqa_output["rMean"] = []
-        self.rtqa_output["meanBas"] = []
-        self.rtqa_output["meanCond"] = []
-        self.rtqa_output["rVar"] = []
-        self.rtqa_output["varBas"] = []
-        self.rtqa_output["varCond"] = []
-        self.rtqa_output["glmProcTimeSeries"] = []
-        self.rtqa_output["rMSE"] = []
-        self.rtqa_output["linTrendCoeff"] = []
-        self.rtqa_output["rNoRegSNR"] = []
-        self.rtqa_output["DVARS"] = []
-        self.rtqa_output["excDVARS"] = []
-        self.rtqa_output["mc_params"] = []
-        self.rtqa_output["FD"] = []
-        self.rtqa_output["MD"] = []
-        self.rtqa_output["meanFD"] = []
-        self.rtqa_output["meanMD"] = []
-        self.rtqa_output["excFD"] = []
-        self.rtqa_output["excMD"] = []
-        self.rtqa_output["posSpikes"] = []
-        self.rtqa_output["negSpikes"] = []
+            params["ind_bas"] = np.array(self.P["inds"][0])
+            params["ind_cond"] = np.array(self.P["inds"][1])
+
+        self.rtqa_input = sharedstate.SharedState(
+            arrays={
+                "raw_ts": sharedstate.Array((nrROIs,)),
+                "glm_ts": sharedstate.Array((nrROIs, 1)),
+                "no_reg_glm_ts": sharedstate.Array((nrROIs,), optional=True),
+                "proc_ts": sharedstate.Array((nrROIs,)),
+                "mc_ts": sharedstate.Array((6,)),
+                "offset_mc": sharedstate.Array((1, 6)),
+                "beta_coeff": sharedstate.Array((nrROIs, 1)),
+                "pos_spikes": sharedstate.Array((nrROIs, 1)),
+                "neg_spikes": sharedstate.Array((nrROIs, 1)),
+            },
+            controls={
+                "is_stopped": False,
+                "calc_ready": False,
+                "roi_changed": False,
+                "is_new_dcm_block": True,
+                "iteration": 0,
+                "which_vol": 0,
+                "rtqa_vol_ready": False,
+            },
+            objects={
+                "roi_checked": sharedstate.Object(self.selectedRoi, capacity=4096 + 16 * nrROIs),
+            },
+            params=params,
+            events={
+                "data_ready": False,
+            })
 
         if self.windowRTQA:
             self.windowRTQA.deleteLater()
 
-        self.calc_rtqa = rtqa_calc.RTQACalculation(self.rtqa_input, self.rtqa_output)
+        self.calc_rtqa = rtqa_calc.RTQACalculation(self.rtqa_input)
+        self.rtqa_output = self.calc_rtqa.output
         self.windowRTQA = rtqa_gui.RTQAWindow(self.calc_rtqa, self.rtqa_input, self.rtqa_output)
         self.calc_rtqa.start()
 
@@ -1807,10 +1818,20 @@ class OpenNFT(QWidget):
     def stop(self):
 
         self.isStopped = True
+        if self.viewScheduler is not None:
+            scheduler = self.viewScheduler
+            logger.info('View renders: {}, dropped requests: {}, timed out renders: {}, '
+                        'latency mean/max: {:.1f}/{:.1f} ms',
+                        scheduler.renders, scheduler.dropped, scheduler.timeouts,
+                        scheduler.mean_latency * 1000, scheduler.max_latency * 1000)
         if self.windowRTQA:
             if not self.rtqa_input is None:
-                self.rtqa_input["is_stopped"] = True
-            self.eng.workspace['rtQA_python'] = self.calc_rtqa.dataPacking()
+                self.calc_rtqa.stop()
+                # the last volume may still be in calculation, results are saved after the worker exits
+                self.calc_rtqa.join(timeout=1.0)
+                if self.calc_rtqa.is_alive():
+                    logger.warning('rtQA calculation did not finish, the last volume may be saved incomplete')
+            self.calc_rtqa.saveData(self.P['memMapFile'].replace('shared', 'rtQA_python').replace('.dat', '.mat'))
         self.btnStop.setEnabled(False)
 
         if 'isAutoRTQA' in self.P and not self.P['isAutoRTQA']:
@@ -1904,6 +1925,7 @@ class OpenNFT(QWidget):
         self.selectedRoi = np.where(list(self.roiDict.values()))[0]
         if self.windowRTQA:
             self.rtqa_input["roi_checked"] = self.selectedRoi
+            self.windowRTQA.invalidatePlots()
 
         self.drawRoiPlots(True)
         if self.isStopped:
@@ -2069,7 +2091,7 @@ class OpenNFT(QWidget):
             self.onInteractWithMapImage()
 
     # --------------------------------------------------------------------------
-    def updateMosaicViewAsync(self):
+    def updateMosaicViewAsync(self, is_new_volume=False):
 
         if self.windowRTQA:
             is_snr_map_created = self.rtqa_input["rtqa_vol_ready"]
@@ -2078,7 +2100,7 @@ class OpenNFT(QWidget):
             is_rtqa_volume = False
             is_snr_map_created = False
 
-        is_stat_map_created = bool(self.eng.evalin('base', 'mainLoopData.statMapCreated'))
+        is_stat_map_created = self.isStatMapCreated
 
         self.view_form_input["is_rtqa"] = is_rtqa_volume
         if self.windowRTQA and self.view_form_input["is_rtqa"]:
@@ -2092,10 +2114,10 @@ class OpenNFT(QWidget):
             self.view_form_input["is_neg"] = self.negMapCheckBox.isChecked()
         self.view_form_input["overlay_ready"] = (is_stat_map_created and not is_rtqa_volume) \
                                                 or (is_snr_map_created and is_rtqa_volume)
-        self.view_form_input["ready"] = True
+        self.requestViewRender(is_new_volume)
 
     # --------------------------------------------------------------------------
-    def updateOrthViewAsync(self):
+    def updateOrthViewAsync(self, is_new_volume=False):
         if not self.orth_view:
             return
 
@@ -2121,7 +2143,41 @@ class OpenNFT(QWidget):
             self.view_form_input["is_neg"] = False
         else:
             self.view_form_input["is_neg"] = self.negMapCheckBox.isChecked()
-        self.view_form_input["ready"] = True
+        self.requestViewRender(is_new_volume)
+
+    # --------------------------------------------------------------------------
+    def requestViewRender(self, is_new_volume=False):
+        """Requests rendering of the current view input state
+
+        Requests are coalesced while the view formation process is busy,
+        interactive requests are limited by config.VIEW_MAX_FPS.
+        """
+        if self.viewScheduler is None:
+            return
+
+        if is_new_volume:
+            self.viewScheduler.request(renderscheduler.RenderScheduler.VOLUME)
+        else:
+            self.viewScheduler.request(renderscheduler.RenderScheduler.INTERACTIVE)
+        self.submitViewRender()
+
+    # --------------------------------------------------------------------------
+    def submitViewRender(self):
+        """Submits the pending render request if the scheduler allows it
+        """
+        if self.viewScheduler is None or self.view_form_output is None:
+            return
+
+        if not self.orth_view.is_alive():
+            logger.error('View formation process exited with code {}, views are not updated anymore',
+                         self.orth_view.exitcode)
+            self.viewScheduler = None
+            return
+
+        request_id = self.viewScheduler.next_request(self.view_form_output["rendered_id"])
+        if request_id is not None:
+            self.view_form_input["request_id"] = request_id
+            self.view_form_input["ready"] = True
 
     # --------------------------------------------------------------------------
     def onChangeOrthViewCursorPosition(self, pos, proj):
@@ -2151,97 +2207,117 @@ class OpenNFT(QWidget):
             self.updateOrthViewAsync()
 
     # --------------------------------------------------------------------------
-    def onCheckOrthViewUpdated(self):
+    def takeViewFrames(self, names):
+        """Takes the view images which were published since the previous check
 
-        if self.view_form_input["done_orth"]:
+        :param names: names of frames and objects of the view formation output
+        :return: name -> frame, only for changed frames which are present
+        """
+        frames = {}
+        for name in names:
+            if self.view_form_output.version(name) != self.viewFrameIds.get(name):
+                self.viewFrameIds[name], frame = self.view_form_output.take(name)
+                if frame is not None:
+                    frames[name] = frame
+        return frames
 
-            self.orthViewUpdateInProgress = True
+    # --------------------------------------------------------------------------
+    def onCheckOrthViewUpdated(self):
 
-            rgba_pos_map_image = None
-            rgba_neg_map_image = None
+        if self.view_form_output is None:
+            return
 
-            for proj in projview.ProjectionType:
+        self.submitViewRender()
 
-                if proj == projview.ProjectionType.transversal:
-                    bg_image = self.view_form_output['back_t']
-                    rgba_pos_map_image = self.view_form_output['overlay_t']
-                    if not self.view_form_input["is_rtqa"] and self.negMapCheckBox.isChecked():
-                        rgba_neg_map_image = self.view_form_output['neg_overlay_t']
-                elif proj == projview.ProjectionType.sagittal:
-                    bg_image = self.view_form_output['back_s']
-                    rgba_pos_map_image = self.view_form_output['overlay_s']
-                    if not self.view_form_input["is_rtqa"] and self.negMapCheckBox.isChecked():
-                        rgba_neg_map_image = self.view_form_output['neg_overlay_s']
-                elif proj == projview.ProjectionType.coronal:
-                    bg_image = self.view_form_output['back_c']
-                    rgba_pos_map_image = self.view_form_output['overlay_c']
-                    if not self.view_form_input["is_rtqa"] and self.negMapCheckBox.isChecked():
-                        rgba_neg_map_image = self.view_form_output['neg_overlay_c']
+        is_neg_visible = not self.view_form_input["is_rtqa"] and self.negMapCheckBox.isChecked()
 
-                self.orthView.set_background_image(proj, bg_image)
-                if rgba_pos_map_image is not None and rgba_pos_map_image.ndim == 3:
-                    self.orthView.set_pos_map_image(proj, rgba_pos_map_image)
-                if rgba_neg_map_image is not None and rgba_neg_map_image.ndim == 3:
-                    self.orthView.set_neg_map_image(proj, rgba_neg_map_image)
+        names = ['back_t', 'back_c', 'back_s', 'overlay_t', 'overlay_c', 'overlay_s', 'pos_thresholds']
+        if is_neg_visible:
+            names += ['neg_overlay_t', 'neg_overlay_c', 'neg_overlay_s', 'neg_thresholds']
 
-            pos_thr = self.view_form_output["pos_thresholds"]
-            self.pos_map_thresholds_widget.set_thresholds(pos_thr)
+        with self.view_form_output.lock:
+            frames = self.takeViewFrames(names)
+            rois = self.takeViewFrames(['ROI_t', 'ROI_c', 'ROI_s'])
 
-            if not self.view_form_input["is_rtqa"] and self.negMapCheckBox.isChecked():
-                neg_thr = self.view_form_output["neg_thresholds"]
-                self.neg_map_thresholds_widget.set_thresholds(neg_thr)
+        if not frames and not rois:
+            return
 
-            roi_t = []
-            roi_c = []
-            roi_s = []
-            for i in self.selectedRoi:
-                roi_t.append(self.view_form_output["ROI_t"][i])
-                roi_c.append(self.view_form_output["ROI_c"][i])
-                roi_s.append(self.view_form_output["ROI_s"][i])
+        self.orthViewUpdateInProgress = True
 
-            self.orthView.set_roi(projview.ProjectionType.transversal, roi_t, self.selectedRoi)
-            self.orthView.set_roi(projview.ProjectionType.coronal, roi_c, self.selectedRoi)
-            self.orthView.set_roi(projview.ProjectionType.sagittal, roi_s, self.selectedRoi)
+        planes = {
+            projview.ProjectionType.transversal: 't',
+            projview.ProjectionType.coronal: 'c',
+            projview.ProjectionType.sagittal: 's',
+        }
 
-            if self.orthViewInitialize:
-                self.orthView.reset_view()
+        is_background_set = False
+        for proj, plane in planes.items():
+            bg_image = frames.get('back_' + plane)
+            rgba_pos_map_image = frames.get('overlay_' + plane)
+            rgba_neg_map_image = frames.get('neg_overlay_' + plane)
 
+            if bg_image is not None:
+                self.orthView.set_background_image(proj, bg_image)
+                is_background_set = True
+            if rgba_pos_map_image is not None and rgba_pos_map_image.ndim == 3:
+                self.orthView.set_pos_map_image(proj, rgba_pos_map_image)
+            if rgba_neg_map_image is not None and rgba_neg_map_image.ndim == 3:
+                self.orthView.set_neg_map_image(proj, rgba_neg_map_image)
+
+        if 'pos_thresholds' in frames:
+            self.pos_map_thresholds_widget.set_thresholds(frames['pos_thresholds'])
+
+        if 'neg_thresholds' in frames:
+            self.neg_map_thresholds_widget.set_thresholds(frames['neg_thresholds'])
+
+        for proj, plane in planes.items():
+            roi = rois.get('ROI_' + plane)
+            if roi is not None:
+                self.orthView.set_roi(proj, [roi[i] for i in self.selectedRoi], self.selectedRoi)
+
+        # the view range is fitted to the first rendered background, not to thresholds or ROIs
+        if self.orthViewInitialize and is_background_set:
+            self.orthView.reset_view()
             self.orthViewInitialize = False
-            self.orthViewUpdateInProgress = False
-            self.view_form_input["done_orth"] = False
+
+        self.orthViewUpdateInProgress = False
 
     # --------------------------------------------------------------------------
     def onCheckMosaicViewUpdated(self):
 
-        if self.view_form_input["done_mosaic_templ"] and self.iteration > 1:
-            background_image = self.view_form_output["mosaic_templ"]
-            if background_image.size > 0:
-                self.mosaicImageView.set_background_image(background_image)
-            else:
-                return
+        if self.view_form_output is None:
+            return
+
+        self.submitViewRender()
 
-            self.view_form_input["done_mosaic_templ"] = False
+        if self.iteration > 1:
+            with self.view_form_output.lock:
+                frames = self.takeViewFrames(['mosaic_templ'])
+            background_image = frames.get('mosaic_templ')
+            if background_image is not None and background_image.size > 0:
+                self.mosaicImageView.set_background_image(background_image)
 
         # SNR/Stat map display
-        if self.view_form_input["done_mosaic_overlay"]:
+        is_neg_visible = not self.view_form_input["is_rtqa"] and self.negMapCheckBox.isChecked()
 
-            rgba_pos_map_image = self.view_form_output["mosaic_pos_overlay"]
-            pos_thr = self.view_form_output["pos_thresholds"]
-            self.pos_map_thresholds_widget.set_thresholds(pos_thr)
+        names = ['mosaic_pos_overlay', 'pos_thresholds']
+        if is_neg_visible:
+            names += ['mosaic_neg_overlay', 'neg_thresholds']
 
-            if rgba_pos_map_image is not None:
-                self.mosaicImageView.set_pos_map_image(rgba_pos_map_image)
+        with self.view_form_output.lock:
+            frames = self.takeViewFrames(names)
 
-            if not self.view_form_input["is_rtqa"] and self.negMapCheckBox.isChecked():
+        if 'pos_thresholds' in frames:
+            self.pos_map_thresholds_widget.set_thresholds(frames['pos_thresholds'])
 
-                rgba_neg_map_image = self.view_form_output["mosaic_neg_overlay"]
-                neg_thr = self.view_form_output["neg_thresholds"]
-                self.neg_map_thresholds_widget.set_thresholds(neg_thr)
+        if frames.get('mosaic_pos_overlay') is not None:
+            self.mosaicImageView.set_pos_map_image(frames['mosaic_pos_overlay'])
 
-                if rgba_neg_map_image is not None:
-                    self.mosaicImageView.set_neg_map_image(rgba_neg_map_image)
+        if 'neg_thresholds' in frames:
+            self.neg_map_thresholds_widget.set_thresholds(frames['neg_thresholds'])
 
-            self.view_form_input["done_mosaic_overlay"] = False
+        if frames.get('mosaic_neg_overlay') is not None:
+            self.mosaicImageView.set_neg_map_image(frames['mosaic_neg_overlay'])
 
     # --------------------------------------------------------------------------
     def loadSettingsFromSetFile(self):
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""
+Resampling of volumes to the planes of the orthogonal view
+
+The sample coordinates and interpolation weights of a plane depend only on
+the plane geometry and the volume matrix. They are computed once and reused
+for all co-registered volumes which share the matrix (background, positive
+and negative stat maps) and for later requests at the same cursor position.
+Results are written to preallocated images in the layout of the view
+(transposed, sagittal plane mirrored), so no copies are made after sampling.
+
+Pixel and voxel coordinates follow `spm_slice_vol`: the plane matrix maps
+1-based pixel coordinates to 1-based voxel coordinates, samples outside of
+the volume are NaN.
+
+__________________________________________________________________________
+Copyright (C) 2016-2021 OpenNFT.org
+
+"""
+
+import collections
+import typing as t
+
+import numpy as np
+from scipy import ndimage
+
+__all__ = ['NEAREST', 'TRILINEAR', 'BSPLINE', 'PlaneSampling', 'OrthSampler']
+
+# interpolation orders
+NEAREST = 0
+TRILINEAR = 1
+BSPLINE = 3
+
+
+class PlaneSampling:
+    """Precomputed sampling of volumes of one shape on one plane
+
+    :param mat: matrix from plane pixel coordinates to volume voxel coordinates
+    :param size: plane size as for `spm_slice_vol`, the image shape is (size[1], size[0])
+    :param vol_shape: shape of sampled volumes
+    :param order: NEAREST, TRILINEAR or BSPLINE
+    :param flip: mirror columns of the image (sagittal plane of the view)
+    """
+
+    def __init__(self, mat: np.ndarray, size: t.Sequence[int], vol_shape: t.Sequence[int],
+                 order: int = NEAREST, flip: bool = False):
+        self.shape = (int(size[1]), int(size[0]))
+        self.order = order
+
+        rows, cols = np.mgrid[0:self.shape[0], 0:self.shape[1]]
+        x = (self.shape[1] - cols) if flip else (cols + 1)
+        y = rows + 1
+
+        # 0-based voxel coordinates of all pixels, (3, npixels)
+        coords = (mat[0:3, 0:1] * x.ravel() + mat[0:3, 1:2] * y.ravel() + mat[0:3, 3:4]) - 1
+        dims = np.array(vol_shape[0:3], ndmin=2).T
+
+        if order == NEAREST:
+            coords = np.rint(coords)
+        valid = np.all((coords >= 0) & (coords <= dims - 1), axis=0)
+
+        self.pixels = np.flatnonzero(valid)
+        coords = coords[:, valid]
+
+        if order == NEAREST:
+            self.indexes = np.ravel_multi_index(coords.astype(np.intp), vol_shape[0:3], order='F')
+        elif order == TRILINEAR:
+            # the last voxel is interpolated from the cell before it
+            base = np.minimum(np.floor(coords), np.maximum(dims - 2, 0))
+            frac = coords - base
+            base = base.astype(np.intp)
+
+            indexes = []
+            weights = []
+            for dx in (0, 1):
+                for dy in (0, 1):
+                    for dz in (0, 1):
+                        corner = base + np.array([[dx], [dy], [dz]])
+                        np.minimum(corner, dims - 1, out=corner)
+                        indexes.append(np.ravel_multi_index(corner, vol_shape[0:3], order='F'))
+                        weights.append((frac[0] if dx else 1 - frac[0])
+                                       * (frac[1] if dy else 1 - frac[1])
+                                       * (frac[2] if dz else 1 - frac[2]))
+
+            self.indexes = np.array(indexes)
+            self.weights = np.array(weights)
+        else:
+            self.coords = coords
+
+    def sample(self, vol: np.ndarray, out: np.ndarray) -> np.ndarray:
+        """Samples the volume to the image
+
+        :param vol: volume of the shape given at construction
+        :param out: image of `shape`, C-contiguous
+        :return: out
+        """
+        out.fill(np.nan)
+        flat = out.reshape(-1)
+
+        if self.order == BSPLINE:
+            flat[self.pixels] = ndimage.map_coordinates(vol, self.coords, order=BSPLINE, mode='nearest')
+            return out
+
+        # a view for Fortran-ordered volumes
+        vol = vol.reshape(-1, order='F')
+        if self.order == NEAREST:
+            flat[self.pixels] = vol[self.indexes]
+        else:
+            values = vol[self.indexes]
+            values *= self.weights
+            flat[self.pixels] = values.sum(axis=0)
+
+        return out
+
+
+class OrthSampler:
+    """Resamples co-registered volumes to the transversal, coronal and sagittal planes
+
+    The sampling of recently used plane geometries is kept, so cursor moves back
+    and forth and repeated requests at the same position do not recompute it.
+
+    :param order: default interpolation order, NEAREST, TRILINEAR or BSPLINE
+    :param capacity: number of kept plane samplings
+    """
+
+    def __init__(self, order: int = NEAREST, capacity: int = 8):
+        self.order = order
+        self.capacity = capacity
+        self._samplings = collections.OrderedDict()
+        self._buffers = {}
+
+    def sampling(self, mat: np.ndarray, size: t.Sequence[int], vol_shape: t.Sequence[int],
+                 order: int, flip: bool, cache: bool = True) -> PlaneSampling:
+        """Returns the sampling for the plane geometry, it is computed if it is not kept
+        """
+        key = (mat.tobytes(), tuple(size), tuple(vol_shape), order, flip)
+        sampling = self._samplings.get(key)
+
+        if sampling is None:
+            sampling = PlaneSampling(mat, size, vol_shape, order, flip)
+            if cache:
+                self._samplings[key] = sampling
+                if len(self._samplings) > self.capacity:
+                    self._samplings.popitem(last=False)
+        elif cache:
+            self._samplings.move_to_end(key)
+
+        return sampling
+
+    def resample(self, volumes: t.Sequence[np.ndarray], coord_param: dict, m: np.ndarray, plane: str,
+                 order: t.Optional[int] = None, cache: bool = True) -> t.List[np.ndarray]:
+        """Resamples volumes which share the matrix to one plane of the orthogonal view
+
+        :param volumes: volumes of the same shape
+        :param coord_param: plane matrices 'tm0', 'cm0', 'sm0' and sizes 'td', 'cd', 'sd'
+        :param m: volume to view space matrix
+        :param plane: 't', 'c' or 's'
+        :param order: interpolation order, the default order if None
+        :param cache: keep the sampling for later requests
+        :return: images of the plane, they are overwritten by the next call for the plane
+        """
+        if order is None:
+            order = self.order
+
+        mat = np.linalg.inv(coord_param[plane + 'm0'] @ m)
+        sampling = self.sampling(mat, coord_param[plane + 'd'], volumes[0].shape, order, plane == 's', cache)
+
+        images = []
+        for i, vol in enumerate(volumes):
+            buffer = self._buffers.get((plane, i))
+            if buffer is None or buffer.shape != sampling.shape:
+                buffer = np.empty(sampling.shape)
+                self._buffers[(plane, i)] = buffer
+            images.append(sampling.sample(vol, buffer))
+
+        return images
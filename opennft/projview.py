@@ -50,9 +50,9 @@ class ProjectionImageView(pg.ViewBox):
 
         self._proj_type = proj_type
 
-        self._background_imitem = pg.ImageItem(autoDownsample=True)
-        self._pos_map_imitem = pg.ImageItem(autoDownsample=True)
-        self._neg_map_imitem = pg.ImageItem(autoDownsample=True)
+        self._background_imitem = pg.ImageItem(autoDownsample=True, axisOrder='row-major')
+        self._pos_map_imitem = pg.ImageItem(autoDownsample=True, axisOrder='row-major')
+        self._neg_map_imitem = pg.ImageItem(autoDownsample=True, axisOrder='row-major')
 
         self._roi_plotdataitems = []
         self._roi_pens = cycler(color=config.PROJ_ROI_COLORS)
@@ -77,14 +77,15 @@ class ProjectionImageView(pg.ViewBox):
         # self.sigResized.connect(self._viewbox_resized)
 
     def set_background_image(self, image):
+        # uint8 images in row-major order are shown with fixed levels, pyqtgraph does not rescale them
         self._image_shape = image.shape
-        self._background_imitem.setImage(image.T)
+        self._background_imitem.setImage(image, autoLevels=False, levels=(0, 255))
 
     def set_pos_map_image(self, image):
-        self._pos_map_imitem.setImage(np.transpose(image, axes=(1, 0, 2)))
+        self._pos_map_imitem.setImage(image, autoLevels=False, levels=(0, 255))
 
     def set_neg_map_image(self, image):
-        self._neg_map_imitem.setImage(np.transpose(image, axes=(1, 0, 2)))
+        self._neg_map_imitem.setImage(image, autoLevels=False, levels=(0, 255))
 
     def set_pos_map_visible(self, flag):
         self._pos_map_imitem.setVisible(flag)
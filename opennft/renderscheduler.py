@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+Scheduling of view render requests from the GUI to the view formation process
+
+The view formation process renders the state of its shared input, so requests
+which arrive while a render is in progress are coalesced into one pending
+request: the latest state wins and only one render is submitted when the
+worker becomes free. Interactive re-renders (cursor moves, thresholds,
+checkboxes) are limited to a maximum frame rate, requests tied to a new
+volume are submitted as soon as the worker is free. A render which is not
+finished within the render timeout is submitted again, so a lost or failed
+render does not stop view updates.
+
+__________________________________________________________________________
+Copyright (C) 2016-2021 OpenNFT.org
+
+"""
+
+import time
+import typing as t
+
+__all__ = ['RenderScheduler']
+
+
+class RenderScheduler:
+    """Coalesces view render requests and limits the rate of interactive re-renders
+
+    :param max_fps: maximum rate of submitted interactive renders, 0 disables the limit
+    :param render_timeout: time in seconds after which an unfinished render is submitted again
+    :param clock: function which returns the current time in seconds
+    """
+
+    INTERACTIVE = 0
+    VOLUME = 1
+
+    def __init__(self, max_fps: float, render_timeout: float = 1.0,
+                 clock: t.Callable[[], float] = time.monotonic):
+        self.min_interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.render_timeout = render_timeout
+        self.clock = clock
+
+        self.pending = None  # type: t.Optional[int]
+        self.pending_since = 0.0
+        self.submitted_id = 0
+        self.submitted_at = None  # type: t.Optional[float]
+        self.submitted_priority = self.INTERACTIVE
+        self.requested_at = 0.0
+        self.is_rendering = False
+
+        self.requests = 0
+        self.renders = 0
+        self.dropped = 0
+        self.timeouts = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def request(self, priority: int = INTERACTIVE):
+        """Adds a render request, it supersedes the pending one
+
+        :param priority: INTERACTIVE or VOLUME
+        """
+        now = self.clock()
+        self.requests += 1
+
+        if self.pending is None:
+            self.pending = priority
+            self.pending_since = now
+        else:
+            self.dropped += 1
+            self.pending = max(self.pending, priority)
+
+    def next_request(self, rendered_id: int) -> t.Optional[int]:
+        """Returns id of the request to submit now or None
+
+        :param rendered_id: id of the last request rendered by the worker
+        :return: id of the new request, the caller submits it to the worker
+        """
+        now = self.clock()
+
+        if self.is_rendering and rendered_id >= self.submitted_id:
+            self.is_rendering = False
+            self.renders += 1
+            self.last_latency = now - self.requested_at
+            self.max_latency = max(self.max_latency, self.last_latency)
+            self.total_latency += self.last_latency
+
+        if self.is_rendering and now - self.submitted_at > self.render_timeout:
+            # the render was lost, it is submitted again unless a newer request supersedes it
+            self.is_rendering = False
+            self.timeouts += 1
+            if self.pending is None:
+                self.pending = self.submitted_priority
+                self.pending_since = self.requested_at
+            else:
+                self.pending = max(self.pending, self.submitted_priority)
+
+        if self.pending is None or self.is_rendering:
+            return None
+
+        if (self.pending == self.INTERACTIVE and self.submitted_at is not None
+                and now - self.submitted_at < self.min_interval):
+            return None
+
+        self.submitted_id += 1
+        self.submitted_at = now
+        self.requested_at = self.pending_since
+        self.submitted_priority = self.pending
+        self.is_rendering = True
+        self.pending = None
+
+        return self.submitted_id
+
+    @property
+    def mean_latency(self) -> float:
+        """Mean time from the first coalesced request to the rendered frame
+        """
+        return self.total_latency / self.renders if self.renders else 0.0
@@ -1,9 +1,8 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-import matlab
 import multiprocessing as mp
 
-from opennft import config
+from opennft import config, sharedstate, mappedvolume, runningstats
 from scipy.io import savemat
 from loguru import logger
 
@@ -12,12 +11,27 @@ class RTQACalculation(mp.Process):
     """Real-time quality assessment methods class
     """
 
+    # ROIs x volumes matrices that are computed in place in the shared output
+    SHARED_TS_FIELDS = ('rSNR', 'rCNR', 'rMean', 'meanBas', 'meanCond', 'rVar', 'varBas', 'varCond',
+                        'glmProcTimeSeries', 'rMSE', 'linTrendCoeff', 'rNoRegSNR', 'posSpikes', 'negSpikes')
+
+    # recursive estimates, the column of a volume is computed from the column of the previous one
+    RECURSIVE_TS_FIELDS = ('rSNR', 'rCNR', 'rMean', 'm2', 'meanBas', 'meanCond', 'rVar', 'varBas', 'varCond',
+                           'rMSE', 'rNoRegSNR', 'rNoRegMean', 'rNoRegVar')
+
+    # inputs of one volume, they are copied together before calculation
+    VOLUME_INPUTS = ('iteration', 'raw_ts', 'glm_ts', 'no_reg_glm_ts', 'proc_ts', 'mc_ts', 'beta_coeff',
+                     'pos_spikes', 'neg_spikes', 'is_new_dcm_block', 'offset_mc')
+
+    # condition code flags of volumes
+    BASELINE = 1
+    CONDITION = 2
+
     # --------------------------------------------------------------------------
-    def __init__(self, input, output):
+    def __init__(self, input):
 
         mp.Process.__init__(self)
         self.input = input
-        self.output = output
 
         # parent data transfer block
         sz = int(input["nr_rois"])
@@ -26,262 +40,430 @@ class RTQACalculation(mp.Process):
 
         if input["is_auto_rtqa"]:
             xrange = int(input["xrange"])
-            self.indBas = 0
-            self.indCond = 0
+            self.condCodes = np.zeros((xrange,), dtype=np.uint8)
         else:
-            lastInds = np.zeros((input["muster_info"]["condTotal"],))
-            for i in range(input["muster_info"]["condTotal"]):
-                lastInds[i] = input["muster_info"]["tmpCond" + str(i + 1)][-1][1]
-            xrange = int(max(lastInds))
-            self.indBas = np.array(input["ind_bas"]) - 1
-            self.indCond = np.array(input["ind_cond"]) - 1
+            musterInfo = input["muster_info"]
+            xrange = int(max(musterInfo["tmpCond" + str(i + 1)][-1][1] for i in range(musterInfo["condTotal"])))
+            self.condCodes = self.condition_codes(xrange, np.array(input["ind_bas"]) - 1,
+                                                  np.array(input["ind_cond"]) - 1)
 
         self.xrange = xrange
 
         # main class data initialization block
-        self.FD = np.array([])
         self.meanFD = 0
-        self.MD = np.array([])
         self.meanMD = 0
         self.blockIter = 1
         self.excFD = [0, 0]
         self.excMD = 0
-        self.excFDIndexes_1 = np.array([-1])
-        self.excFDIndexes_2 = np.array([-1])
-        self.excMDIndexes = np.array([-1])
-        self.rsqDispl = np.array([0])
-        self.mc_params = np.array([[1e-05,1e-05,1e-05,1e-05,1e-05,1e-05]])
+        # root squared displacements, only the filled part is valid
+        self.rsqDispl = np.zeros((xrange + 1,))
+        self.nrDispl = 1
         self.radius = config.DEFAULT_FD_RADIUS
         self.threshold = config.DEFAULT_FD_THRESHOLDS
         self.iterBas = 0
         self.iterCond = 0
-        self.iteration = 0
+        self.iteration = -1
         self.blockIter = 0
         self.noRegBlockIter = 0
-        self.rMean = np.zeros((sz, xrange))
         self.m2 = np.zeros((sz, xrange))
-        self.rVar = np.zeros((sz, xrange))
-        self.rSNR = np.zeros((sz, xrange))
         self.rNoRegMean = np.zeros((sz, xrange))
         self.noRegM2 = np.zeros((sz, 1))
         self.rNoRegVar = np.zeros((sz, xrange))
-        self.rNoRegSNR = np.zeros((sz, xrange))
-        self.meanBas = np.zeros((sz, xrange))
-        self.varBas = np.zeros((sz, xrange))
         self.m2Bas = np.zeros((sz, 1))
-        self.meanCond = np.zeros((sz, xrange))
-        self.varCond = np.zeros((sz, xrange))
         self.m2Cond = np.zeros((sz, 1))
-        self.rCNR = np.zeros((sz, xrange))
-        self.glmProcTimeSeries = np.zeros((sz, xrange))
-        self.posSpikes = dict.fromkeys(['{:d}'.format(x) for x in range(sz)], np.array(0))
-        self.negSpikes = dict.fromkeys(['{:d}'.format(x) for x in range(sz)], np.array(0))
-        self.rMSE = np.zeros((sz, xrange))
-        self.DVARS = np.zeros((1, ))
         self.excDVARS = 0
-        self.linTrendCoeff = np.zeros((sz, xrange))
         self.prevVol = np.array([])
+        # copy of the inputs of the volume being calculated
+        self.sample = {}
+        # mapping of the preprocessed volume file, it is created once in the process
+        self.mapped_volume = None
+
+        # voxelwise maps schedule: maps are due every mapCadence volumes, a due update
+        # is postponed while the next volume is already waiting
+        self.mapCadence = max(int(config.RTQA_MAP_CADENCE), 1)
+        self.isMapPending = False
+        self.mapIteration = -1
+        self.skippedMaps = 0
+        self.lostVolumes = 0
+
+        # voxelwise statistics are computed only inside the whole-brain mask,
+        # indexes are 0-based Fortran-order linear indexes of the volume
+        self.wb_indexes = np.asarray(input["wb_roi_indexes"], dtype=np.intp).ravel()
+        nr_wb_vox = self.wb_indexes.size
+        dtype = np.dtype(config.RTQA_VOLUME_DTYPE)
+        self.volume = np.empty((int(np.prod(input["dim"])),))
+        self.wb_volume = np.empty((nr_wb_vox,), dtype=dtype)
+        self.wb_map = np.empty((nr_wb_vox,), dtype=dtype)
+        self.snr_stats = runningstats.RunningStats(nr_wb_vox, dtype)
+        self.bas_stats = runningstats.RunningStats(nr_wb_vox, dtype)
+        self.cond_stats = runningstats.RunningStats(nr_wb_vox, dtype)
+
+        self.output = self.create_output_state()
+        self.bind_output()
+        self.init_history()
+        self.publish_output()
+
+    # --------------------------------------------------------------------------
+    def condition_codes(self, xrange, indBas, indCond):
+        """ Builds the per-volume condition code vector from the protocol
+
+        :param xrange: number of volumes
+        :param indBas: zero-based indexes of baseline volumes
+        :param indCond: zero-based indexes of condition volumes
+        :return: vector of BASELINE and CONDITION flags, zero for volumes of neither
+        """
+
+        size = int(max(xrange, np.max(indBas, initial=-1) + 1, np.max(indCond, initial=-1) + 1))
+        codes = np.zeros((size,), dtype=np.uint8)
+        codes[indBas.astype(int).ravel()] |= self.BASELINE
+        codes[indCond.astype(int).ravel()] |= self.CONDITION
+        return codes
+
+    # --------------------------------------------------------------------------
+    def cond_code(self, index_volume):
+        """ Returns condition flags of the volume
+
+        :param index_volume: current volume index
+        """
+
+        if 0 <= index_volume < self.condCodes.size:
+            return self.condCodes[index_volume]
+        return 0
+
+    # --------------------------------------------------------------------------
+    def create_output_state(self):
+        """ Allocates shared rtQA output for the number of ROIs and volumes
+        """
+
+        sz = self.nrROIs
+        xrange = self.xrange
+
+        arrays = {
+            "snr_vol": sharedstate.Array(self.input["dim"], order="F"),
+            "cnr_vol": sharedstate.Array(self.input["dim"], order="F"),
+            "DVARS": sharedstate.Array((xrange + 1,), growable=True),
+            "FD": sharedstate.Array((xrange + 1,), growable=True),
+            "MD": sharedstate.Array((xrange + 1,), growable=True),
+            "mc_params": sharedstate.Array((xrange + 1, 6), growable=True),
+            "mc_offset": sharedstate.Array((1, 6)),
+            "excFD": sharedstate.Array((2,)),
+            "excFDIndexes_1": sharedstate.Array((xrange + 1,), growable=True),
+            "excFDIndexes_2": sharedstate.Array((xrange + 1,), growable=True),
+            "excMDIndexes": sharedstate.Array((xrange + 1,), growable=True),
+        }
+        for name in self.SHARED_TS_FIELDS:
+            dtype = bool if name.endswith("Spikes") else np.float64
+            arrays[name] = sharedstate.Array((sz, xrange), dtype=dtype)
+
+        controls = {
+            "show_vol": False,
+            # number of volumes whose time-series metrics are complete
+            "valid_up_to": 0,
+            # volume index of the voxelwise maps and their lag behind the time-series, -1 if not computed
+            "map_iteration": -1,
+            "map_staleness": -1,
+            # map updates postponed because the next volume was waiting
+            "skipped_maps": 0,
+            # volumes which were replaced by the next one before calculation
+            "lost_volumes": 0,
+            "excDVARS": 0,
+            "meanFD": 0.0,
+            "meanMD": 0.0,
+            "excMD": 0,
+        }
+
+        return sharedstate.SharedState(arrays=arrays, controls=controls)
+
+    # --------------------------------------------------------------------------
+    def bind_output(self):
+        """ Binds ROIs x volumes matrices to the shared output of the current process
+        """
+
+        for name in self.SHARED_TS_FIELDS:
+            setattr(self, name, self.output[name])
+
+    # --------------------------------------------------------------------------
+    def init_history(self):
+        """ Sets initial values of the per-volume series
+
+        The series are preallocated growable arrays of the shared output, they
+        are appended in place and are read back as trimmed views of the filled part.
+        Index series hold -1 until the first threshold exceedance.
+        """
+
+        self.output["DVARS"] = np.zeros((1,))
+        self.output["mc_params"] = np.array([[1e-05, 1e-05, 1e-05, 1e-05, 1e-05, 1e-05]])
+        self.output["FD"] = np.array([])
+        self.output["MD"] = np.array([])
+        self.output["excFDIndexes_1"] = np.array([-1])
+        self.output["excFDIndexes_2"] = np.array([-1])
+        self.output["excMDIndexes"] = np.array([-1])
+
+    # --------------------------------------------------------------------------
+    def append_index(self, name, index):
+        """ Appends the volume index to an index series, the initial -1 is replaced
+
+        :param name: index series name
+        :param index: volume index
+        """
+
+        if self.output[name][-1] == -1:
+            self.output[name] = np.array([index])
+        else:
+            self.output.append(name, index)
+
+    # --------------------------------------------------------------------------
+    def publish_output(self):
+        """ Copies the scalar metrics to the shared output, the series are appended in place
+        """
 
-        self.volume_data = {"mean_vol": [],
-                            "m2_vol": [],
-                            "var_vol": [],
-                            "iter": 0,
-                            "mean_bas_vol": [],
-                            "m2_bas_vol": [],
-                            "var_bas_vol": [],
-                            "iter_bas": 0,
-                            "mean_cond_vol": [],
-                            "m2_cond_vol": [],
-                            "var_cond_vol": [],
-                            "iter_cond": 0
-                            }
-
-        self.output["rSNR"] = self.rSNR
-        self.output["rCNR"] = self.rCNR
-        self.output["rMean"] = self.rMean
-        self.output["meanBas"] = self.meanBas
-        self.output["meanCond"] = self.meanCond
-        self.output["rVar"] = self.rVar
-        self.output["varBas"] = self.varBas
-        self.output["varCond"] = self.varCond
-        self.output["glmProcTimeSeries"] = self.glmProcTimeSeries
-        self.output["rMSE"] = self.rMSE
-        self.output["linTrendCoeff"] = self.linTrendCoeff
-        self.output["rNoRegSNR"] = self.rNoRegSNR
-        self.output["DVARS"] = self.DVARS
         self.output["excDVARS"] = self.excDVARS
-        self.output["mc_params"] = self.mc_params
-        self.output["mc_offset"] = np.zeros((6,1))
-        self.output["FD"] = self.FD
-        self.output["MD"] = self.MD
         self.output["meanFD"] = self.meanFD
         self.output["meanMD"] = self.meanMD
         self.output["excFD"] = self.excFD
         self.output["excMD"] = self.excMD
-        self.output["posSpikes"] = self.posSpikes
-        self.output["negSpikes"] = self.negSpikes
+        self.output["map_iteration"] = self.mapIteration
+        self.output["map_staleness"] = self.iteration - self.mapIteration if self.mapIteration >= 0 else -1
+        self.output["skipped_maps"] = self.skippedMaps
+        self.output["lost_volumes"] = self.lostVolumes
 
     # --------------------------------------------------------------------------
     def run(self):
 
         np.seterr(divide='ignore', invalid='ignore')
+        self.bind_output()
+
+        while True:
+
+            # block until the next volume is delivered or the GUI asks to stop,
+            # the flag is cleared at once, so a volume delivered during calculation is not missed
+            self.input.wait("data_ready")
+            self.input["data_ready"] = False
+            if self.input["is_stopped"]:
+                break
 
-        while not self.input["is_stopped"]:
-
-            if self.input["data_ready"]:
-                self.calculate_rtqa()
-
-                self.output["rSNR"] = self.rSNR
-                self.output["rCNR"] = self.rCNR
-                self.output["rMean"] = self.rMean
-                self.output["meanBas"] = self.meanBas
-                self.output["meanCond"] = self.meanCond
-                self.output["rVar"] = self.rVar
-                self.output["varBas"] = self.varBas
-                self.output["varCond"] = self.varCond
-                self.output["glmProcTimeSeries"] = self.glmProcTimeSeries
-                self.output["rMSE"] = self.rMSE
-                self.output["linTrendCoeff"] = self.linTrendCoeff
-                self.output["rNoRegSNR"] = self.rNoRegSNR
-                self.output["DVARS"] = self.DVARS
-                self.output["excDVARS"] = self.excDVARS
-                self.output["mc_params"] = self.mc_params
-                self.output["FD"] = self.FD
-                self.output["MD"] = self.MD
-                self.output["meanFD"] = self.meanFD
-                self.output["meanMD"] = self.meanMD
-                self.output["excFD"] = self.excFD
-                self.output["excMD"] = self.excMD
-                self.output["posSpikes"] = self.posSpikes
-                self.output["negSpikes"] = self.negSpikes
-
-                self.input["data_ready"] = False
-                self.input["calc_ready"] = True
+            self.sample = self.copy_volume_inputs()
+            self.calculate_rtqa()
+            self.publish_output()
+            self.output["valid_up_to"] = self.iteration + 1
+
+            self.input["calc_ready"] = True
+
+    # --------------------------------------------------------------------------
+    def copy_volume_inputs(self):
+        """ Copies the inputs of the delivered volume under the input lock
+
+        The GUI writes the inputs of the next volume while the current one is calculated,
+        the copy keeps all inputs of the calculation from the same volume.
+
+        :return: input name -> value
+        """
+
+        with self.input.lock:
+            return {name: np.array(value) if isinstance(value, np.ndarray) else value
+                    for name, value in ((name, self.input[name]) for name in self.VOLUME_INPUTS)}
+
+    # --------------------------------------------------------------------------
+    def fill_lost_volumes(self, iteration):
+        """ Fills the history of lost volumes, so series stay aligned with volume indexes
+
+        The recursion of the current volume starts from the column of the previous volume,
+        for lost volumes it is a zero column. The last computed estimates are copied to the gap,
+        so lost volumes are skipped as if they were neither baseline nor condition volumes.
+        Appended series get NaN samples for lost volumes, motion parameters are carried forward,
+        so FD of the current volume is the displacement from the last calculated one.
+
+        :param iteration: index of the current volume
+        """
+
+        nr_lost = iteration - self.iteration - 1
+
+        # before the first calculated volume the initial motion parameters take the place of volume 0
+        nr_lost_mc = nr_lost - 1 if self.iteration < 0 else nr_lost
+        for _ in range(nr_lost_mc):
+            self.output.append("mc_params", self.output["mc_params"][-1])
+        for _ in range(nr_lost):
+            for name in ("DVARS", "FD", "MD"):
+                self.output.append(name, np.nan)
+
+        if self.iteration < 0:
+            return
+
+        gap = slice(self.iteration + 1, iteration)
+        for name in self.RECURSIVE_TS_FIELDS:
+            series = getattr(self, name)
+            series[:, gap] = series[:, self.iteration:self.iteration + 1]
+
+    # --------------------------------------------------------------------------
+    def stop(self):
+        """Asks the process loop to finish, it is called from the GUI process
+        """
+        self.input["is_stopped"] = True
+        self.input["data_ready"] = True
+
+        logger.info('rtQA maps: last volume {}, {} volumes behind, {} updates postponed; {} volumes lost',
+                    self.output["map_iteration"], self.output["map_staleness"],
+                    self.output["skipped_maps"], self.output["lost_volumes"])
 
     # --------------------------------------------------------------------------
     def calculate_rtqa(self):
 
-        iteration = self.input["iteration"]
-        for i in range(self.nrROIs):
-            self.linTrendCoeff[i][iteration] = self.input["beta_coeff"][i][-1]
+        iteration = self.sample["iteration"]
+        if iteration > self.iteration + 1:
+            self.lostVolumes += iteration - self.iteration - 1
+            self.fill_lost_volumes(iteration)
+        self.iteration = iteration
+        self.linTrendCoeff[:, iteration] = self.sample["beta_coeff"][:, -1]
 
-        volume = np.memmap(self.input["volume"], dtype=np.float64, order="F")
+        if self.mapped_volume is None:
+            self.mapped_volume = mappedvolume.MappedVolume(self.input["volume"], self.volume.shape)
+        volume, _ = self.mapped_volume.read(out=self.volume)
 
-        if self.input["is_new_dcm_block"]:
+        if self.sample["is_new_dcm_block"]:
             self.blockIter = 0
             self.iterBas = 0
             self.iterCond = 0
-            self.volume_data["iter"] = 0
-            self.volume_data["iter_bas"] = 0
-            self.volume_data["iter_cond"] = 0
-
-        if iteration == 0:
-            self.volume_data["mean_vol"] = np.zeros(volume.shape, order="F")
-            self.volume_data["m2_vol"] = np.zeros(volume.shape, order="F")
-            self.volume_data["var_vol"] = np.zeros(volume.shape, order="F")
-            self.volume_data["mean_bas_vol"] = np.zeros(volume.shape, order="F")
-            self.volume_data["m2_bas_vol"] = np.zeros(volume.shape, order="F")
-            self.volume_data["var_bas_vol"] = np.zeros(volume.shape, order="F")
-            self.volume_data["mean_cond_vol"] = np.zeros(volume.shape, order="F")
-            self.volume_data["m2_cond_vol"] = np.zeros(volume.shape, order="F")
-            self.volume_data["var_cond_vol"] = np.zeros(volume.shape, order="F")
+            self.snr_stats.reset()
+            self.bas_stats.reset()
+            self.cond_stats.reset()
 
-        if iteration > self.first_snr_vol:
-            self.calculate_rtqa_volume(volume, iteration)
+        # ROI-level metrics are computed for every volume
         self.calculate_rtqa_ts(iteration)
-        self.calculateDVARS(volume[self.input["wb_roi_indexes"]], iteration, self.input["is_new_dcm_block"])
+        self.calculateDVARS(volume[self.wb_indexes], iteration, self.sample["is_new_dcm_block"])
         self.calc_mc()
 
+        # voxelwise statistics take every volume, the maps are computed from them last,
+        # only when they are due and the worker is not behind
+        if iteration > self.first_snr_vol:
+            self.update_rtqa_stats(volume, iteration)
+            if self.is_map_due(iteration):
+                self.calculate_rtqa_volume()
+                self.mapIteration = iteration
+
     # --------------------------------------------------------------------------
-    def calculate_rtqa_volume(self, volume, index_volume):
+    def is_map_due(self, iteration):
+        """ Decides if voxelwise maps are updated for the current volume
+
+        Maps are due every mapCadence volumes. If the next volume is already waiting,
+        the update is postponed to the next volume the worker is not behind on,
+        so voxelwise maps never delay the time-series metrics.
 
-        output_vol, self.volume_data["mean_vol"], \
-        self.volume_data["m2_vol"], self.volume_data["var_vol"] = self.snr(self.volume_data["mean_vol"],
-                                                                           self.volume_data["m2_vol"],
-                                                                           volume, self.volume_data["iter"])
-        self.volume_data["iter"] += 1
-        output_vol[self.input["wb_mask"]] = 0
-        self.output["snr_vol"] = output_vol.reshape(self.input["dim"], order="F")
+        :param iteration: current volume index
+        :return: True if maps should be updated
+        """
+
+        if not (self.isMapPending or iteration % self.mapCadence == 0):
+            return False
+
+        if self.input["data_ready"]:
+            self.isMapPending = True
+            self.skippedMaps += 1
+            return False
+
+        self.isMapPending = False
+        return True
+
+    # --------------------------------------------------------------------------
+    def update_rtqa_stats(self, volume, index_volume):
+        """ Updates voxelwise running statistics inside the whole-brain mask
+
+        The statistics are updated for every volume, so the maps do not depend on their schedule
+
+        :param volume: current volume as a vector in Fortran order
+        :param index_volume: current volume index
+        """
+
+        np.take(volume, self.wb_indexes, out=self.wb_volume)
+
+        self.snr_stats.update(self.wb_volume)
 
         if not self.input["is_auto_rtqa"]:
-            output_vol, self.volume_data["mean_bas_vol"], self.volume_data["m2_bas_vol"], \
-            self.volume_data["var_bas_vol"], self.volume_data["mean_cond_vol"], self.volume_data["m2_cond_vol"], \
-            self.volume_data["var_cond_vol"] = self.cnr(self.volume_data["mean_bas_vol"],
-                                                        self.volume_data["m2_bas_vol"],
-                                                        self.volume_data["var_bas_vol"],
-                                                        self.volume_data["mean_cond_vol"],
-                                                        self.volume_data["m2_cond_vol"],
-                                                        self.volume_data["var_cond_vol"],
-                                                        volume, self.volume_data["iter_bas"], self.volume_data["iter_cond"], index_volume)
-
-            output_vol[self.input["wb_mask"]] = 0
-            self.output["cnr_vol"] = output_vol.reshape(self.input["dim"], order="F")
-
-            if index_volume in self.indBas:
-                self.volume_data["iter_bas"] += 1
-            if index_volume in self.indCond:
-                self.volume_data["iter_cond"] += 1
+            code = self.cond_code(index_volume)
+            if code & self.BASELINE:
+                self.bas_stats.update(self.wb_volume)
+            if code & self.CONDITION:
+                self.cond_stats.update(self.wb_volume)
+
+    # --------------------------------------------------------------------------
+    def calculate_rtqa_volume(self):
+        """ Computes voxelwise SNR and CNR maps from the running statistics
+
+        The maps are written directly to the shared output, voxels outside of the mask stay zero
+        """
+
+        runningstats.snr(self.snr_stats, self.wb_map)
+        np.put(self.output["snr_vol"].reshape(-1, order="F"), self.wb_indexes, self.wb_map)
+
+        if not self.input["is_auto_rtqa"]:
+            runningstats.cnr(self.bas_stats, self.cond_stats, self.wb_map)
+            np.put(self.output["cnr_vol"].reshape(-1, order="F"), self.wb_indexes, self.wb_map)
 
         self.input["rtqa_vol_ready"] = True
 
     # --------------------------------------------------------------------------
     def calculate_rtqa_ts(self, index_volume):
+        """ Updates time-series metrics of all ROIs for the current volume
+
+        Every ROI is a row of the metric matrices, so each metric column is updated by one vector operation
 
-        for roi in range(self.nrROIs):
-
-            data = self.input["raw_ts"][roi]
-
-            # AR(1) was not applied.
-            self.rSNR[roi, index_volume], \
-            self.rMean[roi, index_volume], \
-            self.m2[roi, index_volume], \
-            self.rVar[roi, index_volume] = self.snr(self.rMean[roi, index_volume - 1],
-                                                              self.m2[roi, index_volume - 1],
-                                                              data, self.blockIter)
-
-            # GLM regressors were estimated for time-series with AR(1) applied
-            if self.input["no_reg_glm_ts"].any():
-                data_noreg = self.input["no_reg_glm_ts"][roi]
-                self.rNoRegSNR[roi, index_volume], self.rNoRegMean[roi, index_volume], \
-                self.noRegM2[roi], \
-                self.rNoRegVar[roi, index_volume] = self.snr(self.rNoRegMean[roi, index_volume - 1],
-                                                             self.noRegM2[roi],
-                                                             data_noreg, self.blockIter)
-
-            if not self.input["is_auto_rtqa"]:
-                self.rCNR[roi, index_volume], self.meanBas[roi, index_volume], \
-                self.m2Bas[roi], self.varBas[roi, index_volume], \
-                self.meanCond[roi, index_volume], self.m2Cond[roi], \
-                self.varCond[roi, index_volume] = self.cnr(self.meanBas[roi, index_volume - 1], self.m2Bas[roi],
-                                                           self.varBas[roi, index_volume-1],
-                                                           self.meanCond[roi, index_volume - 1], self.m2Cond[roi],
-                                                           self.varCond[roi, index_volume-1],
-                                                           data, self.iterBas, self.iterCond,
-                                                           index_volume)
+        :param index_volume: current volume index
+        """
+
+        data = self.sample["raw_ts"]
+
+        # AR(1) was not applied.
+        self.rSNR[:, index_volume], \
+        self.rMean[:, index_volume], \
+        self.m2[:, index_volume], \
+        self.rVar[:, index_volume] = self.snr(self.rMean[:, index_volume - 1],
+                                              self.m2[:, index_volume - 1],
+                                              data, self.blockIter, is_ts=True)
+
+        # GLM regressors were estimated for time-series with AR(1) applied
+        if self.sample["no_reg_glm_ts"] is not None and self.sample["no_reg_glm_ts"].any():
+            data_noreg = self.sample["no_reg_glm_ts"]
+            self.rNoRegSNR[:, index_volume], self.rNoRegMean[:, index_volume], \
+            self.noRegM2[:, 0], \
+            self.rNoRegVar[:, index_volume] = self.snr(self.rNoRegMean[:, index_volume - 1],
+                                                       self.noRegM2[:, 0],
+                                                       data_noreg, self.blockIter, is_ts=True)
+
+        if not self.input["is_auto_rtqa"]:
+            self.rCNR[:, index_volume], self.meanBas[:, index_volume], \
+            self.m2Bas[:, 0], self.varBas[:, index_volume], \
+            self.meanCond[:, index_volume], self.m2Cond[:, 0], \
+            self.varCond[:, index_volume] = self.cnr(self.meanBas[:, index_volume - 1], self.m2Bas[:, 0],
+                                                     self.varBas[:, index_volume - 1],
+                                                     self.meanCond[:, index_volume - 1], self.m2Cond[:, 0],
+                                                     self.varCond[:, index_volume - 1],
+                                                     data, self.iterBas, self.iterCond,
+                                                     index_volume)
 
         self.blockIter += 1
         if not self.input["is_auto_rtqa"]:
-            if index_volume in self.indBas:
+            code = self.cond_code(index_volume)
+            if code & self.BASELINE:
                 self.iterBas += 1
-            if index_volume in self.indCond:
+            if code & self.CONDITION:
                 self.iterCond += 1
 
-        data_glm = self.input["glm_ts"]
-        data_proc = self.input["proc_ts"]
-        data_pos_spikes = self.input["pos_spikes"]
-        data_neg_spikes = self.input["neg_spikes"]
+        data_glm = self.sample["glm_ts"]
+        data_proc = self.sample["proc_ts"]
+        data_pos_spikes = self.sample["pos_spikes"]
+        data_neg_spikes = self.sample["neg_spikes"]
 
         self.calculateSpikes(data_glm, index_volume, data_pos_spikes, data_neg_spikes)
         self.calculateMSE(index_volume, data_glm, data_proc)
 
     # --------------------------------------------------------------------------
-    def snr(self, rMean, m2, data, blockIter):
+    def snr(self, rMean, m2, data, blockIter, is_ts=False):
         """ Recursive SNR calculation
 
         :param rMean: previous mean value of input data
         :param m2: ptrvious squared mean difference of input data
         :param data: input data
         :param blockIter: iteration number
+        :param is_ts: flag of time-series data, SNR is not reported for the first time-series samples
         :return: calculated rSNR, rMean, rM2 and rVariance
         """
 
@@ -302,8 +484,8 @@ class RTQACalculation(mp.Process):
             rSNR = np.zeros(data.shape, order="F")
             blockIter = 1
 
-        if not isinstance(data, np.ndarray) and blockIter < 8:
-            rSNR = 0
+        if is_ts and blockIter < 8:
+            rSNR = np.zeros(data.shape, order="F")
 
         return rSNR, rMean, m2, rVar,
 
@@ -317,7 +499,9 @@ class RTQACalculation(mp.Process):
         :return: calculated rCNR, rMeans, rM2s and rVariances
         """
 
-        if indexVolume in self.indBas:
+        code = self.cond_code(indexVolume)
+
+        if code & self.BASELINE:
             if not iterBas:
                 meanBas = data
                 m2Bas = np.zeros(data.shape, order="F")
@@ -331,7 +515,7 @@ class RTQACalculation(mp.Process):
                 varBas = m2Bas / iterBas
                 iterBas += 1
 
-        if indexVolume in self.indCond:
+        if code & self.CONDITION:
             if not iterCond:
                 meanCond = data
                 m2Cond = np.zeros(data.shape, order="F")
@@ -353,11 +537,11 @@ class RTQACalculation(mp.Process):
 
     # --------------------------------------------------------------------------
     def _di(self, i):
-        return np.array(self.mc_params[i][0:3])
+        return np.array(self.output["mc_params"][i][0:3])
 
     # --------------------------------------------------------------------------
     def _ri(self, i):
-        return np.array(self.mc_params[i][3:6])
+        return np.array(self.output["mc_params"][i][3:6])
 
     # --------------------------------------------------------------------------
     def _ij_FD(self, i, j):  # displacement from i to j
@@ -366,66 +550,59 @@ class RTQACalculation(mp.Process):
 
     # --------------------------------------------------------------------------
     def all_fd(self):
-        i = len(self.mc_params) - 1
+        i = len(self.output["mc_params"]) - 1
 
-        if not self.input["is_new_dcm_block"]:
-            self.FD = np.append(self.FD, self._ij_FD(i - 1, i))
-            self.meanFD = self.meanFD + (self.FD[-1] - self.meanFD) / (self.blockIter + 1)
+        if not self.sample["is_new_dcm_block"]:
+            fd = self._ij_FD(i - 1, i)
+            self.meanFD = self.meanFD + (fd - self.meanFD) / (self.blockIter + 1)
         else:
-            self.FD = np.append(self.FD, 0)
+            fd = 0
             self.meanFD = 0
+        self.output.append("FD", fd)
 
-        if self.FD[-1] >= self.threshold[1]:
+        if fd >= self.threshold[1]:
             self.excFD[0] += 1
+            self.append_index("excFDIndexes_1", i - 1)
 
-            if self.excFDIndexes_1[-1] == -1:
-                self.excFDIndexes_1 = np.array([i - 1])
-            else:
-                self.excFDIndexes_1 = np.append(self.excFDIndexes_1, i - 1)
-
-            if self.FD[-1] >= self.threshold[2]:
+            if fd >= self.threshold[2]:
                 self.excFD[1] += 1
-
-                if self.excFDIndexes_2[-1] == -1:
-                    self.excFDIndexes_2 = np.array([i - 1])
-                else:
-                    self.excFDIndexes_2 = np.append(self.excFDIndexes_2, i - 1)
+                self.append_index("excFDIndexes_2", i - 1)
 
     # --------------------------------------------------------------------------
     def micro_displacement(self):
 
-        n = len(self.mc_params) - 1
+        mc_params = self.output["mc_params"]
+        n = len(mc_params) - 1
         sqDispl = 0
 
-        if not self.input["is_new_dcm_block"]:
+        if not self.sample["is_new_dcm_block"]:
 
             for i in range(3):
-                sqDispl += self.mc_params[n, i] ** 2
+                sqDispl += mc_params[n, i] ** 2
 
-            self.rsqDispl = np.append(self.rsqDispl, np.sqrt(sqDispl))
+            self.rsqDispl[self.nrDispl] = np.sqrt(sqDispl)
+            self.nrDispl += 1
 
-            self.MD = np.append(self.MD, abs(self.rsqDispl[-2] - self.rsqDispl[-1]))
-            self.meanMD = self.meanMD + (self.MD[-1] - self.meanMD) / (self.blockIter + 1)
+            md = abs(self.rsqDispl[self.nrDispl - 2] - self.rsqDispl[self.nrDispl - 1])
+            self.meanMD = self.meanMD + (md - self.meanMD) / (self.blockIter + 1)
 
         else:
-            self.MD = np.append(self.MD, 0)
+            md = 0
             self.meanMD = 0
+        self.output.append("MD", md)
 
-        if self.MD[-1] >= self.threshold[0]:
+        if md >= self.threshold[0]:
             self.excMD += 1
-            if self.excMDIndexes[-1] == -1:
-                self.excMDIndexes = np.array([n - 1])
-            else:
-                self.excMDIndexes = np.append(self.excMDIndexes, n - 1)
+            self.append_index("excMDIndexes", n - 1)
 
     # --------------------------------------------------------------------------
     def calc_mc(self):
 
-        if self.input["iteration"] == 0:
-            self.output["mc_offset"] = self.input["offset_mc"]
-            self.mc_params = self.output["mc_offset"]
+        if self.sample["iteration"] == 0:
+            self.output["mc_offset"] = self.sample["offset_mc"]
+            self.output["mc_params"] = self.output["mc_offset"]
         else:
-            self.mc_params = np.vstack((self.mc_params, self.input["mc_ts"]))
+            self.output.append("mc_params", self.sample["mc_ts"])
         self.micro_displacement()
         self.all_fd()
 
@@ -439,20 +616,12 @@ class RTQACalculation(mp.Process):
         :param negSpikes: flags of negative spikes
         """
 
-        sz, l = data.shape
+        l = data.shape[1]
         self.glmProcTimeSeries[:, indexVolume] = data[:, 0]
 
-        for i in range(sz):
-            if posSpikes[i] == 1:
-                if self.posSpikes[str(i)].any():
-                    self.posSpikes[str(i)] = np.append(self.posSpikes[str(i)], indexVolume)
-                else:
-                    self.posSpikes[str(i)] = np.array([indexVolume])
-            if negSpikes[i] == 1 and l > 2:
-                if self.negSpikes[str(i)].any():
-                    self.negSpikes[str(i)] = np.append(self.negSpikes[str(i)], indexVolume)
-                else:
-                    self.negSpikes[str(i)] = np.array([indexVolume])
+        self.posSpikes[:, indexVolume] |= posSpikes[:, 0] == 1
+        if l > 2:
+            self.negSpikes[:, indexVolume] |= negSpikes[:, 0] == 1
 
     # --------------------------------------------------------------------------
     def calculateMSE(self, indexVolume, inputSignal, outputSignal):
@@ -464,12 +633,10 @@ class RTQACalculation(mp.Process):
 
         """
 
-        sz = inputSignal.size
         n = self.blockIter
 
-        for i in range(sz):
-            self.rMSE[i, indexVolume] = (n / (n + 1)) * self.rMSE[i, indexVolume - 1] + (
-                        (inputSignal[i] - outputSignal[i]) ** 2) / (n + 1)
+        self.rMSE[:, indexVolume] = (n / (n + 1)) * self.rMSE[:, indexVolume - 1] + (
+                    (inputSignal[:, 0] - outputSignal) ** 2) / (n + 1)
 
     # --------------------------------------------------------------------------
     def calculateDVARS(self, volume, index_volume, isNewDCMBlock):
@@ -483,40 +650,33 @@ class RTQACalculation(mp.Process):
         self.prevVol = volume
 
         if index_volume == 0 or isNewDCMBlock:
-            self.DVARS = np.append(self.DVARS, 0)
-        else:
-            self.DVARS = np.append(self.DVARS, dvars_value)
+            dvars_value = 0
+        self.output.append("DVARS", dvars_value)
 
-        if self.DVARS[-1] > config.DEFAULT_DVARS_THRESHOLD:
+        if dvars_value > config.DEFAULT_DVARS_THRESHOLD:
             self.excDVARS = self.excDVARS + 1
 
     # --------------------------------------------------------------------------
     def dataPacking(self):
         """ Packaging of python RTQA data for following save
+
+        Arrays are returned as is, without conversion to Matlab types
+        """
+
+        tsRTQA = {name: self.output[name] for name in ['rMean', 'rVar', 'rSNR', 'rNoRegSNR',
+                                                       'meanBas', 'varBas', 'meanCond', 'varCond', 'rCNR',
+                                                       'excFDIndexes_1', 'excFDIndexes_2', 'excMDIndexes',
+                                                       'FD', 'MD', 'DVARS', 'rMSE']}
+        tsRTQA['snrVol'] = self.output["snr_vol"]
+        tsRTQA['cnrVol'] = self.output["cnr_vol"]
+
+        return tsRTQA
+
+    # --------------------------------------------------------------------------
+    def saveData(self, file_name):
+        """ Saves python RTQA data to MAT-file which is loaded by nfbSave.m
+
+        :param file_name: MAT-file name
         """
 
-        tsRTQA = dict.fromkeys(['rMean', 'rVar', 'rSNR', 'rNoRegSNR',
-                                'meanBas', 'varBas', 'meanCond', 'varCond', 'rCNR',
-                                'excFDIndexes_1', 'excFDIndexes_2', 'excMDIndexes',
-                                'FD', 'MD', 'DVARS', 'rMSE', 'snrVol', 'cnrVol'])
-
-        tsRTQA['rMean'] = matlab.double(self.output["rMean"].tolist())
-        tsRTQA['rVar'] = matlab.double(self.output["rVar"].tolist())
-        tsRTQA['rSNR'] = matlab.double(self.output["rSNR"].tolist())
-        tsRTQA['rNoRegSNR'] = matlab.double(self.output["rNoRegSNR"].tolist())
-        tsRTQA['meanBas'] = matlab.double(self.output["meanBas"].tolist())
-        tsRTQA['varBas'] = matlab.double(self.output["varBas"].tolist())
-        tsRTQA['meanCond'] = matlab.double(self.output["meanCond"].tolist())
-        tsRTQA['varCond'] = matlab.double(self.output["varCond"].tolist())
-        tsRTQA['rCNR'] = matlab.double(self.output["rCNR"].tolist())
-        tsRTQA['excFDIndexes_1'] = matlab.double(self.excFDIndexes_1.tolist())
-        tsRTQA['excFDIndexes_2'] = matlab.double(self.excFDIndexes_2.tolist())
-        tsRTQA['excMDIndexes'] = matlab.double(self.excMDIndexes.tolist())
-        tsRTQA['FD'] = matlab.double(self.output["FD"].tolist())
-        tsRTQA['MD'] = matlab.double(self.output["MD"].tolist())
-        tsRTQA['DVARS'] = matlab.double(self.output["DVARS"].tolist())
-        tsRTQA['rMSE'] = matlab.double(self.output["rMSE"].tolist())
-        tsRTQA['snrVol'] = matlab.double(self.output["snr_vol"].tolist())
-        tsRTQA['cnrVol'] = matlab.double(self.output["cnr_vol"].tolist())
-
-        return tsRTQA
\ No newline at end of file
+        savemat(file_name, self.dataPacking(), appendmat=False, do_compression=False)
\ No newline at end of file
@@ -33,6 +33,10 @@ class RTQAWindow(QtWidgets.QWidget):
         self.musterInfo = input["muster_info"]
         self.motion_names = ['X', 'Y', 'Z', 'Pitch', 'Roll', 'Yaw', 'FD']
         self.init = True
+        # number of volumes that are already drawn
+        self.plottedUpTo = 0
+        # GUI copies of the plotted history by plot name, only columns of new volumes are copied to them
+        self.historyBuffers = {}
 
         if input["is_auto_rtqa"]:
             self.comboBox.model().item(2).setEnabled(False)
@@ -42,6 +46,7 @@ class RTQAWindow(QtWidgets.QWidget):
 
         xrange = rtqa_calc.xrange
         self.xrange = xrange
+        self.plotX = np.arange(1, xrange + 1, dtype=np.float64)
 
         # Additional GUI elements connection and initialization
         groupBoxLayout = self.roiGroupBox.layout()
@@ -276,9 +281,46 @@ class RTQAWindow(QtWidgets.QWidget):
         else:
             self.roiGroupBox.setVisible(True)
 
+        self.invalidatePlots()
         if self.input["is_stopped"] and self.input["iteration"] != 1:
             self.plotRTQA()
 
+    # --------------------------------------------------------------------------
+    def invalidatePlots(self):
+        """ Makes the next plotRTQA call recreate the plots even if no new volume was calculated,
+        it is called when the shown plot or the set of selected ROIs is changed
+        """
+
+        self.plottedUpTo = 0
+        self.init = True
+
+    # --------------------------------------------------------------------------
+    def historyBuffer(self, key, names, rows, n):
+        """ Returns the GUI copy of the history of selected ROIs
+
+        The buffer is preallocated for all volumes, only the columns of volumes calculated
+        since the previous call are copied from the shared output
+
+        :param key: buffer name
+        :param names: names of ROIs x volumes matrices of the output, their selected rows are stacked
+        :param rows: indexes of selected ROIs
+        :param n: number of valid volumes
+        :return: view of the first n columns of the buffer
+        """
+
+        rows = np.asarray(rows, dtype=int)
+        buffer = self.historyBuffers.get(key)
+        if buffer is None or not np.array_equal(buffer["rows"], rows) or n < buffer["n"]:
+            buffer = {"rows": rows, "n": 0, "data": np.zeros((len(names) * rows.size, self.xrange))}
+            self.historyBuffers[key] = buffer
+
+        data, start = buffer["data"], buffer["n"]
+        for i, name in enumerate(names):
+            data[i * rows.size:(i + 1) * rows.size, start:n] = self.output[name][rows, start:n]
+        buffer["n"] = n
+
+        return data[:, :n]
+
     # --------------------------------------------------------------------------
     def onRadioButtonStateChanged(self):
         """ FD and MD mode change. Mode changing switch plots and plot title
@@ -325,7 +367,7 @@ class RTQAWindow(QtWidgets.QWidget):
 
     # --------------------------------------------------------------------------
     def roiChecked(self):
-        """ Redrawing plots when the set of selected ROIs is changed even if run is stopped
+        """ Shows labels of the selected ROIs, plots are recreated by invalidatePlots
         """
 
         for i in range(len(self.selectedRoiLabels)):
@@ -334,8 +376,6 @@ class RTQAWindow(QtWidgets.QWidget):
             else:
                 self.selectedRoiLabels[i].setVisible(False)
 
-        self.init = True
-
     # --------------------------------------------------------------------------
     def computeMusterPlotData(self, ylim):
         singleY = np.array([ylim[0], ylim[1], ylim[1], ylim[0]])
@@ -407,7 +447,7 @@ class RTQAWindow(QtWidgets.QWidget):
 
             sz, l = data.shape
 
-            if init:
+            if init or plotitem not in self.plotTs.__dict__:
 
                 plotitem.clear()
                 plots = []
@@ -422,11 +462,11 @@ class RTQAWindow(QtWidgets.QWidget):
 
                 self.plotTs.__dict__[plotitem] = plots, muster
 
-            x = np.arange(1, l + 1, dtype=np.float64)
+            x = self.plotX[:l]
 
             plotitems = self.plotTs.__dict__[plotitem][0]
             for p, y in zip(plotitems, data):
-                p.setData(x=x, y=np.array(y))
+                p.setData(x=x, y=y)
 
             items = plotitem.listDataItems()
 
@@ -447,7 +487,13 @@ class RTQAWindow(QtWidgets.QWidget):
 
         if self.input["calc_ready"]:
 
-            n = self.input["iteration"]
+            # metrics are computed in place in the shared history buffers,
+            # only the volumes up to the valid counter are complete
+            n = self.output["valid_up_to"]
+            if n == self.plottedUpTo and not self.input["is_stopped"]:
+                return
+            self.plottedUpTo = n
+
             self.roiChecked()
             checkedBoxesInd = self.input["roi_checked"]
             sz = self.nrROIs
@@ -459,7 +505,7 @@ class RTQAWindow(QtWidgets.QWidget):
 
                 # SNR plot
                 plotitem = self.snrPlot.getPlotItem()
-                data = self.output["rSNR"][checkedBoxesInd, 0:n]
+                data = self.historyBuffer("rSNR", ["rSNR"], checkedBoxesInd, n)
                 self.plotTs(self.init, plotitem, data, checkedBoxesInd)
 
                 names = ['SNR ']
@@ -506,14 +552,12 @@ class RTQAWindow(QtWidgets.QWidget):
             elif current_menu == 2:
 
                 plotitem = self.cnrPlot.getPlotItem()
-                data = self.output["rCNR"][checkedBoxesInd, 0:n]
+                data = self.historyBuffer("rCNR", ["rCNR"], checkedBoxesInd, n)
                 self.plotTs(self.init, plotitem, data, checkedBoxesInd)
 
                 # Means plot
                 plotitem = self.meanPlot.getPlotItem()
-                data = np.append(self.output["rMean"][checkedBoxesInd, 0:n],
-                                 self.output["meanBas"][checkedBoxesInd, 0:n], axis=0)
-                data = np.append(data, self.output["meanCond"][checkedBoxesInd, 0:n], axis=0)
+                data = self.historyBuffer("means", ["rMean", "meanBas", "meanCond"], checkedBoxesInd, n)
                 color = np.array(config.ROI_PLOT_COLORS)[checkedBoxesInd]
                 color = np.append(color, np.array(config.ROI_PLOT_COLORS)[checkedBoxesInd])
                 color = np.append(color, np.array(config.ROI_PLOT_COLORS)[checkedBoxesInd])
@@ -522,9 +566,7 @@ class RTQAWindow(QtWidgets.QWidget):
 
                 # Variances plot
                 plotitem = self.varPlot.getPlotItem()
-                data = np.append(self.output["rVar"][checkedBoxesInd, 0:n],
-                                 self.output["varBas"][checkedBoxesInd, 0:n], axis=0)
-                data = np.append(data, self.output["varCond"][checkedBoxesInd, 0:n], axis=0)
+                data = self.historyBuffer("vars", ["rVar", "varBas", "varCond"], checkedBoxesInd, n)
                 self.plotStatValues(self.init, plotitem, data, color, style)
 
                 names = ['СNR ']
@@ -549,18 +591,14 @@ class RTQAWindow(QtWidgets.QWidget):
 
                 # Spikes plot
                 plotitem = self.spikesPlot.getPlotItem()
-                data = self.output["glmProcTimeSeries"][checkedBoxesInd, 0:n]
+                data = self.historyBuffer("glmProcTimeSeries", ["glmProcTimeSeries"], checkedBoxesInd, n)
                 self.plotSpikes(self.init, plotitem, data, checkedBoxesInd)
 
                 # Spikes labels
-                cnt = 0
-                for i in range(sz):
-                    cnt = cnt + np.count_nonzero(self.output["posSpikes"][str(i)])
+                cnt = np.count_nonzero(self.output["posSpikes"])
                 names = ['( Circles ) <br>Positive spikes: ' + str(int(cnt))]
 
-                cnt = 0
-                for i in range(sz):
-                    cnt = cnt + np.count_nonzero(self.output["negSpikes"][str(i)])
+                cnt = np.count_nonzero(self.output["negSpikes"])
                 names.append('<br>( Diamonds )<br>Negative spikes: ' + str(int(cnt)))
                 pens = [config.PLOT_PEN_COLORS[6],
                         config.PLOT_PEN_COLORS[6]]
@@ -570,7 +608,7 @@ class RTQAWindow(QtWidgets.QWidget):
 
                 # Kalman filter MSE plot
                 plotitem = self.msePlot.getPlotItem()
-                data = self.output["rMSE"][checkedBoxesInd, 0:n]
+                data = self.historyBuffer("rMSE", ["rMSE"], checkedBoxesInd, n)
                 self.plotTs(self.init, plotitem, data, checkedBoxesInd)
 
                 # MSE label
@@ -590,7 +628,7 @@ class RTQAWindow(QtWidgets.QWidget):
 
                 # Linear trend coefficients plot
                 plotitem = self.trendPlot.getPlotItem()
-                data = self.output["linTrendCoeff"][checkedBoxesInd, 0:n]
+                data = self.historyBuffer("linTrendCoeff", ["linTrendCoeff"], checkedBoxesInd, n)
                 self.plotTs(self.init, plotitem, data, checkedBoxesInd)
 
                 # Linear trend labels
@@ -610,7 +648,7 @@ class RTQAWindow(QtWidgets.QWidget):
 
                 # No regulation SNR plot
                 plotitem = self.noRegSnrPlot.getPlotItem()
-                data = self.output["rNoRegSNR"][checkedBoxesInd, 0:n]
+                data = self.historyBuffer("rNoRegSNR", ["rNoRegSNR"], checkedBoxesInd, n)
                 self.plotTs(self.init, plotitem, data, checkedBoxesInd)
 
                 # No regulation SNR label
@@ -663,7 +701,7 @@ class RTQAWindow(QtWidgets.QWidget):
 
             sz, l = data.shape
 
-            if init:
+            if init or plotitem not in self.plotStatValues.__dict__:
 
                 plotitem.clear()
                 plots = []
@@ -677,16 +715,16 @@ class RTQAWindow(QtWidgets.QWidget):
                     p = plotitem.plot(pen=pen)
                     plots.append(p)
 
-                self.plotTs.__dict__[plotitem] = plots, muster
+                self.plotStatValues.__dict__[plotitem] = plots, muster
 
-            x = np.arange(1, l + 1, dtype=np.float64)
+            x = self.plotX[:l]
 
-            for p, y in zip(self.plotTs.__dict__[plotitem][0], data):
-                p.setData(x=x, y=np.array(y))
+            for p, y in zip(self.plotStatValues.__dict__[plotitem][0], data):
+                p.setData(x=x, y=y)
 
             items = plotitem.listDataItems()
 
-            for m in self.plotTs.__dict__[plotitem][1]:
+            for m in self.plotStatValues.__dict__[plotitem][1]:
                 items.remove(m)
 
             if data.any():
@@ -704,41 +742,47 @@ class RTQAWindow(QtWidgets.QWidget):
 
         # First part - line drawing
         sz, l = data.shape
-        x = np.arange(1, l + 1, dtype=np.float64)
+        x = self.plotX[:l]
 
-        if init:
+        if init or plotitem not in self.plotSpikes.__dict__:
             plotitem.clear()
-            plots = []
+            lines = []
 
             muster = self.drawMusterPlot(plotitem)
 
             for i, c in zip(range(sz), np.array(config.ROI_PLOT_COLORS)[checkedBoxesInd]):
                 pen = pg.mkPen(color=c, width=config.ROI_PLOT_WIDTH)
                 p = plotitem.plot(pen=pen)
-                plots.append(p)
+                lines.append(p)
+
+            self.plotSpikes.__dict__[plotitem] = lines, muster, []
 
-            self.plotSpikes.__dict__[plotitem] = plots, muster
+        lines, muster, plots = self.plotSpikes.__dict__[plotitem]
+        for p, y in zip(lines, data):
+            p.setData(x=x, y=y)
 
-        plots = self.plotSpikes.__dict__[plotitem][0]
-        for p, y in zip(plots, data):
-            p.setData(x=x, y=np.array(y))
+        # spike markers are recreated for every update
+        for p in plots:
+            plotitem.removeItem(p)
+        plots.clear()
 
         # Second part - spikes marking
         for i, c in zip(range(sz), np.array(config.ROI_PLOT_COLORS)[checkedBoxesInd]):
 
             roiInd = checkedBoxesInd[i]
-            if self.output["posSpikes"][str(roiInd)].any():
+            posInds = np.flatnonzero(self.output["posSpikes"][roiInd])
+            if posInds.size > 0:
                 brush = pg.mkBrush(color=c)
                 p = plotitem.scatterPlot(symbol='o', size=20, brush=brush)
                 plots.append(p)
-                plots[-1].setData(x=self.output["posSpikes"][str(roiInd)] + 1,
-                                  y=self.output["glmProcTimeSeries"][roiInd, self.output["posSpikes"][str(roiInd)]])
+                plots[-1].setData(x=posInds + 1,
+                                  y=self.output["glmProcTimeSeries"][roiInd, posInds])
 
                 pen = pg.mkPen(color=pg.mkColor(0, 0, 0), width=1.5 * config.ROI_PLOT_WIDTH)
                 p = plotitem.plot(pen=pen)
                 plots.append(p)
 
-                inds = self.output["posSpikes"][str(roiInd)]
+                inds = posInds
                 indX = np.array(list(itertools.chain.from_iterable(zip(inds, inds + 1))))
                 indY = np.array(list(itertools.chain.from_iterable(zip(inds - 1, inds))))
 
@@ -747,18 +791,19 @@ class RTQAWindow(QtWidgets.QWidget):
 
                 plots[-1].setData(x=x1, y=y, connect='pairs')
 
-            if self.output["negSpikes"][str(roiInd)].any():
+            negInds = np.flatnonzero(self.output["negSpikes"][roiInd])
+            if negInds.size > 0:
                 brush = pg.mkBrush(color=c)
                 p = plotitem.scatterPlot(symbol='d', size=20, brush=brush)
                 plots.append(p)
-                plots[-1].setData(x=self.output["negSpikes"][str(roiInd)] + 1,
-                                  y=self.output["glmProcTimeSeries"][roiInd, self.output["negSpikes"][str(roiInd)]])
+                plots[-1].setData(x=negInds + 1,
+                                  y=self.output["glmProcTimeSeries"][roiInd, negInds])
 
                 pen = pg.mkPen(color=pg.mkColor(0, 0, 0), width=1.5 * config.ROI_PLOT_WIDTH)
                 p = plotitem.plot(pen=pen)
                 plots.append(p)
 
-                inds = self.output["negSpikes"][str(roiInd)]
+                inds = negInds
                 indX = np.array(list(itertools.chain.from_iterable(zip(inds, inds + 1))))
                 indY = np.array(list(itertools.chain.from_iterable(zip(inds - 1, inds))))
 
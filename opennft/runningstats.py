@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""
+Voxelwise running statistics for real-time quality assessment
+
+Mean, squared mean difference (M2) and variance are updated recursively
+(Welford's method) in preallocated buffers, so an update does not allocate
+memory. The recursion is the same as in `RTQACalculation.snr`, with float64
+buffers the results are identical.
+
+__________________________________________________________________________
+Copyright (C) 2016-2021 OpenNFT.org
+
+"""
+
+import numpy as np
+
+__all__ = ['RunningStats', 'snr', 'cnr']
+
+
+class RunningStats:
+    """Running mean and variance of a fixed number of voxels
+
+    :param size: number of voxels
+    :param dtype: data type of the statistics buffers
+    """
+
+    def __init__(self, size: int, dtype=np.float64):
+        self.mean = np.zeros((size,), dtype=dtype)
+        self.m2 = np.zeros((size,), dtype=dtype)
+        self.var = np.zeros((size,), dtype=dtype)
+        self.count = 0
+
+        self._delta = np.empty((size,), dtype=dtype)
+        self._tmp = np.empty((size,), dtype=dtype)
+
+    def reset(self):
+        """Starts the statistics anew, the next update initializes the mean
+        """
+        self.count = 0
+
+    def update(self, data: np.ndarray):
+        """Adds the next sample of all voxels
+
+        :param data: voxel values, it has the size of the statistics
+        """
+        if not self.count:
+            np.copyto(self.mean, data, casting='same_kind')
+            self.m2.fill(0)
+            self.var.fill(0)
+        else:
+            delta, tmp = self._delta, self._tmp
+
+            # mean = mean + (data - mean) / (n + 1)
+            np.subtract(data, self.mean, out=delta, casting='same_kind')
+            np.divide(delta, self.count + 1, out=tmp)
+            np.add(self.mean, tmp, out=self.mean)
+
+            # m2 = m2 + (data - prevMean) * (data - mean), var = m2 / n
+            np.subtract(data, self.mean, out=tmp, casting='same_kind')
+            np.multiply(delta, tmp, out=tmp)
+            np.add(self.m2, tmp, out=self.m2)
+            np.divide(self.m2, self.count, out=self.var)
+
+        self.count += 1
+
+
+def snr(stats: RunningStats, out: np.ndarray) -> np.ndarray:
+    """Computes SNR of the running statistics
+
+    :param stats: voxelwise statistics
+    :param out: array for the result
+    :return: out, zeros until the variance is estimated
+    """
+    if stats.count < 2:
+        out.fill(0)
+    else:
+        np.sqrt(stats.var, out=out)
+        np.divide(stats.mean, out, out=out)
+    return out
+
+
+def cnr(bas: RunningStats, cond: RunningStats, out: np.ndarray) -> np.ndarray:
+    """Computes CNR of condition against baseline running statistics
+
+    :param bas: voxelwise statistics of baseline volumes
+    :param cond: voxelwise statistics of condition volumes
+    :param out: array for the result
+    :return: out, zeros until the first condition volume
+    """
+    if not cond.count:
+        out.fill(0)
+    else:
+        np.add(cond.var, bas.var, out=out)
+        np.sqrt(out, out=out)
+        np.subtract(cond.mean, bas.mean, out=bas._tmp)
+        np.divide(bas._tmp, out, out=out)
+    return out
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fixed-schema shared state for OpenNFT worker processes
+
+The state replaces `multiprocessing.Manager().dict()` proxies for the data
+exchange between the GUI and the view formation and rtQA processes.
+Numeric fields live in one shared memory block and are read and written
+in place, flags and counters live in a small control block, and a few small
+Python objects (thresholds, ROI contours) are pickled into fixed-capacity
+slots. Images produced for display are triple-buffered frames with a frame
+id, so a reader can skip unchanged images and keep a zero-copy view of the
+last frame while the writer prepares the next one. Request flags are backed
+by events, so worker processes can block until new work arrives instead of
+polling. Static setup parameters are transferred once at process start.
+
+__________________________________________________________________________
+Copyright (C) 2016-2021 OpenNFT.org
+
+"""
+
+import pickle
+import typing as t
+import multiprocessing as mp
+
+import numpy as np
+
+__all__ = ['Array', 'Frame', 'Object', 'SharedState']
+
+_ALIGNMENT = 64
+
+# frame control slots: frame id, writer/middle/reader buffer indexes,
+# middle buffer is fresh, dropped frames, per buffer presence and frame id
+_FRAME_ID, _FRAME_WRITER, _FRAME_MIDDLE, _FRAME_READER, _FRAME_FRESH, _FRAME_DROPPED = range(6)
+_FRAME_PRESENT = 6
+_FRAME_BUFFER_ID = 9
+_FRAME_CONTROLS = 12
+
+
+class Array:
+    """Numeric field of the shared state schema
+
+    :param shape: array shape, the first axis is the capacity for growable arrays
+    :param dtype: array data type
+    :param order: memory layout of the array ('C' or 'F')
+    :param growable: array is filled along the first axis, readers get the filled part only
+    :param optional: array reads as None until it is written for the first time
+    """
+
+    def __init__(self, shape, dtype=np.float64, order: str = 'C',
+                 growable: bool = False, optional: bool = False):
+        self.shape = tuple(int(s) for s in np.atleast_1d(shape))
+        self.dtype = np.dtype(dtype)
+        self.order = order
+        self.growable = growable
+        self.optional = optional
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+
+class Frame:
+    """Image field of the shared state schema which is published as frames
+
+    The frame is triple-buffered: the writer fills its own buffer and publishes
+    it, the reader takes the last published buffer and keeps it until it takes
+    the next one. A published frame which is replaced before the reader takes it
+    is dropped. A frame can be None.
+
+    :param shape: image shape
+    :param dtype: image data type
+    :param order: memory layout of the image ('C' or 'F')
+    """
+
+    def __init__(self, shape, dtype=np.float64, order: str = 'C'):
+        self.shape = tuple(int(s) for s in np.atleast_1d(shape))
+        self.dtype = np.dtype(dtype)
+        self.order = order
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+
+class Object:
+    """Small Python object field of the shared state schema
+
+    :param default: initial value
+    :param capacity: maximal size of the pickled value in bytes
+    """
+
+    def __init__(self, default=None, capacity: int = 4096):
+        self.default = default
+        self.capacity = int(capacity)
+
+
+class SharedState:
+    """Shared state with a fixed schema
+
+    The state is created in the parent process and is transferred to the worker
+    process as an attribute of `multiprocessing.Process`. Item access works like for
+    a dict: array fields return numpy views on the shared memory, control fields
+    return Python scalars, object fields return unpickled copies and params return
+    the values given at creation. Frame fields return a read-only view of the last
+    published frame, see `take`.
+
+    :param arrays: numeric fields, name -> `Array`
+    :param controls: flags and counters, name -> default value (bool, int or float)
+    :param objects: small Python objects, name -> `Object`
+    :param params: static parameters which are not changed after process start
+    :param events: request flags which can be waited for, name -> initial value
+    :param frames: images published as frames, name -> `Frame`
+    """
+
+    def __init__(self,
+                 arrays: t.Optional[t.Dict[str, Array]] = None,
+                 controls: t.Optional[t.Dict[str, t.Union[bool, int, float]]] = None,
+                 objects: t.Optional[t.Dict[str, Object]] = None,
+                 params: t.Optional[dict] = None,
+                 events: t.Optional[t.Dict[str, bool]] = None,
+                 frames: t.Optional[t.Dict[str, Frame]] = None):
+
+        self._arrays = dict(arrays or {})
+        self._frames = dict(frames or {})
+        self._objects = dict(objects or {})
+        self._params = dict(params or {})
+
+        controls = dict(controls or {})
+        events = dict(events or {})
+
+        names = (list(self._arrays) + list(controls) + list(self._objects)
+                 + list(self._params) + list(events) + list(self._frames))
+        if len(names) != len(set(names)):
+            raise ValueError('Field names of shared state must be unique')
+
+        # control block layout: user flags and counters followed by
+        # fill markers of arrays, lengths and versions of pickled objects
+        # and frame controls
+        self._controls = {}
+        for i, (name, value) in enumerate(controls.items()):
+            self._controls[name] = (i, type(value))
+        size = len(self._controls)
+        self._marks = {}
+        for name in list(self._arrays) + list(self._objects):
+            self._marks[name] = size
+            size += 1
+        self._versions = {}
+        for name in self._objects:
+            self._versions[name] = size
+            size += 1
+        self._frame_controls = {}
+        for name in self._frames:
+            self._frame_controls[name] = size
+            size += _FRAME_CONTROLS
+
+        self._control_block = mp.RawArray('d', max(size, 1))
+
+        self._offsets = {}
+        size = 0
+        for name, field in self._arrays.items():
+            self._offsets[name] = size
+            size += -(-field.nbytes // _ALIGNMENT) * _ALIGNMENT
+        for name, field in self._frames.items():
+            self._offsets[name] = size
+            size += 3 * (-(-field.nbytes // _ALIGNMENT) * _ALIGNMENT)
+        self._array_block = mp.RawArray('B', max(size, 1))
+
+        self._object_blocks = {name: mp.RawArray('B', field.capacity) for name, field in self._objects.items()}
+
+        self._events = {name: mp.Event() for name in events}
+
+        self._lock = mp.RLock()
+        self._make_views()
+
+        for name, value in controls.items():
+            self[name] = value
+        for name, field in self._arrays.items():
+            if not (field.growable or field.optional):
+                self._control[self._marks[name]] = 1
+        for name, field in self._objects.items():
+            self[name] = field.default
+        for name, value in events.items():
+            self[name] = value
+        for name in self._frames:
+            base = self._frame_controls[name]
+            self._control[base + _FRAME_WRITER] = 0
+            self._control[base + _FRAME_MIDDLE] = 1
+            self._control[base + _FRAME_READER] = 2
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_control']
+        del state['_views']
+        del state['_frame_views']
+        del state['_object_views']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_views()
+
+    def _make_views(self):
+        self._control = np.frombuffer(self._control_block, dtype=np.float64)
+
+        buffer = np.frombuffer(self._array_block, dtype=np.uint8)
+        self._views = {}
+        for name, field in self._arrays.items():
+            offset = self._offsets[name]
+            data = buffer[offset:offset + field.nbytes].view(field.dtype)
+            self._views[name] = data.reshape(field.shape, order=field.order)
+
+        self._frame_views = {}
+        for name, field in self._frames.items():
+            offset = self._offsets[name]
+            stride = -(-field.nbytes // _ALIGNMENT) * _ALIGNMENT
+            self._frame_views[name] = [
+                buffer[offset + i * stride:offset + i * stride + field.nbytes].view(field.dtype).reshape(
+                    field.shape, order=field.order)
+                for i in range(3)
+            ]
+
+        self._object_views = {name: np.frombuffer(block, dtype=np.uint8)
+                              for name, block in self._object_blocks.items()}
+
+    @property
+    def lock(self):
+        """Lock for consistent multi-field updates and reads
+        """
+        return self._lock
+
+    def __contains__(self, name) -> bool:
+        return (name in self._controls or name in self._arrays or name in self._objects
+                or name in self._params or name in self._events or name in self._frames)
+
+    def version(self, name) -> int:
+        """Returns id of the last published frame or number of writes of an object
+
+        The value is read without locking, it is cheap enough to be polled.
+
+        :param name: frame or object field name
+        """
+        if name in self._frames:
+            return int(self._control[self._frame_controls[name] + _FRAME_ID])
+        return int(self._control[self._versions[name]])
+
+    def dropped(self, name) -> int:
+        """Returns number of frames which were replaced before the reader took them
+
+        :param name: frame field name
+        """
+        return int(self._control[self._frame_controls[name] + _FRAME_DROPPED])
+
+    def take(self, name) -> t.Tuple[int, t.Any]:
+        """Takes the last published frame or the current object value
+
+        The frame is returned as a read-only view which stays valid until the
+        next `take` of the same field, the writer never writes to it meanwhile.
+        Only one process may take frames of a field.
+
+        :param name: frame or object field name
+        :return: frame id (object version) and the frame (object value)
+        """
+        if name in self._objects:
+            with self._lock:
+                return self.version(name), self[name]
+
+        base = self._frame_controls[name]
+        control = self._control
+
+        with self._lock:
+            if control[base + _FRAME_FRESH]:
+                control[base + _FRAME_READER], control[base + _FRAME_MIDDLE] = \
+                    control[base + _FRAME_MIDDLE], control[base + _FRAME_READER]
+                control[base + _FRAME_FRESH] = 0
+            reader = int(control[base + _FRAME_READER])
+            frame_id = int(control[base + _FRAME_BUFFER_ID + reader])
+            present = control[base + _FRAME_PRESENT + reader]
+
+        if not present:
+            return frame_id, None
+
+        view = self._frame_views[name][reader].view()
+        view.flags.writeable = False
+        return frame_id, view
+
+    def _publish(self, name, value):
+        base = self._frame_controls[name]
+        control = self._control
+
+        writer = int(control[base + _FRAME_WRITER])
+        if value is None:
+            control[base + _FRAME_PRESENT + writer] = 0
+        else:
+            self._frame_views[name][writer][...] = value
+            control[base + _FRAME_PRESENT + writer] = 1
+
+        with self._lock:
+            frame_id = control[base + _FRAME_ID] + 1
+            control[base + _FRAME_BUFFER_ID + writer] = frame_id
+            if control[base + _FRAME_FRESH]:
+                control[base + _FRAME_DROPPED] += 1
+            control[base + _FRAME_WRITER] = control[base + _FRAME_MIDDLE]
+            control[base + _FRAME_MIDDLE] = writer
+            control[base + _FRAME_FRESH] = 1
+            control[base + _FRAME_ID] = frame_id
+
+    def wait(self, name, timeout: t.Optional[float] = None) -> bool:
+        """Blocks until the request flag is set
+
+        :param name: event field name
+        :param timeout: timeout in seconds, None to wait forever
+        :return: the flag value, False if the timeout is expired
+        """
+        return self._events[name].wait(timeout)
+
+    def __getitem__(self, name):
+        if name in self._controls:
+            index, kind = self._controls[name]
+            return kind(self._control[index])
+
+        if name in self._arrays:
+            field = self._arrays[name]
+            mark = int(self._control[self._marks[name]])
+            if field.growable:
+                return self._views[name][:mark]
+            if field.optional and not mark:
+                return None
+            return self._views[name]
+
+        if name in self._events:
+            return self._events[name].is_set()
+
+        if name in self._frames:
+            return self.take(name)[1]
+
+        if name in self._objects:
+            with self._lock:
+                size = int(self._control[self._marks[name]])
+                data = self._object_views[name][:size].tobytes()
+            return pickle.loads(data)
+
+        return self._params[name]
+
+    def __setitem__(self, name, value):
+        if name in self._controls:
+            self._control[self._controls[name][0]] = value
+            return
+
+        if name in self._arrays:
+            field = self._arrays[name]
+            mark = self._marks[name]
+
+            if value is None:
+                if not field.optional:
+                    raise ValueError('Shared array "{}" is not optional'.format(name))
+                self._control[mark] = 0
+                return
+
+            if field.growable:
+                value = np.asarray(value)
+                size = value.shape[0] if value.ndim else 1
+                if size > field.shape[0]:
+                    raise ValueError('Shared array "{}" capacity {} is exceeded'.format(name, field.shape[0]))
+                self._views[name][:size] = value
+                self._control[mark] = size
+            else:
+                self._views[name][...] = value
+                self._control[mark] = 1
+            return
+
+        if name in self._objects:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(data) > self._objects[name].capacity:
+                raise ValueError('Shared object "{}" capacity {} is exceeded'.format(
+                    name, self._objects[name].capacity))
+            with self._lock:
+                self._object_views[name][:len(data)] = np.frombuffer(data, dtype=np.uint8)
+                self._control[self._marks[name]] = len(data)
+                self._control[self._versions[name]] += 1
+            return
+
+        if name in self._frames:
+            self._publish(name, value)
+            return
+
+        if name in self._events:
+            if value:
+                self._events[name].set()
+            else:
+                self._events[name].clear()
+            return
+
+        raise KeyError('"{}" is not a writable field of the shared state'.format(name))
+
+    def append(self, name, value):
+        """Appends one sample to a growable array in place
+
+        The sample is written after the filled part, then the fill marker is
+        moved, so readers never see a partially written sample.
+
+        :param name: growable array field name
+        :param value: sample, it has the shape of the array without the first axis
+        """
+        field = self._arrays[name]
+        mark = self._marks[name]
+        size = int(self._control[mark])
+
+        if size >= field.shape[0]:
+            raise ValueError('Shared array "{}" capacity {} is exceeded'.format(name, field.shape[0]))
+        self._views[name][size] = value
+        self._control[mark] = size + 1
+
+    def copy(self, name):
+        """Returns a copy of the field value which is safe to keep
+        """
+        value = self[name]
+        if isinstance(value, np.ndarray):
+            return np.array(value, order='K')
+        return value
@@ -3,20 +3,65 @@ import multiprocessing as mp
 import nibabel as nib
 import cv2
 import pydicom
-from scipy import linalg
-from rtspm import spm_imatrix, spm_matrix, spm_slice_vol
-from opennft.conversions import img2d_vol3d, vol3d_img2d, get_mosaic_dim
+from rtspm import spm_imatrix, spm_matrix
+from opennft.conversions import img2d_vol3d, get_mosaic_dim, MosaicLayout
+from opennft import sharedstate, mappedvolume, planesampler
 from opennft.mapimagewidget import MapImageThresholdsCalculator, RgbaMapImage, Thresholds
 
 
+# reserved size of pickled ROI contours per ROI and per plane
+ROI_CONTOURS_CAPACITY = 1 << 16
+
+# data type of background volumes of the orthogonal view
+BACKGROUND_DTYPE = np.float32
+
+# view space axis crossed by the transversal, coronal and sagittal planes
+ROI_PLANE_AXES = {'t': 2, 'c': 1, 's': 0}
+
+
+def load_nifti_volume(filename):
+    """Loads NIfTI volume as float32 Fortran-ordered array
+
+    The file is memory mapped if it is uncompressed float32 without scaling,
+    otherwise the data are read and converted.
+
+    :param filename: NIfTI file name
+    :return: volume and its affine matrix
+    """
+    img = nib.load(filename, mmap=True)
+    volume = np.asanyarray(img.dataobj)
+    if volume.dtype != BACKGROUND_DTYPE or not volume.flags.f_contiguous:
+        volume = np.asfortranarray(volume, dtype=BACKGROUND_DTYPE)
+    return volume, img.affine
+
+
+def to_uint8(img, out=None):
+    """Converts the image scaled to [0, 255] to uint8, the GUI shows it with fixed levels (0, 255)
+
+    :param img: float image, it is modified
+    :param out: uint8 image for the result, a new one is allocated if it is not given
+    """
+    img = np.nan_to_num(img, copy=False)
+    np.clip(img, 0, 255, out=img)
+    if out is None:
+        return img.astype(np.uint8)
+    np.copyto(out, img, casting='unsafe')
+    return out
+
+
+def volume_range(volume):
+    """Returns minimum and maximum of volume values ignoring NaNs
+    """
+    return float(np.nanmin(volume)), float(np.nanmax(volume))
+
+
 class VolViewFormation(mp.Process):
 
-    def __init__(self, input, output):
+    def __init__(self, input):
         mp.Process.__init__(self)
         self.str_param = dict([])
 
         self.input_data = input
-        self.output_data = output
 
         self.thr_calculator = MapImageThresholdsCalculator(no_value=0.0)
         self.pos_image = RgbaMapImage(colormap='hot', no_value=0.0)
@@ -25,186 +70,356 @@ class VolViewFormation(mp.Process):
         self.mat_epi = self.input_data["mat"]
         self.dim = self.input_data["dim"]
 
-        self.xdim, self.ydim, self.img2d_dimx, self.img2d_dimy = get_mosaic_dim(self.dim)
-        self.output_data["mosaic_templ"] = np.zeros((self.img2d_dimx, self.img2d_dimy))
-        self.output_data["mosaic_pos_overlay"] = None
-        self.output_data["mosaic_neg_overlay"] = None
-
-        if not (self.input_data["anat_volume"] is None):
-            anat_name = self.input_data["anat_volume"]
-            anat_data = nib.load(anat_name, mmap=False)
-            self.anat_volume = np.array(anat_data.get_fdata(), order="F")
-            self.mat_anat = anat_data.affine
-
-        epi_name = self.input_data["epi_volume"]
-
-        if self.input_data["epi_volume_type"] == "nii":
-            self.epi_volume = np.array(nib.load(epi_name, mmap=False).get_fdata(), order="F")
-        else:
-            epi_volume = np.array(pydicom.dcmread(epi_name).pixel_array, order='F')
-            if epi_volume.ndim == 2:
-                xdim_img_number, ydim_img_number, img2d_dimx, img2d_dimy = get_mosaic_dim(self.dim)
-                self.epi_volume = np.array(img2d_vol3d(epi_volume, xdim_img_number, ydim_img_number, self.dim), order='F')
-            else:
-                self.epi_volume = epi_volume
+        self.mosaic_layout = MosaicLayout(self.dim, self.input_data["mosaic_slice_stride"],
+                                          self.input_data["mosaic_downsample"])
 
+        # background volumes are loaded in the worker process by load_background_volumes
+        self.anat_volume = None
+        self.mat_anat = None
+        self.epi_volume = None
+        self.back_ranges = {}
 
         # ROIs
         if self.input_data["is_ROI"]:
-            self.ROI_vols = np.array(self.input_data["ROI_vols"], order='F')
+            self.ROI_indexes = self.input_data["ROI_indexes"]
             self.ROI_mats = np.array(self.input_data["ROI_mats"], order='F')
         else:
-            self.ROI_vols = []
+            self.ROI_indexes = []
             self.ROI_mats = []
 
         self.prepare_orth_view(self.mat_epi, self.dim)
 
-    def run(self):
-
-        np.seterr(divide='ignore', invalid='ignore')
-
-        while not self.input_data["is_stopped"]:
+        self.output_data = self.create_output_state()
 
-            ready = self.input_data["ready"]
-            
-            if ready:
+    def load_background_volumes(self):
+        """Loads the anatomical and EPI template volumes and their value ranges
 
-                if self.input_data["view_mode"] == 0:
+        It is called in the worker process, so the volumes are not pickled at process start.
+        """
+        if self.input_data["anat_volume"] is not None:
+            self.anat_volume, self.mat_anat = load_nifti_volume(self.input_data["anat_volume"])
+            self.back_ranges["BgStruct"] = volume_range(self.anat_volume)
 
-                    img_vol = np.array(np.memmap(self.input_data["memmap_volume"], dtype=np.float64, shape=self.dim, order='F'))
-                    max_vol = np.max(img_vol)
-                    min_vol = np.min(img_vol)
-                    img_vol = (img_vol - min_vol) / (max_vol - min_vol)
-                    self.output_data["mosaic_templ"] = vol3d_img2d(img_vol, self.xdim, self.ydim,
-                                                                   self.img2d_dimx, self.img2d_dimy, self.dim)
-
-                    self.input_data["done_mosaic_templ"] = True
-
-                    if self.input_data["overlay_ready"]:
-                        if self.input_data["is_rtqa"]:
-                            overlay_vol = self.input_data["rtQA_volume"]
-                            overlay_img = vol3d_img2d(overlay_vol, self.xdim, self.ydim,
-                                                      self.img2d_dimx, self.img2d_dimy, self.dim)
-                            overlay_img = (overlay_img / np.max(overlay_img)) * 255
-                        else:
-                            filename = self.input_data["stat_volume"]
-                            overlay_vol = np.memmap(filename, dtype=np.float64, shape=self.input_data["dim"], offset=0, order='F')
-                            overlay_img = vol3d_img2d(overlay_vol, self.xdim, self.ydim,
-                                                      self.img2d_dimx, self.img2d_dimy, self.dim)
-                            overlay_img = (overlay_img / np.max(overlay_img)) * 255
-
-                            if self.input_data["is_neg"]:
-                                neg_overlay_vol = np.memmap(filename, dtype=np.float64, shape=self.input_data["dim"],
-                                                            offset=overlay_vol.size * overlay_vol.data.itemsize, order='F')
-                                neg_overlay_img = vol3d_img2d(neg_overlay_vol, self.xdim, self.ydim,
-                                                              self.img2d_dimx, self.img2d_dimy, self.dim)
-                                neg_overlay_img = (neg_overlay_img / np.max(neg_overlay_img)) * 255
-
-                        if self.input_data["auto_thr_pos"]:
-                            pos_thr = self.thr_calculator(overlay_img)
-                            if pos_thr.lower < 0:
-                                pos_thr = Thresholds(0, pos_thr.upper)
-                            self.output_data["pos_thresholds"] = pos_thr
-                        else:
-                            pos_thr = self.output_data["pos_thresholds"]
-                        self.output_data["mosaic_pos_overlay"] = self.pos_image(overlay_img, pos_thr, 1.0)
+        epi_name = self.input_data["epi_volume"]
 
-                        if self.input_data["is_neg"]:
-                            if self.input_data["auto_thr_neg"]:
-                                neg_thr = self.thr_calculator(neg_overlay_img)
-                                if neg_thr.lower < 0:
-                                    neg_thr = Thresholds(0, neg_thr.upper)
-                                self.output_data["neg_thresholds"] = neg_thr
-                            else:
-                                neg_thr = self.output_data["neg_thresholds"]
-                            self.output_data["mosaic_neg_overlay"] = self.neg_image(neg_overlay_img, neg_thr, 1.0)
+        if self.input_data["epi_volume_type"] == "nii":
+            self.epi_volume, _ = load_nifti_volume(epi_name)
+        else:
+            epi_volume = pydicom.dcmread(epi_name).pixel_array
+            if epi_volume.ndim == 2:
+                xdim_img_number, ydim_img_number, _, _ = get_mosaic_dim(self.dim)
+                epi_volume = img2d_vol3d(epi_volume, xdim_img_number, ydim_img_number, self.dim)
+            self.epi_volume = np.asfortranarray(epi_volume, dtype=BACKGROUND_DTYPE)
+
+        self.back_ranges["bgEPI"] = volume_range(self.epi_volume)
+
+    def create_output_state(self):
+        """Allocates shared output images for the geometry of the mosaic and orthogonal views
+        """
+        mosaic_shape = self.mosaic_layout.shape
+        plane_shapes = self.orth_plane_shapes()
+        roi_capacity = max(1, self.input_data["nr_ROIs"]) * ROI_CONTOURS_CAPACITY
+
+        frames = {
+            "mosaic_templ": sharedstate.Frame(mosaic_shape, dtype=np.uint8),
+            "mosaic_pos_overlay": sharedstate.Frame(mosaic_shape + (4,), dtype=np.uint8),
+            "mosaic_neg_overlay": sharedstate.Frame(mosaic_shape + (4,), dtype=np.uint8),
+        }
+        objects = {
+            "pos_thresholds": sharedstate.Object(Thresholds(1, 255)),
+            "neg_thresholds": sharedstate.Object(Thresholds(1, 255)),
+        }
+
+        for proj, shape in plane_shapes.items():
+            frames["back_" + proj] = sharedstate.Frame(shape, dtype=np.uint8)
+            frames["overlay_" + proj] = sharedstate.Frame(shape + (4,), dtype=np.uint8)
+            frames["neg_overlay_" + proj] = sharedstate.Frame(shape + (4,), dtype=np.uint8)
+            objects["ROI_" + proj] = sharedstate.Object([], capacity=roi_capacity)
+
+        return sharedstate.SharedState(frames=frames, objects=objects, controls={"rendered_id": 0})
+
+    def orth_plane_shapes(self):
+        """Returns shapes of transversal, coronal and sagittal images of the orthogonal view
+        """
+        bb = self.str_param['bb']
+        dims = np.squeeze(np.round(np.diff(bb, axis=0).T + 1)).astype(int)
 
-                        self.input_data["done_mosaic_overlay"] = True
+        if self.str_param['mode'] == 0:
+            sagittal_shape = (dims[1], dims[2])
+        else:
+            sagittal_shape = (dims[2], dims[1])
 
+        return {'t': (dims[1], dims[0]), 'c': (dims[2], dims[0]), 's': sagittal_shape}
 
-                else:
+    def stop(self):
+        """Asks the process loop to finish, it is called from the GUI process
+        """
+        self.input_data["is_stopped"] = True
+        self.input_data["ready"] = True
 
-                    flags = [self.input_data["bg_type"], self.input_data["is_rtqa"],
-                             self.input_data["is_neg"], self.input_data["is_ROI"]]
+    def run(self):
 
-                    # background
-                    if flags[0] == "bgEPI":
-                        back_volume = self.epi_volume
-                        mat = self.mat_epi
-                    else:
-                        back_volume = self.anat_volume
-                        mat = self.mat_anat
+        np.seterr(divide='ignore', invalid='ignore')
 
-                    # overlay (pos/neg stat or rtQA)
-                    if flags[1]:
-                        overlay_vol = self.input_data["rtQA_volume"]
-                        neg_overlay_vol = []
+        self.load_background_volumes()
+
+        # last published images, unchanged images are not published again
+        self.last_frames = {}
+        # pairs of reusable buffers of uint8 frames
+        self.frame_buffers = {}
+        # volume and mosaic buffers of the mosaic view, they are reused for every volume
+        self.mosaic_volume = np.empty(self.dim, order='F')
+        self.mosaic_buffers = {}
+        # mosaic view layers by name, stored with the key of their source
+        self.mosaic_cache = {}
+        # orthogonal view images by (layer, plane), stored with the key of their source and geometry
+        self.orth_cache = {}
+        self.sampler = planesampler.OrthSampler(order=self.input_data["resampling_order"])
+        # ROI contours by slice, they are computed once before the first request
+        self.roi_atlas = self.roi_contour_atlas() if self.input_data["is_ROI"] else []
+
+        # the shared volume files are mapped once for the whole session
+        template_map = mappedvolume.MappedVolume(self.input_data["memmap_volume"], self.dim)
+        stat_map = mappedvolume.MappedVolume(self.input_data["stat_volume"], self.dim, count=2)
+
+        while True:
+
+            # block until the GUI requests new images or asks to stop
+            self.input_data.wait("ready")
+            if self.input_data["is_stopped"]:
+                break
+            self.input_data["ready"] = False
+            request_id = self.input_data["request_id"]
+
+            if self.input_data["view_mode"] == 0:
+
+                # background layer, it is refreshed when at least mosaic_bg_refresh new volumes were written
+                templ_key = template_map.sequence
+                cached = self.mosaic_cache.get("mosaic_templ")
+                if cached is not None and templ_key - cached[0] < 2 * self.input_data["mosaic_bg_refresh"]:
+                    templ_key = cached[0]
+                mosaic_templ = self.mosaic_layer("mosaic_templ", templ_key,
+                                                 lambda: self.mosaic_background(template_map))
+                with self.output_data.lock:
+                    self.publish_frame("mosaic_templ", mosaic_templ)
+
+                if self.input_data["overlay_ready"]:
+                    # overlay layers, colormapped images are recomputed when the map or thresholds change
+                    is_rtqa = self.input_data["is_rtqa"]
+                    if is_rtqa:
+                        overlay_key = None
+                        overlay_vol = lambda: self.input_data["rtQA_volume"]
                     else:
-                        filename = self.input_data["stat_volume"]
-                        overlay_vol = np.memmap(filename, dtype=np.float64, shape=self.input_data["dim"],
-                                                        offset=0, order='F')
-                        if flags[2]:
-                            neg_overlay_vol = np.memmap(filename, dtype=np.float64, shape=self.input_data["dim"],
-                                                        offset=overlay_vol.size*overlay_vol.data.itemsize, order='F')
-                        else:
-                            neg_overlay_vol = []
+                        overlay_key = ("stat", stat_map.sequence)
+                        overlay_vol = lambda: stat_map.read(0, out=self.mosaic_volume)[0]
+                    overlay_img = self.mosaic_layer("pos_values", overlay_key,
+                                                    lambda: self.mosaic_overlay("pos_values", overlay_vol()))
 
-                    ROI_vols = self.ROI_vols
-                    ROI_mats = self.ROI_mats
-
-                    cursor_pos = self.input_data["cursor_pus"]
-                    flags_planes = self.input_data["flags_planes"]
-
-                    proj = np.nonzero(flags_planes)
-
-                    new_coord = np.array([[0, 0],[0, 0],[0, 0]])
-                    new_coord[proj,:] = cursor_pos
-
-                    self.str_param['centre'] = self.findcent(new_coord, flags_planes)
-                    # Display modes: [Background + Stat + ROIs, Background + Stat, Background + ROIs]
-                    self.str_param['mode_displ'] = [1, 0, 0]
-
-                    [self.output_data["back_t"], self.output_data["back_c"], self.output_data["back_s"],
-                     self.output_data["overlay_t"], self.output_data["overlay_c"], self.output_data["overlay_s"],
-                     self.output_data["neg_overlay_t"], self.output_data["neg_overlay_c"], self.output_data["neg_overlay_s"],
-                     self.output_data["ROI_t"], self.output_data["ROI_c"], self.output_data["ROI_s"]
-                    ] = self.update_orth_view(back_volume, mat, overlay_vol, neg_overlay_vol, ROI_vols, ROI_mats, flags)
-
-                    pos_maps_values = np.array(self.output_data["overlay_t"].ravel(), dtype=np.uint8)
-                    pos_maps_values = np.append(pos_maps_values, self.output_data["overlay_c"].ravel())
-                    pos_maps_values = np.append(pos_maps_values, self.output_data["overlay_s"].ravel())
                     if self.input_data["auto_thr_pos"]:
-                        pos_thr = self.thr_calculator(pos_maps_values)
-                        if (not pos_thr is None) and pos_thr.lower < 0:
-                            pos_thr = Thresholds(0, pos_thr.upper)
+                        pos_thr = self.mosaic_layer("pos_auto_thresholds", overlay_key,
+                                                    lambda: self.auto_thresholds(overlay_img))
                         self.output_data["pos_thresholds"] = pos_thr
                     else:
                         pos_thr = self.output_data["pos_thresholds"]
-                    self.output_data["overlay_t"] = self.pos_image(self.output_data["overlay_t"], pos_thr, 1.0)
-                    self.output_data["overlay_c"] = self.pos_image(self.output_data["overlay_c"], pos_thr, 1.0)
-                    self.output_data["overlay_s"] = self.pos_image(self.output_data["overlay_s"], pos_thr, 1.0)
-
-                    if self.input_data["is_neg"]:
-                        neg_maps_values = np.array(self.output_data["neg_overlay_t"].ravel(), dtype=np.uint8)
-                        neg_maps_values = np.append(neg_maps_values, self.output_data["neg_overlay_c"].ravel())
-                        neg_maps_values = np.append(neg_maps_values, self.output_data["neg_overlay_s"].ravel())
+                    mosaic_pos_overlay = self.mosaic_layer(
+                        "mosaic_pos_overlay", None if overlay_key is None else (overlay_key, pos_thr),
+                        lambda: self.pos_image(overlay_img, pos_thr, 1.0,
+                                               self.rgba_buffer("mosaic_pos_overlay", overlay_img.shape)))
+                    with self.output_data.lock:
+                        self.publish_frame("mosaic_pos_overlay", mosaic_pos_overlay)
+
+                    if self.input_data["is_neg"] and not is_rtqa:
+                        neg_overlay_img = self.mosaic_layer("neg_values", overlay_key,
+                                                            lambda: self.mosaic_overlay(
+                                                                "neg_values",
+                                                                stat_map.read(1, out=self.mosaic_volume)[0]))
                         if self.input_data["auto_thr_neg"]:
-                            neg_thr = self.thr_calculator(neg_maps_values)
-                            if (not neg_thr is None) and neg_thr.lower < 0:
-                                neg_thr = Thresholds(0, neg_thr.upper)
+                            neg_thr = self.mosaic_layer("neg_auto_thresholds", overlay_key,
+                                                        lambda: self.auto_thresholds(neg_overlay_img))
                             self.output_data["neg_thresholds"] = neg_thr
                         else:
                             neg_thr = self.output_data["neg_thresholds"]
-                        self.output_data["neg_overlay_t"] = self.neg_image(self.output_data["neg_overlay_t"],
-                                                                           neg_thr, 1.0)
-                        self.output_data["neg_overlay_c"] = self.neg_image(self.output_data["neg_overlay_c"],
-                                                                           neg_thr, 1.0)
-                        self.output_data["neg_overlay_s"] = self.neg_image(self.output_data["neg_overlay_s"],
-                                                                           neg_thr, 1.0)
+                        mosaic_neg_overlay = self.mosaic_layer(
+                            "mosaic_neg_overlay", (overlay_key, neg_thr),
+                            lambda: self.neg_image(neg_overlay_img, neg_thr, 1.0,
+                                                   self.rgba_buffer("mosaic_neg_overlay", neg_overlay_img.shape)))
+                        with self.output_data.lock:
+                            self.publish_frame("mosaic_neg_overlay", mosaic_neg_overlay)
 
-                    self.input_data["done_orth"] = True
+            else:
 
-                self.input_data["ready"] = False
+                flags = [self.input_data["bg_type"], self.input_data["is_rtqa"],
+                         self.input_data["is_neg"], self.input_data["is_ROI"]]
+
+                # background
+                if flags[0] == "bgEPI":
+                    back_volume = self.epi_volume
+                    mat = self.mat_epi
+                else:
+                    back_volume = self.anat_volume
+                    mat = self.mat_anat
+
+                # overlay (pos/neg stat or rtQA)
+                # stat maps are read only if their cached planes are outdated
+                if flags[1]:
+                    overlay_key = None
+                    overlay_vol = self.input_data["rtQA_volume"]
+                    neg_overlay_vol = []
+                else:
+                    overlay_key = ("stat", stat_map.sequence)
+                    overlay_vol = lambda: stat_map.read(0)[0]
+                    neg_overlay_vol = lambda: stat_map.read(1)[0]
+
+                cursor_pos = self.input_data["cursor_pus"]
+                flags_planes = self.input_data["flags_planes"]
+
+                proj = np.nonzero(flags_planes)
+
+                new_coord = np.array([[0, 0],[0, 0],[0, 0]])
+                new_coord[proj,:] = cursor_pos
+
+                self.str_param['centre'] = self.findcent(new_coord, flags_planes)
+                # Display modes: [Background + Stat + ROIs, Background + Stat, Background + ROIs]
+                self.str_param['mode_displ'] = [1, 0, 0]
+
+                [back_t, back_c, back_s,
+                 overlay_t, overlay_c, overlay_s,
+                 neg_overlay_t, neg_overlay_c, neg_overlay_s,
+                 ROI_t, ROI_c, ROI_s
+                ] = self.update_orth_view(back_volume, mat, overlay_vol, neg_overlay_vol, flags, overlay_key)
+
+                pos_maps_values = (np.array(overlay_t, dtype=np.uint8), overlay_c, overlay_s)
+                if self.input_data["auto_thr_pos"]:
+                    pos_thr = self.thr_calculator(pos_maps_values)
+                    if (not pos_thr is None) and pos_thr.lower < 0:
+                        pos_thr = Thresholds(0, pos_thr.upper)
+                    self.output_data["pos_thresholds"] = pos_thr
+                else:
+                    pos_thr = self.output_data["pos_thresholds"]
+                overlay_t = self.pos_image(overlay_t, pos_thr, 1.0, self.rgba_buffer("overlay_t", overlay_t.shape))
+                overlay_c = self.pos_image(overlay_c, pos_thr, 1.0, self.rgba_buffer("overlay_c", overlay_c.shape))
+                overlay_s = self.pos_image(overlay_s, pos_thr, 1.0, self.rgba_buffer("overlay_s", overlay_s.shape))
+
+                if neg_overlay_t is not None:
+                    neg_maps_values = (np.array(neg_overlay_t, dtype=np.uint8), neg_overlay_c, neg_overlay_s)
+                    if self.input_data["auto_thr_neg"]:
+                        neg_thr = self.thr_calculator(neg_maps_values)
+                        if (not neg_thr is None) and neg_thr.lower < 0:
+                            neg_thr = Thresholds(0, neg_thr.upper)
+                        self.output_data["neg_thresholds"] = neg_thr
+                    else:
+                        neg_thr = self.output_data["neg_thresholds"]
+                    neg_overlay_t = self.neg_image(neg_overlay_t, neg_thr, 1.0,
+                                                     self.rgba_buffer("neg_overlay_t", neg_overlay_t.shape))
+                    neg_overlay_c = self.neg_image(neg_overlay_c, neg_thr, 1.0,
+                                                     self.rgba_buffer("neg_overlay_c", neg_overlay_c.shape))
+                    neg_overlay_s = self.neg_image(neg_overlay_s, neg_thr, 1.0,
+                                                     self.rgba_buffer("neg_overlay_s", neg_overlay_s.shape))
+                else:
+                    neg_overlay_t = neg_overlay_c = neg_overlay_s = None
+
+                with self.output_data.lock:
+                    self.publish_frame("back_t", back_t)
+                    self.publish_frame("back_c", back_c)
+                    self.publish_frame("back_s", back_s)
+                    self.publish_frame("overlay_t", overlay_t)
+                    self.publish_frame("overlay_c", overlay_c)
+                    self.publish_frame("overlay_s", overlay_s)
+                    self.publish_frame("neg_overlay_t", neg_overlay_t)
+                    self.publish_frame("neg_overlay_c", neg_overlay_c)
+                    self.publish_frame("neg_overlay_s", neg_overlay_s)
+                    self.output_data["ROI_t"] = ROI_t
+                    self.output_data["ROI_c"] = ROI_c
+                    self.output_data["ROI_s"] = ROI_s
+
+            # the GUI submits the next request after this one is rendered
+            self.output_data["rendered_id"] = request_id
+
+    def mosaic_layer(self, name, key, compute):
+        """Returns the cached mosaic layer, it is recomputed if its key changed
+
+        :param name: layer name
+        :param key: version of the layer source, None disables caching of the layer
+        :param compute: function which computes the layer
+        """
+        cached = self.mosaic_cache.get(name)
+        if key is None or cached is None or cached[0] != key:
+            cached = (key, compute())
+            self.mosaic_cache[name] = cached
+        return cached[1]
+
+    def mosaic_background(self, template_map):
+        """Returns the uint8 mosaic of the current preprocessed volume scaled to [0, 255]
+        """
+        img_vol, _ = template_map.read(out=self.mosaic_volume)
+        max_vol = np.max(img_vol)
+        min_vol = np.min(img_vol)
+
+        img = self.mosaic_values("templ_values", img_vol)
+        np.subtract(img, min_vol, out=img)
+        np.multiply(img, 255 / (max_vol - min_vol), out=img)
+        self.mosaic_layout.clear_empty_tiles(img)
+
+        return to_uint8(img, self.frame_buffer("mosaic_templ", img.shape, np.uint8))
+
+    def mosaic_overlay(self, name, overlay_vol):
+        """Returns the mosaic of the overlay volume scaled to [0, 255], it is written to the buffer of the layer
+        """
+        overlay_img = self.mosaic_values(name, overlay_vol)
+        np.divide(overlay_img, np.max(overlay_img), out=overlay_img)
+        np.multiply(overlay_img, 255, out=overlay_img)
+        return overlay_img
+
+    def mosaic_values(self, name, vol):
+        """Converts the volume to the reusable float mosaic buffer of the layer
+        """
+        buffer = self.mosaic_buffers.get(name)
+        if buffer is None:
+            buffer = np.zeros(self.mosaic_layout.shape)
+            self.mosaic_buffers[name] = buffer
+        return self.mosaic_layout.to_mosaic(vol, out=buffer)
+
+    def auto_thresholds(self, img):
+        """Computes thresholds of the map image, the lower threshold is not negative
+        """
+        thr = self.thr_calculator(img)
+        if thr is not None and thr.lower < 0:
+            thr = Thresholds(0, thr.upper)
+        return thr
+
+    def rgba_buffer(self, name, shape):
+        """Returns a reusable uint8 RGBA buffer for the overlay frame
+        """
+        return self.frame_buffer(name, tuple(shape) + (4,), np.uint8)
+
+    def frame_buffer(self, name, shape, dtype):
+        """Returns a reusable buffer for the frame
+
+        Two buffers alternate, the one which holds the last published image is never returned.
+        """
+        shape = tuple(shape)
+        buffers = self.frame_buffers.get(name)
+
+        if buffers is None or buffers[0].shape != shape:
+            buffers = (np.empty(shape, dtype=dtype), np.empty(shape, dtype=dtype))
+            self.frame_buffers[name] = buffers
+
+        if buffers[0] is self.last_frames.get(name):
+            return buffers[1]
+        return buffers[0]
+
+    def publish_frame(self, name, image):
+        """Publishes the image as a new frame if it differs from the last published one
+        """
+        if name in self.last_frames:
+            last = self.last_frames[name]
+            if image is last:
+                return
+            if image is not None and last is not None and np.array_equal(image, last):
+                return
+
+        self.output_data[name] = image
+        self.last_frames[name] = image
 
     def prepare_orth_view(self, mat, dim):
         # set structure for Display and draw a first overlay
@@ -228,85 +443,40 @@ class VolViewFormation(mp.Process):
         # Display modes: [Background + Stat + ROIs, Background + Stat, Background + ROIs]
         self.str_param['mode_displ'] = np.array([0, 0, 1])
 
-    def update_orth_view(self, vol, mat, overlay_vol, neg_overlay_vol, ROI_vols, ROI_mats, flags):
+    def update_orth_view(self, vol, mat, overlay_vol, neg_overlay_vol, flags, overlay_key=None):
+        """Returns background, overlay and ROI images of the orthogonal view at the current centre
+
+        Planes whose geometry and source did not change since the previous call come from the cache.
+
+        :param overlay_vol: overlay volume or a function which reads it
+        :param neg_overlay_vol: negative overlay volume or a function which reads it
+        :param overlay_key: version of the overlay volumes, None if the overlay is not cached
+        """
 
-        bb = self.str_param['bb']
-        dims = np.squeeze(np.round(np.diff(bb, axis=0).T + 1))
         _is = np.linalg.inv(self.str_param['space'])
         cent = _is[0:3, 0:3] @ self.str_param['centre'] + _is[0:3, 3]
 
         m = np.array(np.linalg.solve(self.str_param['space'], self.str_param['premul']) @ mat, order='F')
-        tm0 = np.array([
-            [1, 0, 0, -bb[0, 0] + 1],
-            [0, 1, 0, -bb[0, 1] + 1],
-            [0, 0, 1, -cent[2]],
-            [0, 0, 0, 1],
-
-        ])
-        td = np.array([dims[0], dims[1]], dtype=int, order='F')
+        coord_param = self.orth_coord_param(cent)
 
-        cm0 = np.array([
-            [1, 0, 0, -bb[0, 0] + 1],
-            [0, 0, 1, -bb[0, 2] + 1],
-            [0, 1, 0, -cent[1]],
-            [0, 0, 0, 1],
-        ])
-        cd = np.array([dims[0], dims[2]], dtype=int, order='F')
+        back_range = self.back_ranges[flags[0]]
+        back_layer = ("back", ("back", flags[0]), vol, lambda img: self.normalized_background(img, back_range))
+        overlay_layers = [("overlay", overlay_key, overlay_vol, self.normalized_overlay)]
+        if flags[2] and not flags[1]:
+            overlay_layers.append(("neg_overlay", overlay_key, neg_overlay_vol, self.normalized_overlay))
 
-        if self.str_param['mode'] == 0:
-            sm0 = np.array([
-                [0, 0, 1, -bb[0, 2] + 1],
-                [0, 1, 0, -bb[0, 1] + 1],
-                [1, 0, 0, -cent[0]],
-                [0, 0, 0, 1],
-            ])
-            sd = np.array([dims[2], dims[1]], dtype=int, order='F')
+        if flags[0] == "bgEPI":
+            # the EPI background and overlays share the matrix and are resampled together
+            images = self.orth_planes([back_layer] + overlay_layers, coord_param, m)
         else:
-            sm0 = np.array([
-                [0, -1, 0, +bb[1, 1] + 1],
-                [0, 0, 1, -bb[0, 2] + 1],
-                [1, 0, 0, -cent[0]],
-                [0, 0, 0, 1],
-            ])
-            sd = np.array([dims[1], dims[2]], dtype=int, order='F')
-
-        coord_param = {'tm0': tm0, 'cm0': cm0, 'sm0': sm0, 'td': td, 'cd': cd, 'sd': sd}
-
-        back_imgt, back_imgc, back_imgs = self.get_orth_vol(coord_param, vol, m)
-
-        back_imgt = np.nan_to_num(back_imgt)
-        back_imgt[back_imgt < 0] = 0
-
-        back_imgc = np.nan_to_num(back_imgc)
-        back_imgc[back_imgc < 0] = 0
-
-        back_imgs = np.nan_to_num(back_imgs)
-        back_imgs[back_imgs < 0] = 0
-
-        back_imgt = ((back_imgt / np.max(back_imgt)) * 255)
-        back_imgc = ((back_imgc / np.max(back_imgc)) * 255)
-        back_imgs = ((back_imgs / np.max(back_imgs)) * 255)
-
-        if flags[0] != "bgEPI":
+            images = self.orth_planes([back_layer], coord_param, m)
             m = np.array(np.linalg.solve(self.str_param['space'], self.str_param['premul']) @ self.mat_epi, order='F')
+            images += self.orth_planes(overlay_layers, coord_param, m)
 
-        overlay_imgt, overlay_imgc, overlay_imgs = self.get_orth_vol(coord_param, overlay_vol, m)
-        overlay_imgt = np.nan_to_num(overlay_imgt)
-        overlay_imgc = np.nan_to_num(overlay_imgc)
-        overlay_imgs = np.nan_to_num(overlay_imgs)
-        overlay_imgt = ((overlay_imgt / np.max(overlay_imgt)) * 255)
-        overlay_imgc = ((overlay_imgc / np.max(overlay_imgc)) * 255)
-        overlay_imgs = ((overlay_imgs / np.max(overlay_imgs)) * 255)
-
-        if flags[3]:
-            neg_overlay_imgt, neg_overlay_imgc, neg_overlay_imgs = self.get_orth_vol(coord_param, neg_overlay_vol, m)
-            neg_overlay_imgt = np.nan_to_num(neg_overlay_imgt)
-            neg_overlay_imgc = np.nan_to_num(neg_overlay_imgc)
-            neg_overlay_imgs = np.nan_to_num(neg_overlay_imgs)
-            neg_overlay_imgt = ((neg_overlay_imgt / np.max(neg_overlay_imgt)) * 255)
-            neg_overlay_imgc = ((neg_overlay_imgc / np.max(neg_overlay_imgc)) * 255)
-            neg_overlay_imgs = ((neg_overlay_imgs / np.max(neg_overlay_imgs)) * 255)
-
+        back_imgt, back_imgc, back_imgs = images[0]
+        overlay_imgt, overlay_imgc, overlay_imgs = images[1]
+        if len(images) > 2:
+            neg_overlay_imgt, neg_overlay_imgc, neg_overlay_imgs = images[2]
         else:
             neg_overlay_imgt = None
             neg_overlay_imgc = None
@@ -317,20 +487,68 @@ class VolViewFormation(mp.Process):
         ROI_c = [None]*nrROIs
         ROI_s = [None]*nrROIs
 
-        if bool(self.str_param["mode_displ"]) and flags[3]:
+        if bool(self.str_param["mode_displ"]) and flags[3] and self.roi_atlas:
 
             for j in range(nrROIs):
+                ROI_t[j] = self.roi_contours(j, 't', cent)
+                ROI_c[j] = self.roi_contours(j, 'c', cent)
+                ROI_s[j] = self.roi_contours(j, 's', cent)
 
-                vol = np.array(np.squeeze(ROI_vols[j,:,:,:]), order='F')
-                mat = np.array(np.squeeze(ROI_mats[j,:,:]), order='F')
-                m = np.array(np.linalg.solve(self.str_param['space'], self.str_param['premul']) @ mat, order='F')
-                temp_t, temp_c, temp_s = self.get_orth_vol(coord_param, vol, m)
+        return (back_imgt, back_imgc, back_imgs, overlay_imgt, overlay_imgc, overlay_imgs,
+                neg_overlay_imgt, neg_overlay_imgc, neg_overlay_imgs, ROI_t, ROI_c, ROI_s)
 
-                ROI_t[j] = self.roi_boundaries(temp_t)
-                ROI_c[j] = self.roi_boundaries(temp_c)
-                ROI_s[j] = self.roi_boundaries(temp_s)
+    def roi_contour_atlas(self):
+        """Computes ROI contours of every slice of the three planes of the orthogonal view
 
-        return back_imgt, back_imgc, back_imgs, overlay_imgt, overlay_imgc, overlay_imgs, neg_overlay_imgt, neg_overlay_imgc, neg_overlay_imgs, ROI_t, ROI_c, ROI_s
+        ROI masks do not change during the run, so the contours are computed once
+        and orthogonal view updates only look them up by the cursor position.
+
+        :return: list of dicts per ROI, which map a plane to the list of contours by slice index
+        """
+        bb = self.str_param['bb']
+        dims = np.squeeze(np.round(np.diff(bb, axis=0).T + 1)).astype(int)
+        atlas = []
+
+        for j in range(self.input_data["nr_ROIs"]):
+            vol = self.roi_volume(self.ROI_indexes[j])
+            mat = np.array(np.squeeze(self.ROI_mats[j,:,:]), order='F')
+            m = np.array(np.linalg.solve(self.str_param['space'], self.str_param['premul']) @ mat, order='F')
+
+            contours = {}
+            for plane, axis in ROI_PLANE_AXES.items():
+                slices = []
+                for k in range(dims[axis]):
+                    cent = np.zeros((3,))
+                    cent[axis] = bb[0, axis] + k
+                    img, = self.sampler.resample([vol], self.orth_coord_param(cent), m, plane,
+                                                 order=planesampler.NEAREST, cache=False)
+                    slices.append(self.roi_boundaries(img))
+                contours[plane] = slices
+            atlas.append(contours)
+
+        return atlas
+
+    def roi_contours(self, index, plane, cent):
+        """Returns precomputed contours of the ROI on the plane crossing the centre
+
+        :param index: ROI index
+        :param plane: 't', 'c' or 's'
+        :param cent: centre in view space, the nearest precomputed slice is used
+        """
+        axis = ROI_PLANE_AXES[plane]
+        slices = self.roi_atlas[index][plane]
+        k = int(np.round(cent[axis] - self.str_param['bb'][0, axis]))
+
+        if 0 <= k < len(slices):
+            return slices[k]
+        return np.array([])
+
+    def roi_volume(self, voxel_indexes):
+        """Returns ROI mask volume for 0-based voxel indexes
+        """
+        vol = np.zeros(int(np.prod(self.dim)))
+        vol[voxel_indexes] = 1
+        return vol.reshape(self.dim, order='F')
 
     def roi_boundaries(self, roi):
         roi[np.isnan(roi)] = 0
@@ -345,25 +563,108 @@ class VolViewFormation(mp.Process):
 
         return boundaries
 
-    def get_orth_vol(self, coord_param, vol, m):
-        temp = np.array([0, np.nan], order='F')
+    def orth_planes(self, layers, coord_param, m):
+        """Returns transversal, coronal and sagittal images of view layers which share the volume matrix
+
+        A plane of a layer is resampled only if the layer key, the plane position or the volume matrix
+        changed since it was cached, so a cursor move resamples only the planes crossing the moved
+        coordinate. Outdated planes of all layers are resampled together.
+
+        :param layers: list of (name, key, vol, prepare) of every layer, where key is the version
+                       of the layer source or None to disable caching, vol is the source volume or
+                       a function which returns it and prepare converts a resampled plane to the image
+        :param coord_param: geometry of the planes
+        :param m: volume to view space matrix
+        :return: list of the three images of every layer
+        """
+        images = [[None] * 3 for _ in layers]
+        volumes = [None] * len(layers)
+
+        for p, plane in enumerate(('t', 'c', 's')):
+            outdated = []
+
+            for i, (name, key, vol, prepare) in enumerate(layers):
+                plane_key = None
+                if key is not None:
+                    plane_key = (key, coord_param[plane + 'm0'].tobytes(), m.tobytes())
+
+                cached = self.orth_cache.get((name, plane))
+                if plane_key is None or cached is None or cached[0] != plane_key:
+                    outdated.append((i, plane_key))
+                else:
+                    images[i][p] = cached[1]
+
+            if not outdated:
+                continue
+
+            for i, _ in outdated:
+                if volumes[i] is None:
+                    vol = layers[i][2]
+                    volumes[i] = vol() if callable(vol) else vol
+
+            resampled = self.sampler.resample([volumes[i] for i, _ in outdated], coord_param, m, plane)
+
+            for (i, plane_key), img in zip(outdated, resampled):
+                name, prepare = layers[i][0], layers[i][3]
+                images[i][p] = prepare(img)
+                self.orth_cache[(name, plane)] = (plane_key, images[i][p])
+
+        return images
+
+    @staticmethod
+    def normalized_background(img, back_range):
+        """Scales the background plane to uint8 [0, 255] by the maximum of the whole volume,
+        the zero floor is kept, negative values are not shown
+        """
+        img = np.nan_to_num(img)
+        img[img < 0] = 0
+        return to_uint8((img / back_range[1]) * 255)
+
+    @staticmethod
+    def normalized_overlay(img):
+        img = np.nan_to_num(img)
+        return (img / np.max(img)) * 255
+
+    def orth_coord_param(self, cent):
+        """Returns matrices and sizes of the three planes crossing the centre given in view space
+        """
+        bb = self.str_param['bb']
+        dims = np.squeeze(np.round(np.diff(bb, axis=0).T + 1))
+        tm0 = np.array([
+            [1, 0, 0, -bb[0, 0] + 1],
+            [0, 1, 0, -bb[0, 1] + 1],
+            [0, 0, 1, -cent[2]],
+            [0, 0, 0, 1],
 
-        mat_t = np.array(linalg.inv(coord_param['tm0'] @ m), order='F')
-        imgt = np.zeros((coord_param['td'][0], coord_param['td'][1]), order='F')
-        spm_slice_vol(vol, imgt, mat_t, temp)
-        imgt = imgt.T
+        ])
+        td = np.array([dims[0], dims[1]], dtype=int, order='F')
 
-        mat_c = np.array(linalg.inv(coord_param['cm0'] @ m), order='F')
-        imgc = np.zeros((coord_param['cd'][0], coord_param['cd'][1]), order='F')
-        spm_slice_vol(vol, imgc, mat_c, temp)
-        imgc = imgc.T
+        cm0 = np.array([
+            [1, 0, 0, -bb[0, 0] + 1],
+            [0, 0, 1, -bb[0, 2] + 1],
+            [0, 1, 0, -cent[1]],
+            [0, 0, 0, 1],
+        ])
+        cd = np.array([dims[0], dims[2]], dtype=int, order='F')
 
-        mat_s = np.array(linalg.inv(coord_param['sm0'] @ m), order='F')
-        imgs = np.zeros((coord_param['sd'][0], coord_param['sd'][1]), order='F')
-        spm_slice_vol(vol, imgs, mat_s, temp)
-        imgs = np.fliplr(imgs.T)
+        if self.str_param['mode'] == 0:
+            sm0 = np.array([
+                [0, 0, 1, -bb[0, 2] + 1],
+                [0, 1, 0, -bb[0, 1] + 1],
+                [1, 0, 0, -cent[0]],
+                [0, 0, 0, 1],
+            ])
+            sd = np.array([dims[2], dims[1]], dtype=int, order='F')
+        else:
+            sm0 = np.array([
+                [0, -1, 0, +bb[1, 1] + 1],
+                [0, 0, 1, -bb[0, 2] + 1],
+                [1, 0, 0, -cent[0]],
+                [0, 0, 0, 1],
+            ])
+            sd = np.array([dims[1], dims[2]], dtype=int, order='F')
 
-        return imgt, imgc, imgs
+        return {'tm0': tm0, 'cm0': cm0, 'sm0': sm0, 'td': td, 'cd': cd, 'sd': sd}
 
     def findcent(self, coord_loc, flags_planes):
 
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""
+Comparison of voxelwise running statistics with the scalar recursive formulas
+of the former per-voxel rtQA calculation
+
+__________________________________________________________________________
+Copyright (C) 2016-2021 OpenNFT.org
+
+"""
+
+import numpy as np
+import pytest
+
+from opennft import runningstats
+
+NR_VOXELS = 50
+NR_VOLUMES = 40
+# volume index of the new DCM block, the statistics are started anew
+NEW_BLOCK = 25
+
+TOLERANCES = {
+    np.float64: dict(rtol=1e-10, atol=1e-10),
+    np.float32: dict(rtol=1e-3, atol=1e-3),
+}
+
+
+class ScalarStats:
+    """Recursive mean and variance of one voxel as in RTQACalculation.snr
+    """
+
+    def __init__(self):
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.var = 0.0
+        self.count = 0
+
+    def reset(self):
+        # a new DCM block resets only the counter, the next update initializes the mean
+        self.count = 0
+
+    def update(self, value):
+        if not self.count:
+            self.mean = value
+            self.m2 = 0.0
+            self.var = 0.0
+        else:
+            prev_mean = self.mean
+            self.mean = prev_mean + (value - prev_mean) / (self.count + 1)
+            self.m2 = self.m2 + (value - prev_mean) * (value - self.mean)
+            self.var = self.m2 / self.count
+        self.count += 1
+
+    def snr(self):
+        if self.count < 2:
+            return 0.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.float64(self.mean) / np.sqrt(np.float64(self.var))
+
+
+def scalar_cnr(bas, cond):
+    if not cond.count:
+        return 0.0
+    # zero variances give inf or NaN as in the former numpy code
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.float64(cond.mean - bas.mean) / np.sqrt(np.float64(cond.var + bas.var))
+
+
+def make_volumes():
+    rng = np.random.default_rng(0)
+    baseline = rng.uniform(50, 150, NR_VOXELS)
+    return baseline + rng.normal(0, 5, (NR_VOLUMES, NR_VOXELS))
+
+
+def condition_codes():
+    # alternating blocks of 5 baseline and 5 condition volumes
+    return [(i // 5) % 2 for i in range(NR_VOLUMES)]
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_snr_matches_scalar_formulas(dtype):
+    volumes = make_volumes()
+    stats = runningstats.RunningStats(NR_VOXELS, dtype)
+    reference = [ScalarStats() for _ in range(NR_VOXELS)]
+    out = np.empty((NR_VOXELS,), dtype=dtype)
+
+    for i, volume in enumerate(volumes):
+        if i == NEW_BLOCK:
+            stats.reset()
+            for voxel in reference:
+                voxel.reset()
+
+        stats.update(volume.astype(dtype))
+        for voxel, value in zip(reference, volume):
+            voxel.update(float(value))
+
+        runningstats.snr(stats, out)
+
+        np.testing.assert_allclose(stats.mean, [v.mean for v in reference], **TOLERANCES[dtype])
+        np.testing.assert_allclose(stats.var, [v.var for v in reference], **TOLERANCES[dtype])
+        np.testing.assert_allclose(out, [v.snr() for v in reference], **TOLERANCES[dtype])
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_cnr_matches_scalar_formulas(dtype):
+    volumes = make_volumes()
+    codes = condition_codes()
+    bas = runningstats.RunningStats(NR_VOXELS, dtype)
+    cond = runningstats.RunningStats(NR_VOXELS, dtype)
+    ref_bas = [ScalarStats() for _ in range(NR_VOXELS)]
+    ref_cond = [ScalarStats() for _ in range(NR_VOXELS)]
+    out = np.empty((NR_VOXELS,), dtype=dtype)
+
+    for i, (volume, code) in enumerate(zip(volumes, codes)):
+        if i == NEW_BLOCK:
+            bas.reset()
+            cond.reset()
+            for voxel in ref_bas + ref_cond:
+                voxel.reset()
+
+        stats, reference = (cond, ref_cond) if code else (bas, ref_bas)
+        stats.update(volume.astype(dtype))
+        for voxel, value in zip(reference, volume):
+            voxel.update(float(value))
+
+        runningstats.cnr(bas, cond, out)
+
+        expected = [scalar_cnr(b, c) for b, c in zip(ref_bas, ref_cond)]
+        np.testing.assert_allclose(out, expected, **TOLERANCES[dtype])
+
+
+def test_update_does_not_depend_on_snr_calls():
+    """Statistics take every sample no matter how often SNR is computed from them
+    """
+    volumes = make_volumes()
+    every = runningstats.RunningStats(NR_VOXELS)
+    sparse = runningstats.RunningStats(NR_VOXELS)
+    out_every = np.empty((NR_VOXELS,))
+    out_sparse = np.empty((NR_VOXELS,))
+
+    for i, volume in enumerate(volumes):
+        every.update(volume)
+        runningstats.snr(every, out_every)
+        sparse.update(volume)
+        if i % 3 == 0:
+            runningstats.snr(sparse, out_sparse)
+
+    runningstats.snr(sparse, out_sparse)
+    np.testing.assert_array_equal(out_sparse, out_every)